@@ -150,8 +150,13 @@ class FeatureManager( object ):
         self.size_filter = size_filter
         self.squared_distance_default = squared_distance_default
 
-    def _getBestSquaredDistances(self, com_cur, coms_next, size_filter = None, sizes_next = [], default_value = 9999):
-        ''' returns the squared distances to the objects in the neighborhood of com_curr, optionally with size filter '''
+    def _getBestSquaredDistances(self, com_cur, coms_next, size_filter = None, sizes_next = [], default_value = 9999,
+                                 overlapping_next = None):
+        '''
+        returns the squared distances to the objects in the neighborhood of com_curr, optionally with size filter.
+        If `overlapping_next` contains pairs of overlapping objects of the next frame, an object is skipped
+        if it overlaps a closer one, such that the same cell from several segmentation hypotheses is used only once.
+        '''
         squaredDistances = []
 
         for label_next in coms_next.keys():
@@ -163,6 +168,13 @@ class FeatureManager( object ):
         squaredDistances = np.array(squaredDistances)
         # sort the array in the second column in ascending order
         squaredDistances = np.array(sorted(squaredDistances, key=lambda a_entry: a_entry[1]))        
+
+        if overlapping_next is not None and squaredDistances.shape[0] > 1:
+            selected = []
+            for row in squaredDistances:
+                if not any((int(row[0]), int(other[0])) in overlapping_next for other in selected):
+                    selected.append(row)
+            squaredDistances = np.array(selected)
         
         # initialize with label -1 and default value
         result = np.array([ [-1, default_value] for x in range(self.n_best) ], dtype=np.float32)
@@ -172,12 +184,21 @@ class FeatureManager( object ):
         return result
  
 
-    def computeFeatures_at(self, feats_cur, feats_next, img_next, feat_names, label_image_filename=None):
+    def computeFeatures_at(self, feats_cur, feats_next, img_next, feat_names, label_image_filename=None,
+                           overlapping_next=None):
         '''
         **Parameters:**
     
+        * `img_next` is the label image of the next frame, or any object that provides its `shape` and returns
+          regions of interest when indexed with a tuple of slices, like `hytra.pluginsystem.image_provider_plugin.LabelImageRegionReader`.
+          If it is `None`, the candidates in the next frame are all objects whose center lies within the template
+          around the current object's center, which does not need any image and works on the merged features
+          of several segmentation hypotheses.
         * if `label_image_filename` is given, it is used to filter the objects from the feature dictionaries 
           that belong to that label image only (in the JST setting) 
+        * `overlapping_next` holds the pairs `(a, b)` of objects in the next frame that overlap, because they come
+          from conflicting segmentation hypotheses (e.g. the keys of the overlap pixel counts of that frame).
+          Of overlapping child candidates only the closest one is used.
         ''' 
 
 #        n_labels = feats_cur.values()[0].shape[0]
@@ -215,6 +236,10 @@ class FeatureManager( object ):
             global_indices_current_label_image_only = [l for l, f in enumerate(feats_next['filename']) if f == label_image_filename] 
             local_to_global_index_map = dict( [(feats_next['id'][l], l) for l in global_indices_current_label_image_only] )
 
+        # without label image, find the candidates in the next frame by the distance of their centers
+        if feats_next is not None and img_next is None:
+            coms_next = np.asarray(feats_next[self.com_name_next], dtype=np.float64).reshape((-1, self.ndim))
+
         # for every object in this frame, check which objects are in the vicinity in the next frame
         valid_indices = [0]
         for label_cur, com_cur in enumerate(feats_cur[self.com_name_cur]):
@@ -229,7 +254,15 @@ class FeatureManager( object ):
             for k in vigra_feat_names:
                 feats_next_subset[k] = {}
 
-            if feats_next is not None and img_next is not None:
+            if feats_next is not None and img_next is None:
+                idx_cur = np.round(np.asarray(com_cur, dtype=np.float64)[:self.ndim])
+                inside = np.all(np.abs(coms_next - idx_cur) < self.template_size/2, axis=1)
+                inside[0] = False
+                for l in np.flatnonzero(inside):
+                    for n in vigra_feat_names:
+                        feats_next_subset[n][l] = np.array([feats_next[n][l]]).flatten()
+
+            elif feats_next is not None and img_next is not None:
                 # find roi around the center of the current object
                 idx_cur = [round(x) for x in com_cur]
 
@@ -240,7 +273,7 @@ class FeatureManager( object ):
                     roi.append(slice(int(start),int(stop)))
 
                 # find all coms in the neighborhood of com_cur by checking the next frame's labelimage in the roi
-                subimg_next = img_next[roi]
+                subimg_next = img_next[tuple(roi)]
                 labels_next = np.unique(subimg_next).tolist()
 
                 # if 'id' in features, map the labels first -- because labels_next refers image object ids, 
@@ -254,7 +287,8 @@ class FeatureManager( object ):
                             feats_next_subset[n][l] = np.array([feats_next[n][l]]).flatten()                          
 
             sq_dist_label = self._getBestSquaredDistances(com_cur, feats_next_subset[self.com_name_next], 
-                                self.size_filter, feats_next_subset[self.size_name], default_value=self.squared_distance_default)
+                                self.size_filter, feats_next_subset[self.size_name], default_value=self.squared_distance_default,
+                                overlapping_next=overlapping_next)
 
             feats_next_subset_best = {}
             for n in vigra_feat_names:
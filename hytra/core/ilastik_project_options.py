@@ -24,6 +24,9 @@ class IlastikProjectOptions:
         self.imageProviderName = 'LocalImageLoader'
         self.featureSerializerName = 'LocalFeatureSerializer'
         self.sizeFilter = None  # set to tuple with min,max pixel count
+        self.frameCacheSize = 0  # bytes of decoded frames to keep in memory per process, 0 disables the frame cache
+        self.frameCacheScratchDirectory = None  # directory where decoded frames are shared between processes
+        self.featureSpillDirectory = None  # directory to store the features of each frame in, instead of keeping them in memory
 
 def extractWeightDictFromIlastikProject(ilpFilename):
     """
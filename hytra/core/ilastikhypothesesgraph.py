@@ -57,6 +57,13 @@ class IlastikHypothesesGraph(HypothesesGraph):
 
         See the documentation of `hytra.core.hypothesesgraph` for details on how the features are stored.
         """
+        # predict the probabilities of all transitions at once
+        transitionProbabilities = None
+        if self.transitionClassifier is not None:
+            transitionProbabilities = self.getAllTransitionFeaturesRF(self.transitionClassifier,
+                                                                      self.probabilityGenerator,
+                                                                      self.maxNumObjects + 1)
+
         # define wrapper functions
         def detectionProbabilityFunc(traxel):
             return self.getDetectionFeatures(traxel, self.maxNumObjects + 1)
@@ -65,6 +72,9 @@ class IlastikHypothesesGraph(HypothesesGraph):
             if self.transitionClassifier is None:
                 return self.getTransitionFeaturesDist(srcTraxel, destTraxel, self.transitionParameter, self.maxNumObjects + 1)
             else:
+                key = ((srcTraxel.Timestep, srcTraxel.Id), (destTraxel.Timestep, destTraxel.Id))
+                if key in transitionProbabilities:
+                    return transitionProbabilities[key]
                 return self.getTransitionFeaturesRF(srcTraxel, destTraxel, self.transitionClassifier, self.probabilityGenerator, self.maxNumObjects + 1)
 
         def boundaryCostMultiplierFunc(traxel):
@@ -123,6 +133,48 @@ class IlastikHypothesesGraph(HypothesesGraph):
         return [probs[0]] + [probs[1]] * (max_state - 1)
 
 
+    def _getTransitionTraxelPairs(self):
+        """
+        Find all pairs of traxels whose transition probabilities are needed by `insertEnergies`:
+        the links of the graph, and the consecutive traxels inside tracklets.
+        """
+        pairs = []
+        if self.withTracklets:
+            for n in self._graph.nodes_iter():
+                tracklet = self._graph.node[n]['tracklet']
+                pairs.extend(zip(tracklet[:-1], tracklet[1:]))
+
+        for a in self._graph.edges_iter():
+            if not self.withTracklets:
+                pairs.append((self._graph.node[self.source(a)]['traxel'], self._graph.node[self.target(a)]['traxel']))
+            else:
+                pairs.append((self._graph.node[self.source(a)]['tracklet'][-1], self._graph.node[self.target(a)]['tracklet'][0]))
+        return pairs
+
+    def getAllTransitionFeaturesRF(self, transitionClassifier, probabilityGenerator, max_state):
+        """
+        Get the transition probabilities of all traxel pairs returned by `_getTransitionTraxelPairs`, by constructing
+        the feature vectors of all transitions between the same pair of frames at once
+        and predicting them with the classifier in one batch.
+
+        **returns** a dictionary of ((srcTimestep, srcId), (destTimestep, destId)) -> probabilities
+        """
+        pairsPerFramePair = {}
+        for traxelA, traxelB in self._getTransitionTraxelPairs():
+            pairsPerFramePair.setdefault((traxelA.Timestep, traxelB.Timestep), set()).add((traxelA.Id, traxelB.Id))
+
+        transitionProbabilities = {}
+        selectedFeatures = transitionClassifier.selectedFeatures
+        for (frameA, frameB), pairs in pairsPerFramePair.items():
+            pairs = sorted(pairs)
+            featuresA = probabilityGenerator.getObjectFeatureMatrices(frameA, [p[0] for p in pairs], selectedFeatures)
+            featuresB = probabilityGenerator.getObjectFeatureMatrices(frameB, [p[1] for p in pairs], selectedFeatures)
+            featMat = probabilityGenerator.getTransitionFeatureMatrix(featuresA, featuresB, selectedFeatures)
+            probs = transitionClassifier.predictProbabilities(featMat)
+            for (idA, idB), p in zip(pairs, probs):
+                transitionProbabilities[((frameA, idA), (frameB, idB))] = [p[0]] + [p[1]] * (max_state - 1)
+        return transitionProbabilities
+
     def getBoundaryCostMultiplier(self, traxel, fov, margin, t0, t1):
         """
         A traxel's appearance and disappearance probability decrease linearly within a `margin` to the image border
@@ -3,6 +3,7 @@ import logging
 import h5py
 import os
 import hytra.core.mergerresolver
+from hytra.util.framecache import FrameCache
 from hytra.core.jsongraph import JsonTrackingGraph
 
 def getLogger():
@@ -23,8 +24,10 @@ class JsonMergerResolver(hytra.core.mergerresolver.MergerResolver):
                  raw_path,
                  raw_axes,
                  pluginPaths=[os.path.abspath('../hytra/plugins')],
-                 verbose=False):
-        super(JsonMergerResolver, self).__init__(pluginPaths, verbose)
+                 verbose=False,
+                 useMultiprocessing=True,
+                 frameCacheSize=0):
+        super(JsonMergerResolver, self).__init__(pluginPaths, verbose, useMultiprocessing)
 
         # copy model and result because we will modify it here
         assert(isinstance(jsonTrackingGraph, JsonTrackingGraph))
@@ -45,6 +48,10 @@ class JsonMergerResolver(hytra.core.mergerresolver.MergerResolver):
         self.raw_axes = raw_axes
         self.pluginManager.setImageProvider('LocalImageLoader')
         self.imageProvider = self.pluginManager.getImageProvider()
+
+        # the label images are read for fitting, feature computation and export, so keep them decoded
+        if frameCacheSize > 0:
+            self.imageProvider.setFrameCache(FrameCache(frameCacheSize))
     
 
     def _computeObjectFeatures(self, timesteps):
@@ -52,15 +59,12 @@ class JsonMergerResolver(hytra.core.mergerresolver.MergerResolver):
         Computes object features for all nodes in the resolved graph because they
         are needed for the transition classifier or to compute new distances.
 
+        Processes one frame at a time: the raw and (relabeled) label image of a frame are loaded,
+        the features of all objects in that frame are computed in a single call to the feature plugins,
+        and the images are released before the next frame is loaded.
+
         **returns:** a dictionary of feature-dicts per node
         """
-        rawImages = {}
-        labelImages = {}
-        for t in timesteps:
-            rawImages[t] = self.imageProvider.getImageDataAtTimeFrame(self.raw_filename, self.raw_path, self.raw_axes, int(t))
-            labelImages[t] = self.imageProvider.getLabelImageForFrame(self.label_image_filename, self.label_image_path, int(t))
-            self.relabelMergers(labelImages[t], int(t))
-
         getLogger().info("Computing object features")
         objectFeatures = {}
         imageShape = self.imageProvider.getImageShape(self.label_image_filename, self.label_image_path)
@@ -69,34 +73,40 @@ class JsonMergerResolver(hytra.core.mergerresolver.MergerResolver):
         # there is no time axis...
         ndims = len([i for i in imageShape if i != 1])
         getLogger().info("Data has dimensionality {}".format(ndims))
+
+        # group the nodes of the resolved graph by frame
+        nodesPerTimestep = {}
         for node in self.resolvedGraph.nodes_iter():
             intT, idx = node
             if isinstance(idx, str) and idx.startswith('div-'):
                 continue
+            nodesPerTimestep.setdefault(intT, []).append(node)
+
+        # the label image buffer is reused for all frames
+        labelImage = None
+        for intT in sorted(nodesPerTimestep.keys()):
+            rawImage = self.imageProvider.getImageDataAtTimeFrame(self.raw_filename, self.raw_path, self.raw_axes, intT)
+            labelImage = self.imageProvider.getLabelImageForFrame(
+                self.label_image_filename, self.label_image_path, intT, out=labelImage)
+            labelImage = self.relabelMergers(labelImage, intT)
 
-            # mask out this object only and compute features
-            mask = labelImages[str(intT)].copy()
-            mask[mask != idx] = 0
-            mask[mask == idx] = 1
-
-            # compute features, transform to one dict for frame
-            frameFeatureDicts, ignoreNames = self.pluginManager.applyObjectFeatureComputationPlugins(
-                ndims, rawImages[str(intT)], mask, intT, self.raw_filename)
-            frameFeatureItems = []
-            for f in frameFeatureDicts:
-                frameFeatureItems = frameFeatureItems + f.items()
-            frameFeatures = dict(frameFeatureItems)
-
-            # extract all features for this one object
-            objectFeatureDict = {}
-            for k, v in frameFeatures.iteritems():
-                if k in ignoreNames:
-                    continue
-                elif 'Polygon' in k:
-                    objectFeatureDict[k] = v[1]
-                else:
-                    objectFeatureDict[k] = v[1, ...]
-            objectFeatures[node] = objectFeatureDict
+            # compute features of all objects in this frame, transform to one dict for frame
+            frameFeatures = self.pluginManager.computeObjectFeatures(
+                ndims, rawImage, labelImage, intT, self.raw_filename)
+
+            # extract all features for the objects of this frame
+            for node in nodesPerTimestep[intT]:
+                idx = node[1]
+                objectFeatureDict = {}
+                for k, v in frameFeatures.iteritems():
+                    if 'Polygon' in k:
+                        objectFeatureDict[k] = v[idx]
+                    else:
+                        objectFeatureDict[k] = v[idx, ...]
+                objectFeatures[node] = objectFeatureDict
+
+            # release the raw image and features of this frame before loading the next one
+            del rawImage, frameFeatures
 
         return objectFeatures
     
@@ -106,9 +116,15 @@ class JsonMergerResolver(hytra.core.mergerresolver.MergerResolver):
         '''
         return self.imageProvider.getLabelImageForFrame(self.label_image_filename, self.label_image_path, timeframe)
 
+    def _getLabelImageSource(self):
+        '''
+        Returns the image provider plugin name, file and path of the label images
+        '''
+        return self.pluginManager.chosen_data_provider, self.label_image_filename, self.label_image_path
+
     def _exportRefinedSegmentation(self, timesteps):
         h5py.File(self.out_label_image, 'w').close()
         for t in timesteps:
             labelImage = self._readLabelImage(int(t))
-            self.relabelMergers(labelImage, int(t))
+            labelImage = self.relabelMergers(labelImage, int(t))
             self.imageProvider.exportLabelImage(labelImage, int(t), self.out_label_image, self.label_image_path)
\ No newline at end of file
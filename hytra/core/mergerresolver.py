@@ -1,9 +1,15 @@
 import logging
 import itertools
+import inspect
 import os
+import multiprocessing
+import concurrent.futures
 import numpy as np
 import networkx as nx
+from scipy.ndimage import find_objects
 from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+from hytra.pluginsystem.image_provider_plugin import LabelImageRegionReader
+from hytra.pluginsystem.transition_feature_vector_construction_plugin import stackObjectFeatures
 import hytra.core.probabilitygenerator as probabilitygenerator
 import hytra.core.jsongraph
 from hytra.core.jsongraph import negLog, listify, JsonTrackingGraph
@@ -14,21 +20,186 @@ def getLogger():
     return logging.getLogger(__name__)
 
 
+def getBoundingBox(boundingBoxes, objectId):
+    '''
+    **returns** the bounding box of `objectId` from the list returned by `scipy.ndimage.find_objects`,
+    or `None` if the object does not occur in the label image
+    '''
+    if 0 < objectId <= len(boundingBoxes):
+        return boundingBoxes[objectId - 1]
+    return None
+
+
+def acceptsBoundingBox(function):
+    '''
+    Merger resolver plugins written before bounding boxes were introduced implement
+    `updateLabelImage(labelImage, objectId, fits, newIds)` without the `boundingBox` argument.
+
+    **returns** whether `boundingBox` can be passed to the given (bound) plugin method
+    '''
+    argspec = inspect.getargspec(function)
+    return 'boundingBox' in argspec.args or argspec.keywords is not None
+
+
+def fitMergerComponentsInSeparateProcess(components,
+                                         labelImageSource,
+                                         pluginPaths=[os.path.abspath('../hytra/plugins')],
+                                         mergerResolverPluginName='GMMMergerResolver'):
+    '''
+    Fit all nodes of the given connected components of the unresolved graph using the merger resolver plugin.
+    The nodes of all components are fitted frame by frame, passing all nodes of a frame to the plugin at once.
+    The pixel coordinates of the nodes are read from their bounding boxes in the label image of the current frame,
+    so they never need to be held for the whole movie or be sent to this process.
+
+    **Parameters**
+
+    * `components`: a list of components, where each component is a list of
+      `(node, count, boundingBox, predecessors)` tuples ordered by ascending timestep.
+      `predecessors` must all be contained in the same component and appear earlier in the list.
+    * `labelImageSource`: a tuple `(imageProviderPluginName, labelImageFilename, labelImagePath)`
+      that tells where the label images can be read
+    * `pluginPaths`: where all yapsy plugins are stored
+    * `mergerResolverPluginName`: name of the merger resolver plugin to use
+
+    Meant to be run in its own process using `concurrent.futures.ProcessPoolExecutor`
+
+    **returns** a dictionary with the list of fitted objects per node
+    '''
+
+    # set up plugin manager
+    from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+    pluginManager = TrackingPluginManager(pluginPaths=pluginPaths, verbose=False)
+    pluginManager.setMergerResolver(mergerResolverPluginName)
+    mergerResolverPlugin = pluginManager.getMergerResolver()
+    imageProviderPluginName, labelImageFilename, labelImagePath = labelImageSource
+    pluginManager.setImageProvider(imageProviderPluginName)
+    imageProvider = pluginManager.getImageProvider()
+
+    # all nodes of one frame are independent of each other, so they can be fitted as one batch
+    nodesPerTimestep = {}
+    for component in components:
+        for nodeInfo in component:
+            nodesPerTimestep.setdefault(nodeInfo[0][0], []).append(nodeInfo)
+
+    fitsPerNode = {}
+    for timestep in sorted(nodesPerTimestep.keys()):
+        labelImage = LabelImageRegionReader(imageProvider, labelImageFilename, labelImagePath, timestep)
+        nodes, counts, coordinatesList, initializationsList = [], [], [], []
+        for node, count, boundingBox, predecessors in nodesPerTimestep[timestep]:
+            # collect initializations from incoming, which have been fitted before as they are in an earlier frame
+            initializations = []
+            for predecessor in predecessors:
+                initializations.extend(fitsPerNode[predecessor])
+            if boundingBox is None:
+                boundingBox = tuple(slice(0, s) for s in labelImage.shape)
+            nodes.append(node)
+            counts.append(count)
+            coordinatesList.append(mergerResolverPlugin.getObjectCoordinates(labelImage, node[1], boundingBox))
+            initializationsList.append(initializations)
+
+        fittedObjectsList = mergerResolverPlugin.resolveMergersForCoords(coordinatesList, counts, initializationsList)
+        for node, count, fittedObjects in zip(nodes, counts, fittedObjectsList):
+            assert(len(fittedObjects) == count)
+            fitsPerNode[node] = fittedObjects
+
+    return fitsPerNode
+
+
+def maxFlowMinCostTracking(numNodes, appearanceNodes, disappearanceNodes, arcs, arcCosts, detectionCost=1.0, costScale=10000):
+    """
+    Find the maximum flow of minimal cost through a tracking graph where each node can be used at most once,
+    using `networkx` in the current process.
+
+    **Parameters**
+
+    * `numNodes`: the number of nodes, which are identified by indices `0..numNodes-1`
+    * `appearanceNodes`, `disappearanceNodes`: indices of the nodes where flow can enter or leave the graph
+    * `arcs`: a `(numArcs, 2)` array of source and target node indices
+    * `arcCosts`: the cost of using each arc (energy of state 1 minus energy of state 0)
+    * `detectionCost`: the cost of using a node
+    * `costScale`: costs are multiplied by this factor and rounded, because the `networkx`
+      flow algorithms only work reliably with integer weights
+
+    **returns** arrays holding the flow through every node and every arc
+    """
+    if len(appearanceNodes) == 0 or len(disappearanceNodes) == 0:
+        return np.zeros(numNodes, dtype=np.int64), np.zeros(len(arcs), dtype=np.int64)
+
+    # split every node into an in- and out-node (2n, 2n+1) connected by an arc of capacity one
+    source = 2 * numNodes
+    sink = 2 * numNodes + 1
+    flowGraph = nx.DiGraph()
+    detectionWeight = int(round(detectionCost * costScale))
+    for n in range(numNodes):
+        flowGraph.add_edge(2 * n, 2 * n + 1, capacity=1, weight=detectionWeight)
+    for n in appearanceNodes:
+        flowGraph.add_edge(source, 2 * n, capacity=1, weight=0)
+    for n in disappearanceNodes:
+        flowGraph.add_edge(2 * n + 1, sink, capacity=1, weight=0)
+    for (src, dest), cost in zip(arcs, np.round(np.asarray(arcCosts) * costScale).astype(np.int64)):
+        flowGraph.add_edge(2 * int(src) + 1, 2 * int(dest), capacity=1, weight=int(cost))
+
+    flowDict = nx.max_flow_min_cost(flowGraph, source, sink)
+    nodeFlow = np.array([flowDict[2 * n][2 * n + 1] for n in range(numNodes)], dtype=np.int64)
+    arcFlow = np.array([flowDict[2 * int(src) + 1][2 * int(dest)] for src, dest in arcs], dtype=np.int64)
+    return nodeFlow, arcFlow
+
+
+def maxFlowMinCostTrackingWithDpct(numNodes, appearanceNodes, disappearanceNodes, arcs, arcEnergies):
+    """
+    Same as `maxFlowMinCostTracking`, but sets up a `JsonTrackingGraph` and runs `dpct.trackMaxFlow`.
+    `arcEnergies` is a `(numArcs, 2)` array of the energies for the arc states 0 and 1.
+
+    **returns** arrays holding the flow through every node and every arc
+    """
+    trackingGraph = JsonTrackingGraph()
+    appearanceNodes = set(appearanceNodes)
+    disappearanceNodes = set(disappearanceNodes)
+    for n in range(numNodes):
+        additionalFeatures = {}
+        if n in appearanceNodes:
+            additionalFeatures['appearanceFeatures'] = [[0], [0]]
+        if n in disappearanceNodes:
+            additionalFeatures['disappearanceFeatures'] = [[0], [0]]
+        uuid = trackingGraph.addDetectionHypotheses([[0], [1]], **additionalFeatures)
+        assert(uuid == n)
+
+    for (src, dest), energies in zip(arcs, arcEnergies):
+        trackingGraph.addLinkingHypotheses(int(src), int(dest), listify(energies))
+
+    import dpct
+    weights = {"weights": [1, 1, 1, 1]}
+    mergerResult = dpct.trackMaxFlow(trackingGraph.model, weights)
+
+    nodeFlow = np.zeros(numNodes, dtype=np.int64)
+    for d in mergerResult['detectionResults']:
+        nodeFlow[int(d['id'])] = int(d['value'])
+    linkFlowMap = dict([((int(l['src']), int(l['dest'])), int(l['value'])) for l in mergerResult['linkingResults']])
+    arcFlow = np.array([linkFlowMap.get((int(src), int(dest)), 0) for src, dest in arcs], dtype=np.int64)
+    return nodeFlow, arcFlow
+
+
 class MergerResolver(object):
     """
     Base class for all merger resolving implementations. Use one of the derived classes
     that handle reading/writing data to the respective sources.
     """
 
-    def __init__(self, pluginPaths=[os.path.abspath('../hytra/plugins')], verbose=False):
+    def __init__(self, pluginPaths=[os.path.abspath('../hytra/plugins')], verbose=False, useMultiprocessing=True):
         self.unresolvedGraph = None
         self.resolvedGraph = None
         self.mergersPerTimestep = None
         self.detectionsPerTimestep = None
+        self._pluginPaths = pluginPaths
+        self._useMultiprocessing = useMultiprocessing
         self.pluginManager = TrackingPluginManager(
             verbose=verbose, pluginPaths=pluginPaths)
         self.mergerResolverPlugin = self.pluginManager.getMergerResolver()
 
+        # which min-cost max-flow solver to use to find the merger assignments: 'dpct', 'networkx',
+        # or 'auto' to use dpct if it is installed
+        self.minCostFlowSolver = 'auto'
+
         # should be filled by constructors of derived classes!
         self.model = None
         self.result = None
@@ -132,6 +303,78 @@ class MergerResolver(object):
         '''
         raise NotImplementedError()
 
+    def _getLabelImageSource(self):
+        '''
+        Should return a tuple `(imageProviderPluginName, labelImageFilename, labelImagePath)`
+        that allows worker processes to read regions of the label images
+        '''
+        raise NotImplementedError()
+
+    def _findMergerComponents(self, nodesToFit):
+        """
+        Split the `unresolvedGraph` into its weakly connected components. Fits only depend on the fits of
+        predecessors, so different components can be resolved independently of each other.
+
+        `nodesToFit` is a dictionary of `(count, boundingBox)` per node that should be fitted.
+
+        ** returns ** a list of components, each being a list of `(node, count, boundingBox, predecessors)`
+        tuples, ordered by timestep
+        """
+        components = []
+        for componentNodes in nx.weakly_connected_components(self.unresolvedGraph):
+            component = []
+            for node in sorted([n for n in componentNodes if n in nodesToFit], key=lambda n: n[0]):
+                count, boundingBox = nodesToFit[node]
+                predecessors = [e[0] for e in self.unresolvedGraph.in_edges(node)]
+                component.append((node, count, boundingBox, predecessors))
+            if len(component) > 0:
+                components.append(component)
+        return components
+
+    def _fitMergerComponents(self, components):
+        """
+        Fit all `components` (as returned by `_findMergerComponents`) using the merger resolver plugin.
+        Independent components are distributed to several processes if `self._useMultiprocessing=True`,
+        while the initialization order inside each component is kept.
+
+        ** returns ** a dictionary with the list of fitted objects per node
+        """
+        if self._useMultiprocessing:
+            # use ProcessPoolExecutor, which instanciates as many processes as there CPU cores by default
+            ExecutorType = concurrent.futures.ProcessPoolExecutor
+            numJobs = min(len(components), 4 * multiprocessing.cpu_count())
+            getLogger().info('Parallelizing merger fitting of {} components via multiprocessing on all cores!'.format(
+                len(components)))
+        else:
+            ExecutorType = probabilitygenerator.DummyExecutor
+            numJobs = 1
+            getLogger().info('Running merger fitting on single core!')
+
+        # distribute components to jobs such that all jobs have to fit a similar number of nodes,
+        # so we do not have to set up the plugin manager once per (often tiny) component
+        componentsPerJob = [[] for _ in range(numJobs)]
+        nodesPerJob = [0] * numJobs
+        for component in sorted(components, key=len, reverse=True):
+            job = nodesPerJob.index(min(nodesPerJob))
+            componentsPerJob[job].append(component)
+            nodesPerJob[job] += len(component)
+
+        fitsPerNode = {}
+        labelImageSource = self._getLabelImageSource()
+        with ExecutorType() as executor:
+            jobs = []
+            for jobComponents in componentsPerJob:
+                jobs.append(executor.submit(fitMergerComponentsInSeparateProcess,
+                                            jobComponents,
+                                            labelImageSource,
+                                            self._pluginPaths,
+                                            self.pluginManager.chosen_merger_resolver
+                ))
+            for job in concurrent.futures.as_completed(jobs):
+                fitsPerNode.update(job.result())
+
+        return fitsPerNode
+
     def _fitAndRefineNodes(self,
                             detectionsPerTimestep,
                             mergersPerTimestep,
@@ -140,17 +383,25 @@ class MergerResolver(object):
         Update segmentation of mergers (nodes in unresolvedGraph) from first timeframe to last
         and create new nodes in `resolvedGraph`. Links to merger nodes are duplicated to all new nodes.
 
-        Uses the mergerResolver plugin to update the segmentations in the labelImages.
+        Uses the mergerResolver plugin to fit the mergers. The only dependency between frames are the
+        initializations taken from the fits of the predecessors, so the connected components of the
+        `unresolvedGraph` are fitted in parallel (see `_fitMergerComponents`), before the nodes are refined
+        frame by frame.
         '''
 
         intTimesteps = [int(t) for t in timesteps]
         intTimesteps.sort()
 
+        # collect the bounding boxes of all nodes that need to be fitted, reading every label image only once.
+        # The pixel coordinates are only read by the fitting jobs, one frame at a time
+        nodesToFit = {}
+        nextObjectIds = {}
         for intT in intTimesteps:
             t = str(intT)
             # use image provider plugin to load labelimage
             labelImage = self._readLabelImage(int(t))
-            nextObjectId = labelImage.max() + 1
+            nextObjectIds[intT] = labelImage.max() + 1
+            boundingBoxes = find_objects(labelImage)
 
             for idx in detectionsPerTimestep[t]:
                 node = (intT, idx)
@@ -160,19 +411,25 @@ class MergerResolver(object):
                 count = 1
                 if idx in mergersPerTimestep[t]:
                     count = mergersPerTimestep[t][idx]
+                nodesToFit[node] = (count, getBoundingBox(boundingBoxes, idx))
+
+        # TODO: what shall we do if e.g. a 2-merger and a single object merge to 2 + 1,
+        # so there are 3 initializations for the 2-merger, and two initializations for the 1 merger?
+        # What does pgmlink do in that case?
+        fitsPerNode = self._fitMergerComponents(self._findMergerComponents(nodesToFit))
+
+        for intT in intTimesteps:
+            t = str(intT)
+            nextObjectId = nextObjectIds[intT]
+
+            for idx in detectionsPerTimestep[t]:
+                node = (intT, idx)
+                if node not in self.resolvedGraph:
+                    continue
+
+                count, _ = nodesToFit[node]
                 getLogger().debug("Looking at node {} in timestep {} with count {}".format(idx, t, count))
-                
-                # collect initializations from incoming
-                initializations = []
-                for predecessor, _ in self.unresolvedGraph.in_edges(node):
-                    initializations.extend(self.unresolvedGraph.node[predecessor]['fits'])
-                # TODO: what shall we do if e.g. a 2-merger and a single object merge to 2 + 1,
-                # so there are 3 initializations for the 2-merger, and two initializations for the 1 merger?
-                # What does pgmlink do in that case?
-
-                # use merger resolving plugin to fit `count` objects, also updates labelimage!
-                fittedObjects = self.mergerResolverPlugin.resolveMerger(labelImage, idx, nextObjectId, count, initializations)
-                assert(len(fittedObjects) == count)
+                fittedObjects = fitsPerNode[node]
 
                 # split up node if count > 1, duplicate incoming and outgoing arcs
                 if count > 1:
@@ -204,60 +461,78 @@ class MergerResolver(object):
 
     def _minCostMaxFlowMergerResolving(self, objectFeatures, transitionClassifier=None, transitionParameter=5.0):
         """
-        Find the optimal assignments within the `resolvedGraph` by running min-cost max-flow from the
-        `dpct` module.
+        Find the optimal assignments within the `resolvedGraph` by running min-cost max-flow,
+        either using `dpct` or the in-process `networkx` solver on integer-scaled costs,
+        depending on `self.minCostFlowSolver`.
 
-        Converts the `resolvedGraph` to our JSON model structure, predicts the transition probabilities
-        either using the given transitionClassifier, or using distance-based probabilities.
+        Predicts the transition probabilities either using the given transitionClassifier,
+        or using distance-based probabilities.
 
         **returns** a `nodeFlowMap` and `arcFlowMap` holding information on the usage of the respective nodes and links
-
-        **Note:** cannot use `networkx` flow methods because they don't work with floating point weights.
         """
 
-        trackingGraph = JsonTrackingGraph()
-        for node in self.resolvedGraph.nodes_iter():
-            additionalFeatures = {}
-            if len(self.resolvedGraph.in_edges(node)) == 0:
-                additionalFeatures['appearanceFeatures'] = [[0], [0]]
-            if len(self.resolvedGraph.out_edges(node)) == 0:
-                additionalFeatures['disappearanceFeatures'] = [[0], [0]]
-            uuid = trackingGraph.addDetectionHypotheses([[0], [1]], **additionalFeatures)
+        # enumerate nodes and arcs of the resolved graph
+        nodes = self.resolvedGraph.nodes()
+        for uuid, node in enumerate(nodes):
             self.resolvedGraph.node[node]['id'] = uuid
-
-        for edge in self.resolvedGraph.edges_iter():
+        appearanceNodes = [self.resolvedGraph.node[n]['id'] for n in nodes if len(self.resolvedGraph.in_edges(n)) == 0]
+        disappearanceNodes = [self.resolvedGraph.node[n]['id'] for n in nodes if len(self.resolvedGraph.out_edges(n)) == 0]
+
+        edges = self.resolvedGraph.edges()
+        arcs = np.zeros((len(edges), 2), dtype=np.int64)
+        arcEnergies = np.zeros((len(edges), 2))
+
+        if transitionClassifier is not None and len(edges) > 0:
+            # construct the feature vectors of all links at once and predict them in one batch
+            selectedFeatures = transitionClassifier.selectedFeatures
+            try:
+                featuresAtSrc = stackObjectFeatures([objectFeatures[edge[0]] for edge in edges], selectedFeatures)
+                featuresAtDest = stackObjectFeatures([objectFeatures[edge[1]] for edge in edges], selectedFeatures)
+                featMat = self.pluginManager.applyTransitionFeatureMatrixConstructionPlugins(
+                    featuresAtSrc, featuresAtDest, selectedFeatures)
+            except:
+                getLogger().error("Could not compute transition features of {} links".format(len(edges)))
+                raise
+            transitionProbabilities = transitionClassifier.predictProbabilities(featMat)
+
+        for i, edge in enumerate(edges):
             src = self.resolvedGraph.node[edge[0]]['id']
             dest = self.resolvedGraph.node[edge[1]]['id']
 
-            featuresAtSrc = objectFeatures[edge[0]]
-            featuresAtDest = objectFeatures[edge[1]]
-
             if transitionClassifier is not None:
-                try:
-                    featVec = self.pluginManager.applyTransitionFeatureVectorConstructionPlugins(
-                        featuresAtSrc, featuresAtDest, transitionClassifier.selectedFeatures)
-                except:
-                    getLogger().error("Could not compute transition features of link {}->{}:".format(src, dest))
-                    getLogger().error(featuresAtSrc)
-                    getLogger().error(featuresAtDest)
-                    raise
-                featVec = np.expand_dims(np.array(featVec), axis=0)
-                probs = transitionClassifier.predictProbabilities(featVec)[0]
+                probs = transitionProbabilities[i]
             else:
+                featuresAtSrc = objectFeatures[edge[0]]
+                featuresAtDest = objectFeatures[edge[1]]
                 dist = np.linalg.norm(featuresAtDest['RegionCenter'] - featuresAtSrc['RegionCenter'])
                 prob = np.exp(-dist / transitionParameter)
                 probs = [1.0 - prob, prob]
 
-            trackingGraph.addLinkingHypotheses(src, dest, listify(negLog(probs)))
+            arcs[i] = [src, dest]
+            arcEnergies[i] = negLog(probs)
 
         # track
-        import dpct
-        weights = {"weights": [1, 1, 1, 1]}
-        mergerResult = dpct.trackMaxFlow(trackingGraph.model, weights)
+        solver = self.minCostFlowSolver
+        if solver == 'auto':
+            try:
+                import dpct
+                solver = 'dpct'
+            except ImportError:
+                solver = 'networkx'
+        getLogger().debug("Using {} min-cost max-flow solver on {} nodes and {} arcs".format(solver, len(nodes), len(edges)))
+
+        if solver == 'dpct':
+            nodeFlow, arcFlow = maxFlowMinCostTrackingWithDpct(
+                len(nodes), appearanceNodes, disappearanceNodes, arcs, arcEnergies)
+        elif solver == 'networkx':
+            nodeFlow, arcFlow = maxFlowMinCostTracking(
+                len(nodes), appearanceNodes, disappearanceNodes, arcs, arcEnergies[:, 1] - arcEnergies[:, 0])
+        else:
+            raise ValueError("Unknown min-cost flow solver '{}', use 'auto', 'dpct' or 'networkx'".format(solver))
 
         # transform results to dictionaries that can be indexed by id or (src,dest)
-        nodeFlowMap = dict([(int(d['id']), int(d['value'])) for d in mergerResult['detectionResults']])
-        arcFlowMap = dict([((int(l['src']), int(l['dest'])), int(l['value'])) for l in mergerResult['linkingResults']])
+        nodeFlowMap = dict([(i, int(v)) for i, v in enumerate(nodeFlow)])
+        arcFlowMap = dict([((int(a[0]), int(a[1])), int(v)) for a, v in zip(arcs, arcFlow)])
 
         return nodeFlowMap, arcFlowMap
 
@@ -483,11 +758,22 @@ class MergerResolver(object):
     def relabelMergers(self, labelImage, time):
         """
         Calls the merger resolving plugin to relabel the mergers based on a previously found fit,
-        which is stored in the hypotheses graph node
+        which is stored in the hypotheses graph node.
+
+        **returns** the relabeled image, which is a copy if the given `labelImage` was read-only (e.g. from a frame cache)
         """
         t = str(time)
         
         if self.detectionsPerTimestep is not None and t in self.detectionsPerTimestep:
+            if not labelImage.flags.writeable:
+                labelImage = labelImage.copy()
+
+            # find the bounding boxes of all objects in one pass, so that each merger only needs to look at its crop,
+            # if the plugin supports that
+            boundingBoxes = None
+            if acceptsBoundingBox(self.mergerResolverPlugin.updateLabelImage):
+                boundingBoxes = find_objects(labelImage)
+
             for idx in self.detectionsPerTimestep[t]:
                 node = (time, idx)
 
@@ -499,6 +785,10 @@ class MergerResolver(object):
                 newIds = self.unresolvedGraph.node[node]['newIds']
                 
                 # use merger resolving plugin to update labelImage with merger IDs
-                self.mergerResolverPlugin.updateLabelImage(labelImage, idx, fits, newIds)
+                if boundingBoxes is None:
+                    self.mergerResolverPlugin.updateLabelImage(labelImage, idx, fits, newIds)
+                else:
+                    self.mergerResolverPlugin.updateLabelImage(labelImage, idx, fits, newIds,
+                                                               boundingBox=getBoundingBox(boundingBoxes, idx))
           
         return labelImage
\ No newline at end of file
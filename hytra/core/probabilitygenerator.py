@@ -1,17 +1,24 @@
 import numpy as np
 import logging
+import os
 import time
 import concurrent.futures
+import multiprocessing
 
 import hytra.core.divisionfeatures
 from hytra.util.progressbar import ProgressBar
+from hytra.util.framecache import FrameCache
 from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+from hytra.pluginsystem.image_provider_plugin import LabelImageRegionReader
 from hytra.core.random_forest_classifier import RandomForestClassifier
 from hytra.core.ilastik_project_options import IlastikProjectOptions
 
 def getLogger():
     return logging.getLogger("ProbabilityGenerator")
 
+_labelImageBuffers = {}
+''' label image buffer per label image file, reused by all feature computation jobs running in this process '''
+
 class Traxel(object):
     """
     A simple Python variant of the C++ traxel with the same interface 
@@ -81,7 +88,10 @@ def computeRegionFeaturesOnCloud(frame,
                                  pluginPaths=['hytra/plugins'],
                                  featuresPerFrame = None,
                                  imageProviderPluginName='LocalImageLoader',
-                                 featureSerializerPluginName='LocalFeatureSerializer'
+                                 featureSerializerPluginName='LocalFeatureSerializer',
+                                 frameCache=None,
+                                 featureSpillDirectory=None,
+                                 numObjectFeatureThreads=1
                                 ):
     '''
     Allow to use dispy to schedule feature computation to nodes running a dispynode,
@@ -96,9 +106,13 @@ def computeRegionFeaturesOnCloud(frame,
     * `labelImageFilename`: the base filename of the label image volume, or a dvid server address
     * `labelImagePath`: path inside the label image HDF5 file, or DVID dataset UUID
     * `pluginPaths`: where all yapsy plugins are stored (should be absolute for DVID)
+    * `frameCache`: optional `hytra.util.framecache.FrameCache` to keep the decoded frames for later passes
+    * `featureSpillDirectory`: if given, the local feature serializer writes the features to a file in this directory
+    * `numObjectFeatureThreads`: number of threads in which the object feature plugins run for this frame
 
-    **returns** the feature dictionary for this frame if `featureSerializerPluginName == 'LocalFeatureSerializer'`
-    and `featuresPerFrame == None`.
+    **returns** a tuple of the frame and its feature dictionary if `featureSerializerPluginName == 'LocalFeatureSerializer'`,
+    `featuresPerFrame == None` and `featureSpillDirectory == None`. Otherwise the features are stored
+    by the feature serializer and `None` is returned in their place.
     '''
 
     # set up plugin manager
@@ -106,35 +120,28 @@ def computeRegionFeaturesOnCloud(frame,
     pluginManager = TrackingPluginManager(pluginPaths=pluginPaths, turnOffFeatures=turnOffFeatures, verbose=False)
     pluginManager.setImageProvider(imageProviderPluginName)
     pluginManager.setFeatureSerializer(featureSerializerPluginName)
+    pluginManager.getImageProvider().setFrameCache(frameCache)
+    pluginManager.numObjectFeatureThreads = numObjectFeatureThreads
 
     # load raw and label image (depending on chosen plugin this works via DVID or locally)
     rawImage = pluginManager.getImageProvider().getImageDataAtTimeFrame(
         rawImageFilename, rawImagePath, rawImageAxes, frame)
     labelImage = pluginManager.getImageProvider().getLabelImageForFrame(
-        labelImageFilename, labelImagePath, frame)
+        labelImageFilename, labelImagePath, frame, out=_labelImageBuffers.get(labelImageFilename))
+    if labelImage.flags.writeable:
+        _labelImageBuffers[labelImageFilename] = labelImage
 
     # untwist axes, if just x and y are messed up
     if rawImage.shape[0] == labelImage.shape[1] and rawImage.shape[1] == labelImage.shape[0]:
         labelImage = np.transpose(labelImage, axes=[1, 0])
 
-    # compute features
-    moreFeats, ignoreNames = pluginManager.applyObjectFeatureComputationPlugins(
-        len(labelImage.shape), rawImage, labelImage, frame, rawImageFilename)
-
-    # combine into one dictionary
+    # compute features, combined into one dictionary without the ignored features
     # WARNING: if there are multiple features with the same name, they will be overwritten!
-    frameFeatureItems = []
-    for f in moreFeats:
-        frameFeatureItems = frameFeatureItems + f.items()
-    frameFeatures = dict(frameFeatureItems)
-
-    # delete all ignored features
-    for k in ignoreNames:
-        if k in frameFeatures.keys():
-            del frameFeatures[k]
+    frameFeatures = pluginManager.computeObjectFeatures(
+        len(labelImage.shape), rawImage, labelImage, frame, rawImageFilename)
 
     # return or save features
-    if featuresPerFrame is None and featureSerializerPluginName is 'LocalFeatureSerializer':
+    if featuresPerFrame is None and featureSpillDirectory is None and featureSerializerPluginName is 'LocalFeatureSerializer':
         # simply return resulting dict
         return frame, frameFeatures
     else:
@@ -145,11 +152,13 @@ def computeRegionFeaturesOnCloud(frame,
         featureSerializer.server_address = labelImageFilename
         featureSerializer.uuid = labelImagePath
 
-        # feature dictionary used by local serializer
+        # feature dictionary or directory used by local serializer
         featureSerializer.features_per_frame = featuresPerFrame
+        featureSerializer.spill_directory = featureSpillDirectory
 
         # store
         featureSerializer.storeFeaturesForFrame(frameFeatures, frame)
+        return frame, None
 
 def computeDivisionFeaturesOnCloud(frameT,
                                    featuresAtT,
@@ -158,29 +167,44 @@ def computeDivisionFeaturesOnCloud(frameT,
                                    labelImageFilename,
                                    labelImagePath,
                                    numDimensions,
-                                   divisionFeatureNames):
+                                   divisionFeatureNames,
+                                   featureSerializer=None):
     '''
     Allow to compute division features using multiprocessing
 
     **Parameters**
 
     * `frameT`: the frame number
-    * `featuresAtT`: the feature dict of the current frame
-    * `featuresAtTPlus1`: feature dict of next frame
+    * `featuresAtT`: the feature dict of the current frame, or `None` to load it with the `featureSerializer`
+    * `featuresAtTPlus1`: feature dict of next frame, or `None` to load it with the `featureSerializer`
     * `imageProviderPlugin`: plugin for feature loading
     * `numDimensions`: number of dimensions of the dataset
     * `divisionFeatureNames`: list of feature names for the `hytra.divisionfeatures.FeatureManager`
+    * `featureSerializer`: feature serializer plugin that stored the region features, only needed if they
+      are not passed in directly
 
     **returns** a tuple of `frameT` and the dictionary of the newly computed division 
     features for `frameT`
     '''
 
-    # get the label image of the next frame
+    fm = hytra.core.divisionfeatures.FeatureManager(ndim=numDimensions)
+
+    if featuresAtT is None:
+        featuresAtT = featureSerializer.loadFeaturesForFrame(None, frameT)
+    if featuresAtTPlus1 is None:
+        featuresAtTPlus1 = featureSerializer.loadFeaturesForFrame(None, frameT + 1)
+
+    # get the label image of the next frame. If the templates around all objects only cover a small part of
+    # the frame, load just those regions instead of the whole image.
     if frameT + 1 < imageProviderPlugin.getTimeRange(labelImageFilename, labelImagePath):
-        labelImageAtTPlus1 = imageProviderPlugin.getLabelImageForFrame(labelImageFilename, labelImagePath, frameT + 1)
+        shape = [s for s in imageProviderPlugin.getImageShape(labelImageFilename, labelImagePath) if s != 1]
+        numObjects = len(featuresAtT[fm.com_name_cur])
+        if numObjects * fm.template_size ** len(shape) < np.prod(shape) / 2:
+            labelImageAtTPlus1 = LabelImageRegionReader(imageProviderPlugin, labelImageFilename, labelImagePath, frameT + 1)
+        else:
+            labelImageAtTPlus1 = imageProviderPlugin.getLabelImageForFrame(labelImageFilename, labelImagePath, frameT + 1)
 
     # compute features
-    fm = hytra.core.divisionfeatures.FeatureManager(ndim=numDimensions)
     feats = fm.computeFeatures_at(featuresAtT, featuresAtTPlus1, labelImageAtTPlus1, divisionFeatureNames, labelImageFilename)
 
     return frameT, feats
@@ -215,6 +239,49 @@ class DummyExecutor(object):
 
         return f
 
+class SerializedFeaturesPerFrame(object):
+    """
+    Read-only dictionary of frame -> features that loads the features of a frame on demand
+    with a feature serializer plugin, such that not all features need to be kept in memory.
+    The most recently used frames are kept, as e.g. `getTraxelFeatureDict` is called once per object.
+    """
+
+    numCachedFrames = 2
+    ''' number of recently loaded frames that are kept around '''
+
+    def __init__(self, featureSerializer, frames):
+        self._featureSerializer = featureSerializer
+        self._frames = list(frames)
+        self._cachedFrames = []
+
+    def __getitem__(self, frame):
+        if frame not in self._frames:
+            raise KeyError(frame)
+        for f, features in self._cachedFrames:
+            if f == frame:
+                return features
+        features = self._featureSerializer.loadFeaturesForFrame(None, frame)
+        self._cachedFrames = [(frame, features)] + self._cachedFrames[:self.numCachedFrames - 1]
+        return features
+
+    def __contains__(self, frame):
+        return frame in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __iter__(self):
+        return iter(self._frames)
+
+    def keys(self):
+        return list(self._frames)
+
+    def iteritems(self):
+        for frame in self._frames:
+            yield frame, self[frame]
+
+    items = iteritems
+
 class ProbabilityGenerator(object):
     """
     The ProbabilityGenerator contains a dictionary of all traxels. The traxels themself contain the 
@@ -247,6 +314,20 @@ class IlpProbabilityGenerator(ProbabilityGenerator):
         self._pluginManager.setImageProvider(ilpOptions.imageProviderName)
         self._pluginManager.setFeatureSerializer(ilpOptions.featureSerializerName)
 
+        # label image filename per segmentation hypothesis, as referenced by the 'hypothesis' feature
+        self._labelImageFilenames = [ilpOptions.labelImageFilename]
+
+        # store features on disk instead of in memory, one file per frame
+        self._featureSpillDirectory = ilpOptions.featureSpillDirectory
+        if self._featureSpillDirectory is not None and not os.path.exists(self._featureSpillDirectory):
+            os.makedirs(self._featureSpillDirectory)
+
+        # keep decoded frames around, as they are needed by several passes over the data
+        self._frameCache = None
+        if ilpOptions.frameCacheSize > 0 or ilpOptions.frameCacheScratchDirectory is not None:
+            self._frameCache = FrameCache(ilpOptions.frameCacheSize, ilpOptions.frameCacheScratchDirectory)
+            self._pluginManager.getImageProvider().setFrameCache(self._frameCache)
+
         self._countClassifier = None
         self._divisionClassifier = None
         self._transitionClassifier = None
@@ -284,51 +365,18 @@ class IlpProbabilityGenerator(ProbabilityGenerator):
             self._transitionClassifier = RandomForestClassifier(self._options.transitionClassifierPath,
                                                                 self._options.transitionClassifierFilename, self._options)
     
-    def __getstate__(self):
-        '''
-        We define __getstate__ and __setstate__ to exclude the random forests from being pickled,
-        as that is not allowed.
-
-        See https://docs.python.org/3/library/pickle.html#pickle-state for more details.
-        '''
-        # Copy the object's state from self.__dict__ which contains
-        # all our instance attributes. Always use the dict.copy()
-        # method to avoid modifying the original state.
-        state = self.__dict__.copy()
-        # Remove the unpicklable entries.
-        del state['_countClassifier']
-        del state['_divisionClassifier']
-        del state['_transitionClassifier']
-        return state
-
-    def __setstate__(self, state):
-        # Restore instance attributes
-        self.__dict__.update(state)
-        # Restore the random forests by reading them from scratch
-        self._loadClassifiers()
-
     def computeRegionFeatures(self, rawImage, labelImage, frameNumber):
         """
         Computes all region features for all objects in the given image
         """
         assert (labelImage.dtype == np.uint32)
 
-        moreFeats, ignoreNames = self._pluginManager.applyObjectFeatureComputationPlugins(len(labelImage.shape),
-                                                                                          rawImage,
-                                                                                          labelImage,
-                                                                                          frameNumber,
-                                                                                          self._options.rawImageFilename)
-        frameFeatureItems = []
-        for f in moreFeats:
-            frameFeatureItems = frameFeatureItems + f.items()
-        frameFeatures = dict(frameFeatureItems)
-
-        # delete the "Global<Min/Max>" features as they are not nice when iterating over everything
-        for k in ignoreNames:
-            if k in frameFeatures.keys():
-                del frameFeatures[k]
-
-        return frameFeatures
+        # without the "Global<Min/Max>" features as they are not nice when iterating over everything
+        return self._pluginManager.computeObjectFeatures(len(labelImage.shape),
+                                                         rawImage,
+                                                         labelImage,
+                                                         frameNumber,
+                                                         self._options.rawImageFilename)
 
     def computeDivisionFeatures(self, featuresAtT, featuresAtTPlus1, labelImageAtTPlus1):
         """
@@ -419,6 +467,9 @@ class IlpProbabilityGenerator(ProbabilityGenerator):
         If `dispyNodeIps` is an empty list, then the feature extraction will be parallelized via
         multiprocessing.
 
+        If `ilpOptions.featureSpillDirectory` is set, the features of every frame are written to disk by the
+        local feature serializer, and a `SerializedFeaturesPerFrame` that loads them on demand is returned.
+
         **TODO:** fix division feature computation for distributed mode
         """
         import logging
@@ -440,7 +491,14 @@ class IlpProbabilityGenerator(ProbabilityGenerator):
                 ExecutorType = DummyExecutor
                 logging.getLogger('Traxelstore').info('Running feature extraction on single core!')
 
+            # frames are processed in parallel already if we use multiprocessing, otherwise run the plugins in parallel
+            numObjectFeatureThreads = 1 if self._useMultiprocessing else multiprocessing.cpu_count()
+
             featuresPerFrame = {}
+            featureSerializer = None
+            if self._featureSpillDirectory is not None:
+                featureSerializer = self._pluginManager.getFeatureSerializer()
+                featureSerializer.spill_directory = self._featureSpillDirectory
             progressBar = ProgressBar(stop=numSteps)
             progressBar.show(increase=0)
 
@@ -456,32 +514,54 @@ class IlpProbabilityGenerator(ProbabilityGenerator):
                                                 self._options.labelImageFilename,
                                                 self._options.labelImagePath,
                                                 turnOffFeatures,
-                                                self._pluginPaths
+                                                self._pluginPaths,
+                                                frameCache=self._frameCache,
+                                                featureSpillDirectory=self._featureSpillDirectory,
+                                                numObjectFeatureThreads=numObjectFeatureThreads
                     ))
                 for job in concurrent.futures.as_completed(jobs):
                     progressBar.show()
                     frame, feats = job.result()
                     featuresPerFrame[frame] = feats
+                if featureSerializer is not None:
+                    # the features have been stored on disk, the jobs below load them when needed
+                    featuresPerFrame = SerializedFeaturesPerFrame(featureSerializer, range(self.timeRange[0], self.timeRange[1]))
 
                 # 2nd pass for division features
                 if self._divisionClassifier is not None:
                     jobs = []
                     for frame in range(self.timeRange[0], self.timeRange[1] - 1):
+                        if featureSerializer is None:
+                            featuresAtT, featuresAtTPlus1 = featuresPerFrame[frame], featuresPerFrame[frame + 1]
+                        else:
+                            featuresAtT, featuresAtTPlus1 = None, None
                         jobs.append(executor.submit(computeDivisionFeaturesOnCloud,
                                                     frame,
-                                                    featuresPerFrame[frame],
-                                                    featuresPerFrame[frame + 1],
+                                                    featuresAtT,
+                                                    featuresAtTPlus1,
                                                     self._pluginManager.getImageProvider(),
                                                     self._options.labelImageFilename,
                                                     self._options.labelImagePath,
                                                     self.getNumDimensions(),
-                                                    self._divisionFeatureNames
+                                                    self._divisionFeatureNames,
+                                                    featureSerializer=featureSerializer
                         ))
 
+                    divisionFeaturesPerFrame = {}
                     for job in concurrent.futures.as_completed(jobs):
                         progressBar.show()
                         frame, feats = job.result()
-                        featuresPerFrame[frame].update(feats)
+                        if featureSerializer is None:
+                            featuresPerFrame[frame].update(feats)
+                        else:
+                            # the region features on disk are still read by other jobs, so we add
+                            # the (much smaller) division features once all jobs are done
+                            divisionFeaturesPerFrame[frame] = feats
+
+                    for frame, feats in divisionFeaturesPerFrame.items():
+                        frameFeatures = dict(featureSerializer.loadFeaturesForFrame(None, frame))
+                        frameFeatures.update(feats)
+                        featureSerializer.storeFeaturesForFrame(frameFeatures, frame)
 
             # # serialize features??
             # for frame in range(self.timeRange[0], self.timeRange[1]):
@@ -598,6 +678,8 @@ class IlpProbabilityGenerator(ProbabilityGenerator):
                         traxel.idInSegmentation = val[objectId]
                     elif key == 'filename':
                         traxel.segmentationFilename = val[objectId]
+                    elif key == 'hypothesis':
+                        traxel.segmentationFilename = self._labelImageFilenames[val[objectId]]
                     else:
                         try:
                             if isinstance(val, list):  # polygon feature returns a list!
@@ -665,6 +747,27 @@ class IlpProbabilityGenerator(ProbabilityGenerator):
         features = np.expand_dims(features, axis=0)
         return features
 
+    def getObjectFeatureMatrices(self, frame, objectIds, selectedFeatures):
+        """
+        Getter method for the selected features of several objects of one frame at once
+
+        **returns** a dictionary of feature name -> array with one row per entry of `objectIds`
+        """
+        assert self._featuresPerFrame != None
+        objectIds = np.asarray(objectIds, dtype=np.int64)
+        frameFeatures = self._featuresPerFrame[frame]
+        return dict((key, np.asarray(frameFeatures[key])[objectIds, ...]) for key in selectedFeatures)
+
+    def getTransitionFeatureMatrix(self, featuresA, featuresB, selectedFeatures):
+        """
+        Batched version of `getTransitionFeatureVector`, where `featuresA` and `featuresB` hold the features
+        of N source and N target objects, e.g. from `getObjectFeatureMatrices`.
+
+        **returns** the feature vectors of all N transitions as N x F array
+        """
+        return self._pluginManager.applyTransitionFeatureMatrixConstructionPlugins(
+            featuresA, featuresB, selectedFeatures)
+
 
 if __name__ == '__main__':
     """
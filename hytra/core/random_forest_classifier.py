@@ -2,7 +2,12 @@ import vigra
 import numpy as np
 import h5py
 import os
+import time
+import shutil
+import hashlib
+import tempfile
 import logging
+import concurrent.futures
 from hytra.pluginsystem.plugin_manager import TrackingPluginManager
 from hytra.core.ilastik_project_options import IlastikProjectOptions
 
@@ -10,6 +15,44 @@ def getLogger():
     ''' logger to be used in this module '''
     return logging.getLogger(__name__)
 
+_deserializedForests = {}
+''' random forests per digest of their serialization, such that every process parses them at most once '''
+
+def _serializeRandomForests(randomForests):
+    '''
+    Write the given vigra random forests into a small HDF5 file (as `Forest0000`, `Forest0001`, ...)
+
+    **returns** the content of that file as byte string
+    '''
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, 'forests.h5')
+        for i, rf in enumerate(randomForests):
+            rf.writeHDF5(filename, pathInFile='/Forest{:04d}'.format(i))
+        with open(filename, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(tmpDir)
+
+def _deserializeRandomForests(data, digest):
+    '''
+    Load the random forests from a byte string created by `_serializeRandomForests`,
+    or reuse them if this process has loaded them before.
+    '''
+    if digest not in _deserializedForests:
+        tmpDir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpDir, 'forests.h5')
+            with open(filename, 'wb') as f:
+                f.write(data)
+            with h5py.File(filename, 'r') as h5file:
+                forestNames = sorted([key for key in h5file.keys() if 'Forest' in key])
+            _deserializedForests[digest] = [vigra.learning.RandomForest(str(filename), str('/' + k))
+                                            for k in forestNames]
+        finally:
+            shutil.rmtree(tmpDir)
+    return _deserializedForests[digest]
+
 class RandomForestClassifier:
     """
     A random forest (RF) classifier wraps a list of RFs as used in ilastik,
@@ -24,87 +67,176 @@ class RandomForestClassifier:
         self._options = ilpOptions
         self._classifierPath = classifierPath
         self._ilpFilename = ilpFilename
+        self._columnLayouts = {}
+        self._serializedForests = None
         if ilpFilename is not None and classifierPath is not None:
-            self._randomForests = self._readRandomForests()
-            self.selectedFeatures = self._readSelectedFeatures()
+            # read the forests and selected features from one open file handle
+            with h5py.File(self._ilpFilename, 'r') as h5file:
+                self._randomForests = self._readRandomForests(h5file)
+                self.selectedFeatures = self._readSelectedFeatures(h5file)
         else:
             self._randomForests = []
             self.selectedFeatures = selectedFeatures
 
-    def _readRandomForests(self):
+    def __getstate__(self):
+        '''
+        vigra's random forests cannot be pickled, so they are serialized once into a compact HDF5 blob
+        which is pickled instead. The forests are only restored when an unpickled classifier is used,
+        and at most once per process, so worker processes do not need to re-read the project file.
+        '''
+        state = self.__dict__.copy()
+        if self._randomForests is not None and len(self._randomForests) > 0 and self._serializedForests is None:
+            data = _serializeRandomForests(self._randomForests)
+            self._serializedForests = (data, hashlib.sha1(data).hexdigest())
+        state['_serializedForests'] = self._serializedForests
+        state['_randomForests'] = None if self._serializedForests is not None else []
+        state['_columnLayouts'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _getRandomForests(self):
+        ''' the list of vigra random forests, which are deserialized on first use after unpickling '''
+        if self._randomForests is None:
+            self._randomForests = _deserializeRandomForests(*self._serializedForests)
+        return self._randomForests
+
+    def _getForestsPath(self, classifierPath):
+        if classifierPath == '/':
+            return '/' + self._options.classifierForestsGroupName
+        else:
+            return '/'.join([classifierPath, self._options.classifierForestsGroupName])
+
+    def _readRandomForests(self, h5file):
         """
-        Read in a list of random forests at a given location in the hdf5 file
+        Read in a list of random forests at a given location in the open hdf5 file
         """
-        with h5py.File(self._ilpFilename, 'r') as h5file:
-            if self._classifierPath == '/':
-                fullPath = '/' + self._options.classifierForestsGroupName
-            else:
-                fullPath = '/'.join([self._classifierPath, self._options.classifierForestsGroupName])
-            randomForests = []
-            getLogger().info(" Attempting to read {} classifier(s) in {} from {}".format(
-                len([key for key in h5file[fullPath].keys() if 'Forest' in key]), self._ilpFilename, fullPath))
+        fullPath = self._getForestsPath(self._classifierPath)
+        forestNames = sorted([key for key in h5file[fullPath].keys() if 'Forest' in key])
+        getLogger().info(" Attempting to read {} classifier(s) in {} from {}".format(
+            len(forestNames), self._ilpFilename, fullPath))
 
-            for k in h5file[fullPath].keys():
-                if 'Forest' in k:
-                    getLogger().info(" Reading forest: {}".format( str('/'.join([fullPath, k])) ) )
-                    rf = vigra.learning.RandomForest(str(self._ilpFilename), str('/'.join([fullPath, k])))
-                    randomForests.append(rf)
-            return randomForests
+        randomForests = []
+        for k in forestNames:
+            forestPath = str('/'.join([fullPath, k]))
+            getLogger().info(" Reading forest: {}".format(forestPath))
+            try:
+                # let vigra read from the file that is already open
+                rf = vigra.learning.RandomForest(file_id=h5file.id.id, pathInFile=forestPath)
+            except (TypeError, RuntimeError):
+                # vigra versions without support for file ids, or linked against a different HDF5 library
+                rf = vigra.learning.RandomForest(str(self._ilpFilename), forestPath)
+            randomForests.append(rf)
+        return randomForests
 
-    def _readSelectedFeatures(self):
+    def _readSelectedFeatures(self, h5file):
         """
         Read which features were selected when training this RF
         """
-        with h5py.File(self._ilpFilename, 'r') as h5file:
-            if self._classifierPath == '/':
-                fullPath = '/' + self._options.selectedFeaturesGroupName
-            else:
-                fullPath = '/'.join([self._classifierPath, self._options.selectedFeaturesGroupName])
-            featureNameList = []
-
-            for feature_group_name in h5file[fullPath].keys():
-                feature_group = h5file[fullPath][feature_group_name]
-                for feature in feature_group.keys():
-                    # discard squared distances feature
-                    if feature == 'ChildrenRatio_SquaredDistances':
-                        continue
-                        
-                    # if feature == 'Coord<Principal<Kurtosis>>':
-                    #     feature = 'Coord<Principal<Kurtosis> >'
-                    # elif feature == 'Coord<Principal<Skewness>>':
-                    #     feature = 'Coord<Principal<Skewness> >'
-
-                    featureNameList.append(feature)
-            return featureNameList
+        if self._classifierPath == '/':
+            fullPath = '/' + self._options.selectedFeaturesGroupName
+        else:
+            fullPath = '/'.join([self._classifierPath, self._options.selectedFeaturesGroupName])
+        featureNameList = []
 
-    def extractFeatureVector(self, featureDict, singleObject=False):
+        for feature_group_name in h5file[fullPath].keys():
+            feature_group = h5file[fullPath][feature_group_name]
+            for feature in feature_group.keys():
+                # discard squared distances feature
+                if feature == 'ChildrenRatio_SquaredDistances':
+                    continue
+                    
+                # if feature == 'Coord<Principal<Kurtosis>>':
+                #     feature = 'Coord<Principal<Kurtosis> >'
+                # elif feature == 'Coord<Principal<Skewness>>':
+                #     feature = 'Coord<Principal<Skewness> >'
+
+                featureNameList.append(feature)
+        return featureNameList
+
+    def _getColumnLayout(self, featureDict, singleObject):
         """
-        Extract the vector(s) of required features from the given feature dictionary,
-        by concatenating the columns of the selected features into a matrix of new features, one row per object
+        Get the columns that each selected feature occupies in the extracted feature matrix,
+        as list of (feature name, column slice) pairs, together with the total number of columns.
+
+        The layout only depends on the shapes of the features of a single object, so it is computed once per
+        classifier and shape configuration.
         """
-        featureVectors = None
+        objectShapes = []
         for f in self.selectedFeatures:
             if f not in featureDict:
                 raise AssertionError("Feature '{}' not present in object features!".format(f))
-            vec = featureDict[f]
-            if len(vec.shape) == 1:
-                if singleObject:
-                    vec = np.expand_dims(vec, axis=0)
-                else:
-                    vec = np.expand_dims(vec, axis=1)
-            if featureVectors is None:
-                featureVectors = vec
-            else:
-                if len(vec.shape) == 3:
-                    for row in range(vec.shape[2]):
-                        featureVectors = np.hstack([featureVectors, vec[..., row]])
-                elif len(vec.shape) > 3:
+            shape = np.shape(featureDict[f])
+            objectShapes.append(tuple(shape) if singleObject else tuple(shape[1:]))
+
+        key = (singleObject, tuple(objectShapes))
+        if key not in self._columnLayouts:
+            layout = []
+            numColumns = 0
+            for f, shape in zip(self.selectedFeatures, objectShapes):
+                if len(shape) > 2:
                     raise ValueError("Cannot deal with features of more than two dimensions yet")
-                else:
-                    featureVectors = np.hstack([featureVectors, vec])
+                width = int(np.prod(shape))
+                layout.append((f, slice(numColumns, numColumns + width)))
+                numColumns += width
+            self._columnLayouts[key] = (layout, numColumns)
+        return self._columnLayouts[key]
+
+    def _flattenObjectFeatures(self, vec, numObjects):
+        """
+        Reshape a feature with one entry per object into one row per object. Features with two dimensions
+        per object are flattened column by column.
+        """
+        vec = np.asarray(vec)
+        if len(vec.shape) == 3:
+            vec = vec.transpose(0, 2, 1)
+        return vec.reshape(numObjects, -1)
+
+    def extractFeatureVector(self, featureDict, singleObject=False):
+        """
+        Extract the vector(s) of required features from the given feature dictionary,
+        by concatenating the columns of the selected features into a matrix of new features, one row per object.
+
+        If `singleObject=True`, the feature dictionary contains the features of just one object,
+        and a matrix with one row is returned.
+        """
+        if len(self.selectedFeatures) == 0:
+            return None
+
+        layout, numColumns = self._getColumnLayout(featureDict, singleObject)
+        numObjects = 1 if singleObject else len(featureDict[self.selectedFeatures[0]])
+        dtype = np.result_type(*[np.asarray(featureDict[f]).dtype for f in self.selectedFeatures])
+
+        featureVectors = np.empty((numObjects, numColumns), dtype=dtype)
+        for f, columns in layout:
+            vec = featureDict[f]
+            if singleObject:
+                vec = np.expand_dims(vec, axis=0)
+            featureVectors[:, columns] = self._flattenObjectFeatures(vec, numObjects)
 
         return featureVectors
 
+    def extractFeatureMatrix(self, featureDicts):
+        """
+        Extract the feature vectors of several objects at once, where `featureDicts` is a list
+        holding the feature dictionary of one object each (as used with `extractFeatureVector(..., singleObject=True)`).
+
+        **returns** a matrix with one row per object
+        """
+        if len(self.selectedFeatures) == 0 or len(featureDicts) == 0:
+            return None
+
+        layout, numColumns = self._getColumnLayout(featureDicts[0], True)
+        dtype = np.result_type(*[np.asarray(featureDicts[0][f]).dtype for f in self.selectedFeatures])
+
+        featureMatrix = np.empty((len(featureDicts), numColumns), dtype=dtype)
+        for f, columns in layout:
+            values = np.array([featureDict[f] for featureDict in featureDicts])
+            featureMatrix[:, columns] = self._flattenObjectFeatures(values, len(featureDicts))
+
+        return featureMatrix
+
     def predictProbabilities(self, features, featureDict=None):
         """
         Given a matrix of features, where each row represents one object and each column is a specific feature,
@@ -112,42 +244,71 @@ class RandomForestClassifier:
 
         If features=None but a featureDict is given, the selected features for this random forest are automatically extracted
         """
-        assert (len(self._randomForests) > 0)
+        randomForests = self._getRandomForests()
+        assert (len(randomForests) > 0)
 
         # make sure features are good
         if features is None and featureDict is not None:
             features = self.extractFeatureVector(featureDict)
         assert (len(features.shape) == 2)
-        # assert(features.shape[1] == self._randomForests[0].featureCount())
-        if not features.shape[1] == self._randomForests[0].featureCount():
+        # assert(features.shape[1] == randomForests[0].featureCount())
+        if not features.shape[1] == randomForests[0].featureCount():
             getLogger().error(
                 "Cannot predict from features of shape {} if {} features are expected".format(features.shape,
-                      self._randomForests[0].featureCount()))
+                      randomForests[0].featureCount()))
             print(features)
             raise AssertionError()
 
         # predict by summing the probabilities of all the given random forests (not in parallel - not optimized for speed)
-        probabilities = np.zeros((features.shape[0], self._randomForests[0].labelCount()))
-        for rf in self._randomForests:
+        probabilities = np.zeros((features.shape[0], randomForests[0].labelCount()))
+        for rf in randomForests:
             probabilities += rf.predictProbabilities(features.astype('float32'))
 
         return probabilities
 
-    def train(self, featureMatrix, labels):
+    def train(self, featureMatrix, labels, numForests=1, treeCount=255, randomSeed=None):
         """
-        Train the random forest given feature matrix and labels
+        Train the random forest given feature matrix and labels.
+
+        The `treeCount` trees are split into `numForests` forests, which are trained in parallel threads.
+        As `predictProbabilities` sums up the probabilities of all forests (like for ilastik classifiers),
+        the predicted probabilities of a classifier trained with `numForests > 1` sum up to `numForests`.
         """
         getLogger().info(
             "Training classifier from {} positive and {} negative labels".format(
                 np.count_nonzero(np.asarray(labels)), len(labels) - np.count_nonzero(np.asarray(labels))))
         getLogger().info("Training classifier from a feature vector of length {}".format(featureMatrix.shape))
 
-        self._randomForests = [vigra.learning.RandomForest()]
-        oob = self._randomForests[0].learnRF(
-            np.asarray(featureMatrix).astype("float32"),
-            (np.asarray(labels)).astype("uint32").reshape(-1, 1))
-        getLogger().info("RF trained with OOB Error {}".format(oob))
-    
+        numForests = max(1, min(numForests, treeCount))
+        treeCounts = [treeCount // numForests + (1 if i < treeCount % numForests else 0) for i in range(numForests)]
+
+        # every forest needs its own seed, vigra chooses a random one for seed 0
+        if randomSeed is None:
+            seeds = [0] * numForests
+        else:
+            seeds = [randomSeed + i for i in range(numForests)]
+
+        featureMatrix = np.asarray(featureMatrix).astype("float32")
+        labels = (np.asarray(labels)).astype("uint32").reshape(-1, 1)
+
+        def learnForest(forestTreeCount, seed):
+            rf = vigra.learning.RandomForest(treeCount=forestTreeCount)
+            oob = rf.learnRF(featureMatrix, labels, randomSeed=seed)
+            return rf, oob
+
+        t0 = time.time()
+        # vigra releases the GIL while learning, so the forests are trained in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=numForests) as executor:
+            jobs = [executor.submit(learnForest, c, seed) for c, seed in zip(treeCounts, seeds)]
+            results = [job.result() for job in jobs]
+
+        self._randomForests = [rf for rf, _ in results]
+        self._serializedForests = None
+        oob = sum(o * c for (_, o), c in zip(results, treeCounts)) / float(treeCount)
+        getLogger().info("RF with {} forests of {} trees trained in {} secs with OOB Error {}".format(
+            numForests, treeCount, time.time() - t0, oob))
+        return oob
+
     def save(self, outputFilename=None, classifierPath='/'):
         """
         Save the random forest to a HDF5 file into a specified path inside the HDF5 file.
@@ -162,11 +323,16 @@ class RandomForestClassifier:
         if classifierPath is None:
             classifierPath = self._classifierPath
 
-        if classifierPath == '/':
-            fullPath = '/' + os.path.join(self._options.classifierForestsGroupName, 'Forest0000') 
-        else:
-            fullPath = os.path.join(classifierPath, self._options.classifierForestsGroupName, 'Forest0000')
-        self._randomForests[0].writeHDF5(outputFilename, pathInFile=fullPath)
+        # remove the forests of an earlier training, which would otherwise be loaded as well
+        forestsPath = self._getForestsPath(classifierPath)
+        if os.path.exists(outputFilename):
+            with h5py.File(outputFilename, 'r+') as f:
+                if forestsPath in f:
+                    del f[forestsPath]
+
+        for i, rf in enumerate(self._getRandomForests()):
+            forestName = 'Forest{:0{width}d}'.format(i, width=self._options.randomForestZeroPaddingWidth)
+            rf.writeHDF5(outputFilename, pathInFile='/'.join([forestsPath, forestName]))
 
         if classifierPath == '/':
             selectedFeaturesPath = 'SelectedFeatures' 
@@ -0,0 +1,178 @@
+'''
+Provide methods to construct the training set of a transition classifier from a ground truth segmentation
+and the ground truth moves between consecutive frames.
+
+Object features are computed for all frames in parallel, positive examples are the ground truth moves
+(in both directions), and negative examples are the nearest neighbors in the next frame that are not
+a ground truth move. The transition feature vectors of all examples of a pair of frames are constructed at once.
+'''
+
+import logging
+import concurrent.futures
+import numpy as np
+from sklearn.neighbors import KDTree
+from hytra.util.progressbar import ProgressBar
+
+def getLogger():
+    ''' logger to be used in this module '''
+    return logging.getLogger(__name__)
+
+def computeFrameFeaturesInSeparateProcess(frame, ndims, rawImage, labelImage, rawFilename, pluginPaths):
+    '''
+    Compute the object features of one frame, including the features that plugins want to be omitted.
+    Creates its own plugin manager, such that it can run in a worker process.
+
+    **returns** a tuple of the frame and its feature dictionary
+    '''
+    from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+    pluginManager = TrackingPluginManager(pluginPaths=pluginPaths, verbose=False)
+    features = pluginManager.computeObjectFeatures(ndims, rawImage, labelImage, frame, rawFilename,
+                                                   removeOmittedFeatures=False)
+    return frame, features
+
+def computeFeatures(rawImage, labelImages, rawFilename, pluginPaths, useMultiprocessing=True):
+    '''
+    Compute the object features of all frames, one worker process per frame if `useMultiprocessing=True`.
+
+    **Parameters**
+
+    * `rawImage`: raw data with axes `xyztc`, where frame i of the time axis belongs to `labelImages[i]`
+    * `labelImages`: list of ground truth label images with axes `xyzc`
+    * `rawFilename`: filename of the raw data, passed on to the feature computation plugins
+    * `pluginPaths`: where all yapsy plugins are stored
+
+    **returns** a list of feature dictionaries, one per frame
+    '''
+    if useMultiprocessing:
+        ExecutorType = concurrent.futures.ProcessPoolExecutor
+    else:
+        from hytra.core.probabilitygenerator import DummyExecutor
+        ExecutorType = DummyExecutor
+
+    ndims = len(rawImage.squeeze().shape) - 1
+    featuresPerFrame = [None] * len(labelImages)
+    progressBar = ProgressBar(stop=len(labelImages))
+    progressBar.show(increase=0)
+
+    with ExecutorType() as executor:
+        jobs = [executor.submit(computeFrameFeaturesInSeparateProcess, i, ndims, rawImage[..., i, 0],
+                                labelImages[i][..., 0], rawFilename, pluginPaths)
+                for i in range(len(labelImages))]
+        for job in concurrent.futures.as_completed(jobs):
+            progressBar.show()
+            frame, features = job.result()
+            featuresPerFrame[frame] = features
+    return featuresPerFrame
+
+def getValidRegionCentersAndTheirIDs(featureDict,
+                                     countFeatureName='Count',
+                                     regionCenterName='RegionCenter'):
+    """
+    From the feature dictionary of a certain frame,
+    find all objects with pixel count > 0, and return their
+    region centers and ids.
+    """
+    validObjectMask = np.asarray(featureDict[countFeatureName]).reshape(-1) > 0
+    validObjectMask[0] = False
+
+    regionCenters = featureDict[regionCenterName][validObjectMask, :]
+    objectIds = np.where(validObjectMask)[0]
+    return regionCenters, objectIds
+
+def _pairKeys(pairs, numObjects):
+    ''' encode (N,2) pairs of object ids as one int64 per pair, such that they can be compared as sorted arrays '''
+    return pairs[:, 0] * numObjects + pairs[:, 1]
+
+def findNegativeExamples(features, positiveLabels, numNeighbors=3):
+    """
+    Compute negative labels by finding the `numNeighbors` nearest neighbors in the next frame, and
+    filtering out those pairings that are part of the positiveLabels.
+
+    **Returns** a list of arrays of pairs of indices, where there are as many arrays
+    as there are pairs of consecutive frames ordered by time,
+    e.g. for frame pairs (0,1), (1,2), ... (n-1,n).
+    Each row in such an array then contains an index into the earlier frame of the pair,
+    and one index into the later frame.
+    """
+    negativeLabels = []
+    for i in range(1, len(features)):
+        centersAtI, objectIdsAtI = getValidRegionCentersAndTheirIDs(features[i])
+        centersAtIMinusOne, objectIdsAtIMinusOne = getValidRegionCentersAndTheirIDs(features[i - 1])
+        k = min(numNeighbors, len(objectIdsAtI))
+        if k == 0 or len(objectIdsAtIMinusOne) == 0:
+            negativeLabels.append(np.zeros((0, 2), dtype=np.int64))
+            continue
+
+        # find the k nearest neighbors of each object of frame i-1 in frame i
+        kdt = KDTree(centersAtI, metric='euclidean')
+        neighbors = kdt.query(centersAtIMinusOne, k=k, return_distance=False)
+        candidates = np.column_stack([np.repeat(objectIdsAtIMinusOne, k), objectIdsAtI[neighbors.reshape(-1)]])
+
+        # discard the candidates that are positive annotations
+        positivePairs = np.asarray(positiveLabels[i - 1], dtype=np.int64).reshape(-1, 2)
+        numObjects = 1 + max(candidates.max(), positivePairs.max() if len(positivePairs) > 0 else 0)
+        positiveKeys = np.unique(_pairKeys(positivePairs, numObjects))
+        candidateKeys = _pairKeys(candidates, numObjects)
+        if len(positiveKeys) > 0:
+            isPositive = positiveKeys[np.minimum(np.searchsorted(positiveKeys, candidateKeys), len(positiveKeys) - 1)] == candidateKeys
+        else:
+            isPositive = np.zeros(len(candidateKeys), dtype=bool)
+        getLogger().debug("Frame {}: {} negative examples, discarding {} positive annotations".format(
+            i, np.count_nonzero(~isPositive), np.count_nonzero(isPositive)))
+        negativeLabels.append(candidates[~isPositive])
+
+    return negativeLabels
+
+def findFeaturesWithoutNaNs(features):
+    """
+    Find the features that have no NaNs or infs in any frame,
+    and are not one of the features that cannot be used for transition classification.
+
+    **returns** the sorted list of feature names
+    """
+    selectedFeatures = set(features[0].keys())
+    for featuresPerFrame in features:
+        for key, value in featuresPerFrame.items():
+            if key in selectedFeatures and not isinstance(value, list) \
+                    and (np.any(np.isnan(value)) or np.any(np.isinf(value))):
+                selectedFeatures.remove(key)
+    forbidden = ["Global<Maximum >", "Global<Minimum >", 'Histogram', 'Polygon', 'Defect Center',
+                 'Center', 'Input Center', 'Weighted<RegionCenter>']
+    return sorted(selectedFeatures.difference(forbidden))
+
+def _getObjectFeatureMatrices(featureDict, objectIds, selectedFeatures):
+    ''' the selected features of the given objects of one frame, one row per object '''
+    objectIds = np.asarray(objectIds, dtype=np.int64)
+    return dict((key, np.asarray(featureDict[key])[objectIds, ...]) for key in selectedFeatures)
+
+def constructTrainingSet(features, positiveLabels, negativeLabels, selectedFeatures, pluginManager):
+    """
+    Construct the transition feature vectors of all positive examples (in both directions)
+    and negative examples, per pair of consecutive frames in one batch.
+
+    **returns** a tuple of the N x F feature matrix and the N labels (1 for positive, 0 for negative examples)
+    """
+    featureMatrices = []
+    labels = []
+    for k in range(len(features) - 1):
+        positivePairs = np.asarray(positiveLabels[k], dtype=np.int64).reshape(-1, 2)
+        negativePairs = np.asarray(negativeLabels[k], dtype=np.int64).reshape(-1, 2)
+        getLogger().debug("Adding {} positive and {} negative samples of frames {} and {}".format(
+            len(positivePairs), len(negativePairs), k, k + 1))
+
+        featuresAtK = _getObjectFeatureMatrices(features[k], positivePairs[:, 0], selectedFeatures)
+        featuresAtKPlusOne = _getObjectFeatureMatrices(features[k + 1], positivePairs[:, 1], selectedFeatures)
+        featureMatrices.append(pluginManager.applyTransitionFeatureMatrixConstructionPlugins(
+            featuresAtK, featuresAtKPlusOne, selectedFeatures))
+        featureMatrices.append(pluginManager.applyTransitionFeatureMatrixConstructionPlugins(
+            featuresAtKPlusOne, featuresAtK, selectedFeatures))
+        featureMatrices.append(pluginManager.applyTransitionFeatureMatrixConstructionPlugins(
+            _getObjectFeatureMatrices(features[k], negativePairs[:, 0], selectedFeatures),
+            _getObjectFeatureMatrices(features[k + 1], negativePairs[:, 1], selectedFeatures),
+            selectedFeatures))
+        labels.extend([1] * (2 * len(positivePairs)) + [0] * len(negativePairs))
+
+    featureMatrices = [m for m in featureMatrices if m.shape[0] > 0]
+    if len(featureMatrices) == 0:
+        return np.zeros((0, 0)), np.zeros(0, dtype=np.uint32)
+    return np.vstack(featureMatrices), np.array(labels, dtype=np.uint32)
@@ -46,7 +46,7 @@ def trainDetectionClassifier(hypothesesGraph, gtFrameIdToGlobalIdsWithScoresMap,
     candidates.sort(key=lambda x: x.score)
 
     # pick the first and last numSamples/2, and extract their features?
-    # use RandomForestClassifier's method "extractFeatureVector"
+    # use RandomForestClassifier's method "extractFeatureMatrix"
     selectedSamples = candidates[0:numSamples//2] + candidates[-numSamples//2-1:-1]
     labels = np.hstack([np.zeros(numSamples//2), np.ones(numSamples//2)])
     getLogger().info("Using {} of {} available training examples".format(numSamples, len(candidates)))
@@ -57,7 +57,7 @@ def trainDetectionClassifier(hypothesesGraph, gtFrameIdToGlobalIdsWithScoresMap,
     node = selectedSamples[0].node
     if selectedFeatures is None:
         selectedFeatures = nodeTraxelMap[node].Features.keys()
-        forbidden = ['JaccardScores', 'id', 'filename', 'Polygon', 'detProb', 'divProb', 'com']
+        forbidden = ['JaccardScores', 'id', 'filename', 'hypothesis', 'Polygon', 'detProb', 'divProb', 'com']
         forbidden += [f for f in selectedFeatures if f.count('_') > 0]
         for f in forbidden:
             if f in selectedFeatures:
@@ -65,12 +65,7 @@ def trainDetectionClassifier(hypothesesGraph, gtFrameIdToGlobalIdsWithScoresMap,
         getLogger().info("No list of selected features was specified, using {}".format(selectedFeatures))
 
     rf = RandomForestClassifier(selectedFeatures=selectedFeatures)
-    features = rf.extractFeatureVector(nodeTraxelMap[node].Features, singleObject=True)
-    featureMatrix = np.zeros([len(selectedSamples), features.shape[1]])
-    featureMatrix[0, :] = features
-    for idx, candidate in enumerate(selectedSamples[1:]):
-        features = rf.extractFeatureVector(nodeTraxelMap[candidate.node].Features, singleObject=True)
-        featureMatrix[idx + 1, :] = features
+    featureMatrix = rf.extractFeatureMatrix([nodeTraxelMap[candidate.node].Features for candidate in selectedSamples])
 
     rf.train(featureMatrix, labels)
 
@@ -3,105 +3,159 @@ import logging
 import time
 import concurrent.futures
 
-from hytra.core.probabilitygenerator import IlpProbabilityGenerator, computeDivisionFeaturesOnCloud, computeRegionFeaturesOnCloud, DummyExecutor
+import hytra.core.divisionfeatures
+from hytra.core.probabilitygenerator import IlpProbabilityGenerator, computeRegionFeaturesOnCloud, DummyExecutor
 from hytra.util.progressbar import ProgressBar
 
 def getLogger():
     return logging.getLogger(__name__)
 
+def computeLabelOverlaps(labelImageA, labelImageB):
+    """
+    Find all pairs of objects that overlap in the two label images in a single pass over the pixels,
+    by combining the labels of every pixel that is foreground in both images into one 64 bit key.
+
+    **returns** a tuple of three arrays: the label in A, the label in B, and the number of overlapping pixels
+    of every overlapping pair, sorted by label in A and then label in B.
+    """
+    labelsA = labelImageA.ravel()
+    labelsB = labelImageB.ravel()
+    foreground = np.logical_and(labelsA != 0, labelsB != 0)
+    keys = (labelsA[foreground].astype(np.uint64) << np.uint64(32)) | labelsB[foreground].astype(np.uint64)
+    keys, counts = np.unique(keys, return_counts=True)
+    return (keys >> np.uint64(32)).astype(np.uint32), (keys & np.uint64(0xffffffff)).astype(np.uint32), counts
+
+def createGlobalIdLookup(hypothesisIndices, objectIds, numHypotheses):
+    """
+    Create the compact lookup of the globalIds of all objects of one frame, where `hypothesisIndices` and `objectIds`
+    specify the segmentation hypothesis and label of every globalId (= position in these arrays).
+
+    **returns** a tuple of an offset per hypothesis (plus the total size) and a dense table of globalIds,
+    where the globalId of object `i` in hypothesis `h` is found at `offsets[h] + i`, and missing objects are -1.
+    """
+    hypothesisIndices = np.asarray(hypothesisIndices, dtype=np.int64)
+    objectIds = np.asarray(objectIds, dtype=np.int64)
+    sizes = np.zeros(numHypotheses, dtype=np.int64)
+    np.maximum.at(sizes, hypothesisIndices, objectIds + 1)
+    offsets = np.zeros(numHypotheses + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes)
+    globalIds = -np.ones(offsets[-1], dtype=np.int64)
+    globalIds[offsets[hypothesisIndices] + objectIds] = np.arange(len(objectIds))
+    return offsets, globalIds
+
+def lookupGlobalIds(globalIdLookup, hypothesisIndex, objectIds):
+    """
+    **returns** the globalIds of the given objects of one segmentation hypothesis as list,
+    using a lookup created by `createGlobalIdLookup`
+    """
+    offsets, globalIds = globalIdLookup
+    return globalIds[offsets[hypothesisIndex] + np.asarray(objectIds, dtype=np.int64)].tolist()
+
 def findConflictingHypothesesInSeparateProcess(frame,
                                                labelImageFilenames,
                                                labelImagePaths,
-                                               labelImageFrameIdToGlobalId,
+                                               globalIdLookup,
                                                pluginPaths=['hytra/plugins'],
-                                               imageProviderPluginName='LocalImageLoader'):
+                                               imageProviderPluginName='LocalImageLoader',
+                                               frameCache=None):
     """
     Look which objects between different segmentation hypotheses (given as different labelImages)
-    overlap, and return a dictionary of those overlapping situations.
+    overlap, and return a dictionary of those overlapping situations, as well as a dictionary
+    of the number of overlapping pixels for every pair of overlapping globalIds (in both orders).
+    The `globalIdLookup` of this frame is created by `createGlobalIdLookup`.
 
-    Meant to be run in its own process using `concurrent.futures.ProcessPoolExecutor`
+    Meant to be run in its own process using `concurrent.futures.ProcessPoolExecutor`,
+    pass a `frameCache` to reuse the label images decoded during feature extraction.
     """
 
     # set up plugin manager
     from hytra.pluginsystem.plugin_manager import TrackingPluginManager
     pluginManager = TrackingPluginManager(pluginPaths=pluginPaths, verbose=False)
     pluginManager.setImageProvider(imageProviderPluginName)
+    pluginManager.getImageProvider().setFrameCache(frameCache)
 
     overlaps = {} # overlap dict: key=globalId, value=[list of globalIds]
+    overlapPixelCounts = {} # key=(globalIdA, globalIdB), value=number of overlapping pixels
 
-    for labelImageIndexA in range(len(labelImageFilenames)):
+    for labelImageIndexA in range(len(labelImageFilenames) - 1):
         labelImageA = pluginManager.getImageProvider().getLabelImageForFrame(labelImageFilenames[labelImageIndexA],
                                                                                     labelImagePaths[labelImageIndexA],
                                                                                     frame)
+        # every object of A gets an entry, even if it does not overlap with anything
+        objectIdsA = np.flatnonzero(np.bincount(labelImageA.ravel())[1:]) + 1
+        for globalIdA in lookupGlobalIds(globalIdLookup, labelImageIndexA, objectIdsA):
+            overlaps.setdefault(globalIdA, [])
+
         for labelImageIndexB in range(labelImageIndexA + 1, len(labelImageFilenames)):
             labelImageB = pluginManager.getImageProvider().getLabelImageForFrame(labelImageFilenames[labelImageIndexB],
                                                                                         labelImagePaths[labelImageIndexB],
                                                                                         frame)
             # check for overlaps - even a 1-pixel overlap is enough to be mutually exclusive!
-            for objectIdA in np.unique(labelImageA):
-                if objectIdA == 0:
-                    continue
-                overlapping = set(np.unique(labelImageB[labelImageA == objectIdA])) - set([0])
-                overlappingGlobalIds = [labelImageFrameIdToGlobalId[(labelImageFilenames[labelImageIndexB], frame, o)] for o in overlapping]
-                globalIdA = labelImageFrameIdToGlobalId[(labelImageFilenames[labelImageIndexA], frame, objectIdA)]
-                overlaps.setdefault(globalIdA, []).extend(overlappingGlobalIds)
-                for globalIdB in overlappingGlobalIds:
-                    overlaps.setdefault(globalIdB, []).append(globalIdA)
+            objectIdsA, objectIdsB, counts = computeLabelOverlaps(labelImageA, labelImageB)
+            for globalIdA, globalIdB, count in zip(lookupGlobalIds(globalIdLookup, labelImageIndexA, objectIdsA),
+                                                   lookupGlobalIds(globalIdLookup, labelImageIndexB, objectIdsB),
+                                                   counts):
+                overlaps[globalIdA].append(globalIdB)
+                overlaps.setdefault(globalIdB, []).append(globalIdA)
+                overlapPixelCounts[(globalIdA, globalIdB)] = int(count)
+                overlapPixelCounts[(globalIdB, globalIdA)] = int(count)
 
-    return frame, overlaps
+    return frame, overlaps, overlapPixelCounts
 
 def computeJaccardScoresOnCloud(frame,
                                 labelImageFilenames,
                                 labelImagePaths,
-                                labelImageFrameIdToGlobalId,
+                                globalIdLookup,
                                 groundTruthFilename,
                                 groundTruthPath,
                                 groundTruthMinJaccardScore,
                                 pluginPaths=['hytra/plugins'],
-                                imageProviderPluginName='LocalImageLoader'):
+                                imageProviderPluginName='LocalImageLoader',
+                                frameCache=None):
     """
     Compute jaccard scores of all objects in the different segmentations with the ground truth for that frame.
     Returns a dictionary of overlapping GT labels and the score per globalId in that frame, as well as 
     a dictionary specifying the matching globalId and score for every GT label (as a list ordered by score, best match last).
+    The `globalIdLookup` of this frame is created by `createGlobalIdLookup`.
 
-    Meant to be run in its own process using `concurrent.futures.ProcessPoolExecutor`
+    Meant to be run in its own process using `concurrent.futures.ProcessPoolExecutor`,
+    pass a `frameCache` to reuse the label images decoded during feature extraction.
     """
 
     # set up plugin manager
     from hytra.pluginsystem.plugin_manager import TrackingPluginManager
     pluginManager = TrackingPluginManager(pluginPaths=pluginPaths, verbose=False)
     pluginManager.setImageProvider(imageProviderPluginName)
+    pluginManager.getImageProvider().setFrameCache(frameCache)
 
     scores = {}
     gtToGlobalIdMap = {}
 
     groundTruthLabelImage = pluginManager.getImageProvider().getLabelImageForFrame(groundTruthFilename, groundTruthPath, frame)
+    gtPixelCounts = np.bincount(groundTruthLabelImage.ravel())
 
     for labelImageIndexA in range(len(labelImageFilenames)):
         labelImageA = pluginManager.getImageProvider().getLabelImageForFrame(labelImageFilenames[labelImageIndexA],
                                                                                     labelImagePaths[labelImageIndexA],
                                                                                     frame)
-        # check for overlaps - even a 1-pixel overlap is enough to be mutually exclusive!
-        for objectIdA in np.unique(labelImageA):
-            if objectIdA == 0:
-                continue
-            globalIdA = labelImageFrameIdToGlobalId[(labelImageFilenames[labelImageIndexA], frame, objectIdA)]
-            overlap = groundTruthLabelImage[labelImageA == objectIdA]
-            overlappingGtElements = set(np.unique(overlap)) - set([0])
-            
-            for gtLabel in overlappingGtElements:
-                # compute Jaccard scores
-                intersectingPixels = np.sum(overlap == gtLabel)
-                unionPixels = np.sum(np.logical_or(groundTruthLabelImage == gtLabel, labelImageA == objectIdA))
-                jaccardScore = float(intersectingPixels) / float(unionPixels) 
+        # the contingency table of all overlapping (object, GT label) pairs and the sizes of all labels
+        # are all we need to compute the jaccard scores: union = sizeA + sizeGT - intersection
+        objectPixelCounts = np.bincount(labelImageA.ravel())
+        objectIds, gtLabels, intersectingPixels = computeLabelOverlaps(labelImageA, groundTruthLabelImage)
+        unionPixels = objectPixelCounts[objectIds] + gtPixelCounts[gtLabels] - intersectingPixels
+        jaccardScores = intersectingPixels.astype(np.float64) / unionPixels
+
+        globalIds = lookupGlobalIds(globalIdLookup, labelImageIndexA, objectIds)
+        for globalIdA, gtLabel, jaccardScore in zip(globalIds, gtLabels, jaccardScores):
+            jaccardScore = float(jaccardScore)
 
-                # append to object's score list
-                scores.setdefault(globalIdA, []).append( (gtLabel, jaccardScore) )
+            # append to object's score list
+            scores.setdefault(globalIdA, []).append( (gtLabel, jaccardScore) )
 
-                # store this as GT mapping if there was no better object for this GT label yet
-                if jaccardScore > groundTruthMinJaccardScore and \
-                    ((frame, gtLabel) not in gtToGlobalIdMap or gtToGlobalIdMap[(frame, gtLabel)][-1][1] < jaccardScore):
-                    gtToGlobalIdMap.setdefault((frame, gtLabel), []).append((globalIdA, jaccardScore))
+            # store this as GT mapping if there was no better object for this GT label yet
+            if jaccardScore > groundTruthMinJaccardScore and \
+                ((frame, gtLabel) not in gtToGlobalIdMap or gtToGlobalIdMap[(frame, gtLabel)][-1][1] < jaccardScore):
+                gtToGlobalIdMap.setdefault((frame, gtLabel), []).append((globalIdA, jaccardScore))
 
     # sort all gt mappings by ascending jaccard score
     for _, v in gtToGlobalIdMap.iteritems():
@@ -110,6 +164,36 @@ def computeJaccardScoresOnCloud(frame,
     return frame, scores, gtToGlobalIdMap
 
 
+def computeDivisionFeaturesOfAllHypothesesOnCloud(frameT,
+                                                  featuresAtT,
+                                                  featuresAtTPlus1,
+                                                  numDimensions,
+                                                  divisionFeatureNames,
+                                                  overlapPixelCountsAtTPlus1=None):
+    '''
+    Compute the division features of all objects of all segmentation hypotheses in `frameT` at once,
+    where the child candidates are the objects of all hypotheses in the next frame whose centers are close.
+    Of the candidates that overlap, because they are the same cell in several hypotheses, only the closest one
+    is used. No label images are needed for that.
+
+    **Parameters**
+
+    * `frameT`: the frame number
+    * `featuresAtT`: the merged feature dict (of all hypotheses) of the current frame
+    * `featuresAtTPlus1`: the merged feature dict of the next frame
+    * `numDimensions`: number of dimensions of the dataset
+    * `divisionFeatureNames`: list of feature names for the `hytra.divisionfeatures.FeatureManager`
+    * `overlapPixelCountsAtTPlus1`: the overlap pixel counts per pair of globalIds of the next frame,
+      as found by `findConflictingHypothesesInSeparateProcess`
+
+    **returns** a tuple of `frameT` and the dictionary of the newly computed division
+    features for all objects in `frameT`
+    '''
+    fm = hytra.core.divisionfeatures.FeatureManager(ndim=numDimensions)
+    feats = fm.computeFeatures_at(featuresAtT, featuresAtTPlus1, None, divisionFeatureNames,
+                                  overlapping_next=overlapPixelCountsAtTPlus1)
+    return frameT, feats
+
 class ConflictingSegmentsProbabilityGenerator(IlpProbabilityGenerator):
     """
     Specialization of the probability generator that computes all the features on its own,
@@ -149,7 +233,11 @@ class ConflictingSegmentsProbabilityGenerator(IlpProbabilityGenerator):
         
         self._labelImageFilenames.insert(0, ilpOptions.labelImageFilename)
         self._labelImagePaths.insert(0, ilpOptions.labelImagePath)
-        self._labelImageFrameIdToGlobalId = {} # map from (labelImageFilename, frame, id) to (id)
+        self._globalIdLookupPerFrame = {} # compact map from (labelImageFilename, id) to globalId per frame, see `createGlobalIdLookup`
+
+        self.overlapPixelCountsPerFrame = {}
+        ''' number of overlapping pixels per frame and pair of conflicting globalIds, filled by `fillTraxels` '''
+        self._overlapsPerFrame = {} # list of overlapping globalIds per frame and globalId, see `_findOverlaps`
         
     def fillTraxels(self, usePgmlink=True, ts=None, fs=None, dispyNodeIps=[], turnOffFeatures=[]):
         """
@@ -167,12 +255,19 @@ class ConflictingSegmentsProbabilityGenerator(IlpProbabilityGenerator):
         assert(len(dispyNodeIps) == 0)
 
         super(ConflictingSegmentsProbabilityGenerator, self).fillTraxels(usePgmlink, ts, fs, dispyNodeIps, turnOffFeatures)
-        self._findOverlaps()
+
+        # the overlaps have been found during feature extraction, as they are needed for the division features
+        for frame, overlaps in self._overlapsPerFrame.iteritems():
+            for objectId, overlapIds in overlaps.iteritems():
+                if self.TraxelsPerFrame[frame][objectId].conflictingTraxelIds is None:
+                    self.TraxelsPerFrame[frame][objectId].conflictingTraxelIds = []
+                self.TraxelsPerFrame[frame][objectId].conflictingTraxelIds.extend(overlapIds)
 
     def _findOverlaps(self):
         """
         Check which objects are overlapping between the different segmentation hypotheses,
-        and store that information in every traxel.
+        and store the overlapping globalIds and the number of overlapping pixels per frame.
+        Needs the `self._globalIdLookupPerFrame`.
         """
         getLogger().info("Checking for overlapping segmentation hypotheses...")
         t0 = time.time()
@@ -196,16 +291,15 @@ class ConflictingSegmentsProbabilityGenerator(IlpProbabilityGenerator):
                                             frame,
                                             self._labelImageFilenames,
                                             self._labelImagePaths,
-                                            self._labelImageFrameIdToGlobalId,
-                                            self._pluginPaths
+                                            self._globalIdLookupPerFrame[frame],
+                                            self._pluginPaths,
+                                            frameCache=self._frameCache
                 ))
             for job in concurrent.futures.as_completed(jobs):
                 progressBar.show()
-                frame, overlaps = job.result()
-                for objectId, overlapIds in overlaps.iteritems():
-                    if self.TraxelsPerFrame[frame][objectId].conflictingTraxelIds is None:
-                        self.TraxelsPerFrame[frame][objectId].conflictingTraxelIds = []
-                    self.TraxelsPerFrame[frame][objectId].conflictingTraxelIds.extend(overlapIds)
+                frame, overlaps, overlapPixelCounts = job.result()
+                self.overlapPixelCountsPerFrame[frame] = overlapPixelCounts
+                self._overlapsPerFrame[frame] = overlaps
         
         t1 = time.time()
         getLogger().info("Finding overlaps took {} secs".format(t1 - t0))
@@ -255,11 +349,12 @@ class ConflictingSegmentsProbabilityGenerator(IlpProbabilityGenerator):
                                             frame,
                                             self._labelImageFilenames,
                                             self._labelImagePaths,
-                                            self._labelImageFrameIdToGlobalId,
+                                            self._globalIdLookupPerFrame[frame],
                                             groundTruthSegmentationFilename,
                                             groundTruthSegmentationPath,
                                             groundTruthMinJaccardScore,
-                                            self._pluginPaths
+                                            self._pluginPaths,
+                                            frameCache=self._frameCache
                 ))
             for job in concurrent.futures.as_completed(jobs):
                 progressBar.show()
@@ -382,63 +477,62 @@ class ConflictingSegmentsProbabilityGenerator(IlpProbabilityGenerator):
         return result
 
 
-    def _insertFilenameAndIdToFeatures(self, featureDict, filename):
+    def _insertHypothesisAndIdToFeatures(self, featureDict, hypothesisIndex):
         """
-        For later disambiguation, we store for each row in the feature matrix which file it came from.
-        We also store the label image id.  
+        For later disambiguation, we store for each row in the feature matrix which segmentation hypothesis
+        it came from, as index into `self._labelImageFilenames`. We also store the label image id.
         """
+        numElements = len(featureDict.values()[0])
+        dtype = np.min_scalar_type(len(self._labelImageFilenames) - 1)
+        featureDict['hypothesis'] = np.full(numElements, hypothesisIndex, dtype=dtype)
+        featureDict['id'] = np.arange(numElements, dtype=np.uint32)
 
-        # get num elements:
-        numElements = None
-
-        for _, v in featureDict.iteritems():
-            try:
-                currentNumElements = v.shape[0]
-            except:
-                currentNumElements = len(v)
-
-            if numElements is None:
-                numElements = currentNumElements
-            else:
-                assert(numElements == currentNumElements)
-
-        featureDict['filename'] = [filename] * numElements
-        featureDict['id'] = range(numElements)
-
-    def _mergeFrameFeatures(self, originalDict, nextDict):
+    def _mergeFrameFeatures(self, featureDicts):
         """
         Merge the feature vectors of every feature (key=featureName, value=list of feature values for each object)
-        The `originalDict` is altered to also contain the `nextDict`.
+        of all segmentation hypotheses of one frame into one dictionary, filling preallocated arrays.
 
-        Ignores the 0th element in each feature vector of nextDict
+        Ignores the 0th element in each feature vector of all but the first dict
         """
-        for k, v in nextDict.iteritems():
-            assert(k in originalDict) # all frames should have the same features
+        merged = {}
+        for k, v in featureDicts[0].iteritems():
+            parts = [v] + [d[k][1:] for d in featureDicts[1:]] # all frames should have the same features
             if isinstance(v, np.ndarray):
-                originalDict[k] = np.concatenate((originalDict[k], v[1:]))
+                parts = [np.asarray(p) for p in parts]
+                merged[k] = np.empty((sum(len(p) for p in parts),) + v.shape[1:],
+                                     dtype=np.result_type(*[p.dtype for p in parts]))
+                start = 0
+                for p in parts:
+                    merged[k][start:start + len(p)] = p
+                    start += len(p)
             else:
-                originalDict[k].extend(v[1:])
+                merged[k] = []
+                for p in parts:
+                    merged[k].extend(p)
+        return merged
 
     def _storeBackwardMapping(self, featuresPerFrame):
         """
-        populates the `self._labelImageFrameIdToGlobalId` dictionary
+        populates the `self._globalIdLookupPerFrame` dictionary, such that every job only needs the lookup
+        of the frame it works on
         """
         for frame, featureDict in featuresPerFrame.iteritems():
-            for newId, (filename, objectId) in enumerate(zip(featureDict['filename'], featureDict['id'])):
-                self._labelImageFrameIdToGlobalId[(filename, frame, objectId)] = newId
+            self._globalIdLookupPerFrame[frame] = createGlobalIdLookup(featureDict['hypothesis'],
+                                                                       featureDict['id'],
+                                                                       len(self._labelImageFilenames))
 
     def _extractAllFeatures(self, dispyNodeIps=[], turnOffFeatures=[]):
         """
         Extract the features of all frames of all segmentation hypotheses. 
         Feature extraction will be parallelized via multiprocessing.
+        The overlaps between the hypotheses are found before the division features are computed,
+        which need them to use each cell of the next frame only once.
 
         WARNING: distributed computation via Dispy is not supported here, so dispyNodeIps must be an empty list!
         """
 
         # configure progress bar
         numSteps = (self.timeRange[1] - self.timeRange[0]) * len(self._labelImageFilenames)
-        if self._divisionClassifier is not None:
-            numSteps *= 2
 
         t0 = time.time()
 
@@ -456,55 +550,58 @@ class ConflictingSegmentsProbabilityGenerator(IlpProbabilityGenerator):
 
         with ExecutorType() as executor:
             # 1st pass for region features, once per segmentation hypotheses
-            for filename, path in zip(self._labelImageFilenames, self._labelImagePaths):
-                jobs = []
+            jobs = {}
+            for hypothesisIndex, (filename, path) in enumerate(zip(self._labelImageFilenames, self._labelImagePaths)):
                 for frame in range(self.timeRange[0], self.timeRange[1]):
-                    jobs.append(executor.submit(computeRegionFeaturesOnCloud,
+                    jobs[executor.submit(computeRegionFeaturesOnCloud,
+                                         frame,
+                                         self._options.rawImageFilename, 
+                                         self._options.rawImagePath,
+                                         self._options.rawImageAxes,
+                                         filename,
+                                         path,
+                                         turnOffFeatures,
+                                         self._pluginPaths,
+                                         frameCache=self._frameCache
+                    )] = hypothesisIndex
+
+            # merge the features of a frame once all hypotheses are done, in the order of the hypotheses
+            featuresPerFrameAndHypothesis = {}
+            for job in concurrent.futures.as_completed(jobs):
+                progressBar.show()
+                frame, feats = job.result()
+                self._insertHypothesisAndIdToFeatures(feats, jobs[job])
+                featuresOfFrame = featuresPerFrameAndHypothesis.setdefault(frame, {})
+                featuresOfFrame[jobs[job]] = feats
+                if len(featuresOfFrame) == len(self._labelImageFilenames):
+                    del featuresPerFrameAndHypothesis[frame]
+                    featuresPerFrame[frame] = self._mergeFrameFeatures(
+                        [featuresOfFrame[i] for i in range(len(self._labelImageFilenames))])
+
+        self._storeBackwardMapping(featuresPerFrame)
+        self._findOverlaps()
+
+        # 2nd pass for division features, once per frame for all segmentation hypotheses,
+        # such that the child candidates of an object come from all hypotheses in the next frame
+        if self._divisionClassifier is not None:
+            progressBar = ProgressBar(stop=self.timeRange[1] - self.timeRange[0] - 1)
+            progressBar.show(increase=0)
+            with ExecutorType() as executor:
+                jobs = []
+                for frame in range(self.timeRange[0], self.timeRange[1] - 1):
+                    jobs.append(executor.submit(computeDivisionFeaturesOfAllHypothesesOnCloud,
                                                 frame,
-                                                self._options.rawImageFilename, 
-                                                self._options.rawImagePath,
-                                                self._options.rawImageAxes,
-                                                filename,
-                                                path,
-                                                turnOffFeatures,
-                                                self._pluginPaths
+                                                featuresPerFrame[frame],
+                                                featuresPerFrame[frame + 1],
+                                                self.getNumDimensions(),
+                                                self._divisionFeatureNames,
+                                                self.overlapPixelCountsPerFrame[frame + 1]
                     ))
+
                 for job in concurrent.futures.as_completed(jobs):
                     progressBar.show()
                     frame, feats = job.result()
-                    self._insertFilenameAndIdToFeatures(feats, filename)
-                    if frame not in featuresPerFrame:
-                        featuresPerFrame[frame] = feats
-                    else:
-                        self._mergeFrameFeatures(featuresPerFrame[frame], feats)
-
-            # 2nd pass for division features
-            # TODO: the division feature manager should also see the child candidates in all segmentation hypotheses
-            for filename, path in zip(self._labelImageFilenames, self._labelImagePaths):
-                if self._divisionClassifier is not None:
-                    jobs = []
-                    for frame in range(self.timeRange[0], self.timeRange[1] - 1):
-                        jobs.append(executor.submit(computeDivisionFeaturesOnCloud,
-                                                    frame,
-                                                    featuresPerFrame[frame],
-                                                    featuresPerFrame[frame + 1],
-                                                    self._pluginManager.getImageProvider(),
-                                                    filename,
-                                                    path,
-                                                    self.getNumDimensions(),
-                                                    self._divisionFeatureNames
-                        ))
-
-                    for job in concurrent.futures.as_completed(jobs):
-                        progressBar.show()
-                        frame, feats = job.result()
-                        # add division features to the dictionary for the first set, and then merge the new features in
-                        if feats.keys()[0] not in featuresPerFrame[frame]:
-                            featuresPerFrame[frame].update(feats)
-                        else:
-                            self._mergeFrameFeatures(featuresPerFrame[frame], feats)
-
-        self._storeBackwardMapping(featuresPerFrame)
+                    featuresPerFrame[frame].update(feats)
 
         t1 = time.time()
         getLogger().info("Feature computation took {} secs".format(t1 - t0))
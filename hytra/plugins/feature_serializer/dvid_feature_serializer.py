@@ -1,31 +1,95 @@
 from hytra.pluginsystem import feature_serializer_plugin
+from hytra.util.featureencoding import encodeFeatures, decodeFeatures, isEncodedFeatures
 import numpy as np
+import os
+import threading
+import concurrent.futures
 import json_tricks as json
 from libdvid import DVIDNodeService, DVIDServerService
 
 class DvidFeatureSerializer(feature_serializer_plugin.FeatureSerializerPlugin):
     """
-    serializes features to dvid
+    serializes features to dvid, using the binary encoding of `hytra.util.featureencoding`.
+    Features that were stored as JSON by older versions can still be loaded.
     """
 
     keyvalue_store = 'features'
-    
-    def storeFeaturesForFrame(self, features, timeframe):
+
+    compressFeatures = True
+    ''' whether to compress the encoded features before uploading them '''
+
+    numTransferThreads = 4
+    ''' number of frames that are transferred in parallel by `storeFeaturesForFrames` and `loadFeaturesForFrames` '''
+
+    def __init__(self):
+        super(DvidFeatureSerializer, self).__init__()
+        self._threadLocal = threading.local()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_threadLocal']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._threadLocal = threading.local()
+        self._pid = os.getpid()
+
+    def _getNodeService(self):
         """
-        Stores feature data
+        Get the node service of the current thread, which is only created once per server and uuid,
+        together with the keyvalue store
         """
         assert(self.server_address is not None)
         assert(self.uuid is not None)
-        node_service = DVIDNodeService(self.server_address, self.uuid)
-        node_service.create_keyvalue(self.keyvalue_store)
-        node_service.put(self.keyvalue_store, "frame-{}".format(timeframe), json.dumps(features))
+        if os.getpid() != self._pid:
+            self._threadLocal = threading.local()
+            self._pid = os.getpid()
+        key = (self.server_address, self.uuid)
+        if getattr(self._threadLocal, 'key', None) != key:
+            self._threadLocal.nodeService = DVIDNodeService(self.server_address, self.uuid)
+            self._threadLocal.nodeService.create_keyvalue(self.keyvalue_store)
+            self._threadLocal.key = key
+        return self._threadLocal.nodeService
+
+    def _getKey(self, timeframe):
+        return "frame-{}".format(timeframe)
+
+    def storeFeaturesForFrame(self, features, timeframe):
+        """
+        Stores feature data
+        """
+        self._getNodeService().put(self.keyvalue_store, self._getKey(timeframe),
+                                   encodeFeatures(features, self.compressFeatures))
 
     def loadFeaturesForFrame(self, features, timeframe):
         """
         loads feature data
         """
-        assert(self.server_address is not None)
-        assert(self.uuid is not None)
-        node_service = DVIDNodeService(self.server_address, self.uuid)
-        node_service.create_keyvalue(self.keyvalue_store)
-        return json.loads(node_service.get(self.keyvalue_store, "frame-{}".format(timeframe)))
\ No newline at end of file
+        data = self._getNodeService().get(self.keyvalue_store, self._getKey(timeframe))
+        if isEncodedFeatures(data):
+            return decodeFeatures(data)
+        return json.loads(data)
+
+    def storeFeaturesForFrames(self, featuresPerFrame):
+        """
+        Stores the feature data of several frames (dict of timeframe -> features), encoding and uploading
+        `numTransferThreads` frames in parallel
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.numTransferThreads) as executor:
+            jobs = [executor.submit(self.storeFeaturesForFrame, features, timeframe)
+                    for timeframe, features in featuresPerFrame.items()]
+            for job in jobs:
+                job.result()
+
+    def loadFeaturesForFrames(self, timeframes):
+        """
+        Loads the feature data of several frames, downloading and decoding `numTransferThreads` frames in parallel
+
+        **returns** a dictionary of timeframe -> features
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.numTransferThreads) as executor:
+            jobs = dict((timeframe, executor.submit(self.loadFeaturesForFrame, None, timeframe))
+                        for timeframe in timeframes)
+            return dict((timeframe, job.result()) for timeframe, job in jobs.items())
@@ -1,15 +1,25 @@
 from hytra.pluginsystem import feature_serializer_plugin
+from hytra.util.featureencoding import writeFeaturesToHdf5, readFeaturesFromHdf5
 import numpy as np
+import os
 
 class LoadFeatureSerializer(feature_serializer_plugin.FeatureSerializerPlugin):
     """
-    serializes features into local dict
+    serializes features into local dict, or, if a `spill_directory` is set, into one HDF5 file per frame
+    in that directory, which is memory-mapped again on loading. The latter allows to process movies
+    whose features do not fit into memory, and to store features from several processes at once.
     """
 
+    def _getFrameFilename(self, timeframe):
+        return os.path.join(self.spill_directory, 'features-{}.h5'.format(timeframe))
+
     def storeFeaturesForFrame(self, features, timeframe):
         """
         Stores feature data
         """
+        if self.spill_directory is not None:
+            writeFeaturesToHdf5(features, self._getFrameFilename(timeframe))
+            return
         assert(self.features_per_frame is not None)
         assert(isinstance(self.features_per_frame, dict))
         self.features_per_frame[timeframe] = features
@@ -18,6 +28,8 @@ class LoadFeatureSerializer(feature_serializer_plugin.FeatureSerializerPlugin):
         """
         loads feature data
         """
+        if self.spill_directory is not None:
+            return readFeaturesFromHdf5(self._getFrameFilename(timeframe))
         assert(self.features_per_frame is not None)
         assert(isinstance(self.features_per_frame, dict))
-        return self.features_per_frame[timeframe]
\ No newline at end of file
+        return self.features_per_frame[timeframe]
@@ -1,73 +1,268 @@
 from hytra.pluginsystem import image_provider_plugin
 import numpy as np
 import json_tricks as json
-from libdvid import DVIDNodeService, DVIDServerService
+import os
+import threading
+import concurrent.futures
+try:
+    import httplib
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
+
+_imageInfo = {}
+''' metadata per (server, dataset UUID), downloaded at most once per process '''
+
+_threadLocal = threading.local()
+''' the persistent connections of each thread to each server '''
+
+_executor = None
+''' thread pool of this process that fetches slabs and prefetches frames '''
+
+_prefetched = {}
+''' futures of the frames fetched in the background per (kind, server, dataset UUID, frame) '''
+
+_pid = os.getpid()
+
+def _resetProcessState():
+    ''' forget connections, threads and prefetched frames, which are not usable after forking '''
+    global _pid, _threadLocal, _executor, _prefetched
+    _pid = os.getpid()
+    _threadLocal = threading.local()
+    _executor = None
+    _prefetched = {}
+
+def _checkProcess():
+    if os.getpid() != _pid:
+        # we have been forked, threads and connections of the parent are not usable here
+        _resetProcessState()
 
 class DvidImageLoader(image_provider_plugin.ImageProviderPlugin):
     """
-    Computes the subtraction of features in the feature vector
+    Loads raw and label images of a dataset that was uploaded with `hytra/dvid/upload_dataset.py` from a DVID server,
+    where `Resource` is the server address and `PathInResource` the dataset UUID.
+
+    Talks to DVID's HTTP API directly, keeping one persistent connection per server and thread open,
+    and caches the dataset's `config/imageInfo` metadata. Large frames are fetched as several slabs in parallel.
+    Connections, metadata and prefetched frames are kept per process and not per loader, because the feature
+    computation jobs create a new plugin manager (and thus loader) for every frame.
     """
 
     shape = None
 
+    numFetchThreads = 4
+    ''' number of threads (and connections) used to fetch the slabs of a frame in parallel '''
+
+    minSlabBytes = 4 * 1024 * 1024
+    ''' frames are only split into parallel requests of at least this many bytes '''
+
+    prefetchNextFrame = False
+    '''
+    whether to fetch frame t+1 in the background when frame t is requested. Only enable this if the frames
+    are requested in order by one process, otherwise the prefetched frames are downloaded twice.
+    '''
+
+    def deactivate(self):
+        """
+        Stop the fetching threads of this process and close the connections of this thread
+        """
+        _checkProcess()
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+        for connection in getattr(_threadLocal, 'connections', {}).values():
+            connection.close()
+        _resetProcessState()
+
+    def _getExecutor(self):
+        global _executor
+        _checkProcess()
+        if _executor is None:
+            # one extra thread, such that a prefetch cannot block the slabs of the current frame
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.numFetchThreads + 1)
+        return _executor
+
+    def _getConnection(self, Resource):
+        """
+        Get the persistent connection of the current thread to the DVID server at `Resource`
+        """
+        _checkProcess()
+        if not hasattr(_threadLocal, 'connections'):
+            _threadLocal.connections = {}
+        connections = _threadLocal.connections
+        if Resource not in connections:
+            address = urlparse(Resource if '://' in Resource else 'http://' + Resource)
+            connections[Resource] = httplib.HTTPConnection(address.hostname, address.port or 80)
+        return connections[Resource]
+
+    def _request(self, Resource, endpoint):
+        """
+        GET the given endpoint of DVID's HTTP API, reconnecting once if the server closed the connection.
+
+        **returns** the response body
+        """
+        for attempt in range(2):
+            connection = self._getConnection(Resource)
+            try:
+                connection.request('GET', '/api/' + endpoint)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, IOError):
+                connection.close()
+                del _threadLocal.connections[Resource]
+                if attempt == 1:
+                    raise
+
+        if response.status != 200:
+            raise IOError("DVID request {} failed with status {}: {}".format(endpoint, response.status, data))
+        return data
+
+    def _getImageInfo(self, Resource, PathInResource):
+        """
+        Get the dataset's shape and time range, which are only downloaded once per dataset
+        """
+        key = (Resource, PathInResource)
+        if key not in _imageInfo:
+            data = self._request(Resource, 'node/{}/config/key/imageInfo'.format(PathInResource))
+            _imageInfo[key] = json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+        return _imageInfo[key]
+
     def _getRawImageName(self, timeframe):
         return "raw-"+str(timeframe)
 
-
     def _getSegmentationName(self, timeframe):
         return "seg-"+str(timeframe)
 
+    def _fetchSubvolume(self, Resource, PathInResource, dataName, dtype, size, offset):
+        """
+        Download one sub-volume of the given `size` at `offset` (in the order of the uploaded numpy arrays,
+        whereas the DVID API expects x-first order).
+        """
+        endpoint = 'node/{}/{}/raw/0_1_2/{}/{}'.format(PathInResource, dataName,
+                                                       '_'.join(str(s) for s in reversed(size)),
+                                                       '_'.join(str(o) for o in reversed(offset)))
+        data = self._request(Resource, endpoint)
+        return np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder('<')).reshape(size).astype(dtype)
 
-    def getImageDataAtTimeFrame(self, Resource, PathInResource, axes, timeframe):
+    def _fetchVolume(self, Resource, PathInResource, dataName, dtype, size, offset, parallel=True):
         """
-        Loads image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
-        Return numpy array of image data at timeframe.
+        Download a sub-volume, split into slabs along the first axis that are fetched in parallel if it is large
+        and `parallel=True`
+        """
+        numBytes = np.prod(size) * np.dtype(dtype).itemsize
+        numSlabs = int(min(self.numFetchThreads, size[0], max(1, numBytes // self.minSlabBytes)))
+        if numSlabs < 2 or not parallel:
+            return self._fetchSubvolume(Resource, PathInResource, dataName, dtype, size, offset)
+
+        volume = np.empty(size, dtype=dtype)
+        boundaries = np.linspace(0, size[0], numSlabs + 1).astype(int)
+
+        def fetchSlab(start, stop):
+            slabSize = (stop - start,) + tuple(size[1:])
+            slabOffset = (offset[0] + start,) + tuple(offset[1:])
+            volume[start:stop] = self._fetchSubvolume(Resource, PathInResource, dataName, dtype, slabSize, slabOffset)
+
+        jobs = [self._getExecutor().submit(fetchSlab, a, b) for a, b in zip(boundaries[:-1], boundaries[1:])]
+        for job in jobs:
+            # raise exceptions of the fetching threads
+            job.result()
+        return volume
+
+    def _fetchFrame(self, kind, Resource, PathInResource, timeframe, prefetch=True):
         """
-        node_service = DVIDNodeService(Resource, PathInResource)
+        Get a whole raw (`kind='raw'`) or label (`kind='label'`) frame, using the background prefetch if there was one.
+        Starts prefetching the next frame if `prefetch=True`.
+        """
+        def fetch(t, parallel=True):
+            shape = tuple(self._getImageInfo(Resource, PathInResource)['shape'])
+            if kind == 'raw':
+                return self._fetchVolume(Resource, PathInResource, self._getRawImageName(t), np.uint8,
+                                         shape, (0, 0, 0), parallel)
+            else:
+                return self._fetchVolume(Resource, PathInResource, self._getSegmentationName(t), np.uint64,
+                                         shape, (0, 0, 0), parallel).astype(np.uint32)
 
-        if (self.shape == None):
-            self.getImageShape(Resource, PathInResource)
+        _checkProcess()
+        key = (kind, Resource, PathInResource, timeframe)
+        if key in _prefetched:
+            frame = _prefetched.pop(key).result()
+        else:
+            frame = fetch(timeframe)
 
-        raw_frame = node_service.get_gray3D(self._getRawImageName(timeframe), tuple(self.shape), (0,0,0))
-        return raw_frame
+        if prefetch and self.prefetchNextFrame:
+            timeRange = self.getTimeRange(Resource, PathInResource)
+            nextKey = (kind, Resource, PathInResource, timeframe + 1)
+            # keep only the latest prefetch per kind around
+            for k in [k for k in _prefetched.keys() if k[0] == kind]:
+                if k != nextKey:
+                    del _prefetched[k]
+            if timeframe + 1 < timeRange[1] and nextKey not in _prefetched:
+                # the prefetch runs on the thread pool itself, so it must not wait for parallel slabs there
+                _prefetched[nextKey] = self._getExecutor().submit(fetch, timeframe + 1, False)
+        return frame
 
+    def getImageDataAtTimeFrame(self, Resource, PathInResource, axes, timeframe):
+        """
+        Loads the raw image of the given frame from DVID.
+        Return numpy array of image data at timeframe.
+        """
+        self.getImageShape(Resource, PathInResource)
+        return self._getCachedFrame(('raw', Resource, PathInResource, timeframe),
+                                    lambda: self._fetchFrame('raw', Resource, PathInResource, timeframe))
 
-    def getLabelImageForFrame(self, Resource, PathInResource, timeframe):
+    def getLabelImageForFrame(self, Resource, PathInResource, timeframe, out=None):
         """
-        Loads label image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
+        Loads the label image of the given frame from DVID.
         Return numpy array of image data at timeframe.
+        The preallocated `out` buffer is not supported and ignored.
         """
+        self.getImageShape(Resource, PathInResource)
+        return self._getCachedFrame(('label', Resource, PathInResource, timeframe),
+                                    lambda: self._fetchFrame('label', Resource, PathInResource, timeframe))
+
+    def _getSubvolume(self, Resource, PathInResource, roi):
+        '''
+        helper that converts a `roi` (tuple of slices) into the size and offset of a DVID sub-volume request
+        '''
+        shape = self.getImageShape(Resource, PathInResource)
 
-        if (self.shape == None):
-            self.getImageShape(Resource, PathInResource)
+        size = []
+        offset = []
+        for i, s in enumerate(shape):
+            start, stop, _ = (roi[i] if i < len(roi) else slice(None)).indices(s)
+            size.append(stop - start)
+            offset.append(start)
+        return tuple(size), tuple(offset)
 
-        node_service = DVIDNodeService(Resource, PathInResource)
-        seg_frame = np.array(node_service.get_labels3D(self._getSegmentationName(timeframe),
-                            tuple(self.shape), (0,0,0))).astype(np.uint32)
-        return seg_frame
+    def getImageDataRegion(self, Resource, PathInResource, axes, timeframe, roi):
+        """
+        Requests only the sub-volume `roi` (a tuple of slices) of the raw image from DVID
+        """
+        size, offset = self._getSubvolume(Resource, PathInResource, roi)
+        return self._fetchVolume(Resource, PathInResource, self._getRawImageName(timeframe), np.uint8, size, offset)
+
+    def getLabelImageRegion(self, Resource, PathInResource, timeframe, roi):
+        """
+        Requests only the sub-volume `roi` (a tuple of slices) of the label image from DVID
+        """
+        size, offset = self._getSubvolume(Resource, PathInResource, roi)
+        return self._fetchVolume(Resource, PathInResource, self._getSegmentationName(timeframe), np.uint64,
+                                 size, offset).astype(np.uint32)
 
     def getImageShape(self, Resource, PathInResource):
         """
-        Derive Image Shape from label image.
-        Loads label image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
+        Get the image shape from the dataset's metadata on the DVID server.
+        PathInResource is the dataset UUID
         Return list with image dimensions
         """
-
-        node_service = DVIDNodeService(Resource, PathInResource)
-        config = json.loads(node_service.get("config", "imageInfo"))
-        self.shape =  config["shape"]
+        self.shape = self._getImageInfo(Resource, PathInResource)["shape"]
         return self.shape
 
     def getTimeRange(self, Resource, PathInResource):
         """
-        Count Label images to derive the total number of frames
-        Loads label image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
+        Get the time range from the dataset's metadata on the DVID server.
+        PathInResource is the dataset UUID
         Return tuple of (first frame, last frame)
         """
-        node_service = DVIDNodeService(Resource, PathInResource)
-        config = json.loads(node_service.get("config", "imageInfo"))
-        return config["time_range"]
\ No newline at end of file
+        return self._getImageInfo(Resource, PathInResource)["time_range"]
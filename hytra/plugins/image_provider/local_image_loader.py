@@ -3,72 +3,224 @@ import hytra.util.axesconversion
 import numpy as np
 import h5py
 import logging
+import os
+from collections import OrderedDict
 
 class LocalImageLoader(image_provider_plugin.ImageProviderPlugin):
     """
-    Computes the subtraction of features in the feature vector
+    Loads raw and label images from local HDF5 files.
+
+    Keeps a small LRU pool of read-only file handles open, and caches the shape and time range per
+    file and path, because these are requested per frame (or even per object) by many scripts.
+    Decoded frames are kept in the plugin's frame cache, if one was set.
     """
 
     shape = None
 
+    maxNumOpenFiles = 16
+    ''' maximum number of HDF5 files that are kept open for reading '''
+
+    def __init__(self):
+        super(LocalImageLoader, self).__init__()
+        self._openFiles = OrderedDict()
+        self._pid = os.getpid()
+        self._shapeCache = {}
+        self._timeRangeCache = {}
+
+    def __getstate__(self):
+        '''
+        Open file handles cannot be pickled, so only the cached metadata is passed on.
+        '''
+        state = self.__dict__.copy()
+        state['_openFiles'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pid = os.getpid()
+
+    def deactivate(self):
+        """
+        Close all open files
+        """
+        self.closeFiles()
+
+    def closeFiles(self, Resource=None):
+        """
+        Close the open handle of the given `Resource`, or of all files if `Resource=None`
+        """
+        if Resource is None:
+            resources = list(self._openFiles.keys())
+        else:
+            resources = [Resource] if Resource in self._openFiles else []
+
+        for r in resources:
+            h5file = self._openFiles.pop(r)
+            if os.getpid() == self._pid:
+                h5file.close()
+
+    def _getFile(self, Resource):
+        """
+        Get a read-only handle of the HDF5 file `Resource` from the pool, opening it if needed.
+        """
+        if os.getpid() != self._pid:
+            # we have been forked, don't share the parent's HDF5 handles but reopen all files in this process
+            self._openFiles = OrderedDict()
+            self._pid = os.getpid()
+
+        if Resource in self._openFiles:
+            # mark as most recently used
+            h5file = self._openFiles.pop(Resource)
+        else:
+            logging.getLogger("LocalImageLoader").debug("opening {}".format(Resource))
+            h5file = h5py.File(Resource, 'r')
+            while len(self._openFiles) >= self.maxNumOpenFiles:
+                _, oldFile = self._openFiles.popitem(last=False)
+                oldFile.close()
+        self._openFiles[Resource] = h5file
+        return h5file
+
     def getImageDataAtTimeFrame(self, Resource, PathInResource, axes, timeframe):
         """
         Loads image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
+        PathInResource provides the internal image path
         Return numpy array of image data at timeframe.
         """
-        logging.getLogger("LocalImageLoader").debug("opening {}".format(Resource))
-        with h5py.File(Resource, 'r') as rawH5:
+        def loadFrame():
+            rawH5 = self._getFile(Resource)
             logging.getLogger("LocalImageLoader").debug("PathInResource {}".format(timeframe))
             rawImage = rawH5[PathInResource][hytra.util.axesconversion.getFrameSlicing(axes, timeframe)]
             remainingAxes = axes.replace('t', '')
-            rawImage = hytra.util.axesconversion.adjustOrder(rawImage, remainingAxes).squeeze()
-            return rawImage
+            return hytra.util.axesconversion.adjustOrder(rawImage, remainingAxes).squeeze()
 
-    def getLabelImageForFrame(self, Resource, PathInResource, timeframe):
+        return self._getCachedFrame(('raw', Resource, PathInResource, axes, timeframe), loadFrame)
+
+    def getLabelImageForFrame(self, Resource, PathInResource, timeframe, out=None):
         """
         Loads label image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
+        PathInResource provides the internal image path
         Return numpy array of image data at timeframe.
+
+        The frame is read directly into a `uint32` array, letting HDF5 convert the stored type on the fly,
+        which is `out` if it has the right shape and dtype (and no frame cache is used).
         """
+        def loadFrame(out=None):
+            shape = self.getImageShape(Resource, PathInResource)
+            h5file = self._getFile(Resource)
+            internalPath = PathInResource % (timeframe, timeframe + 1, shape[0], shape[1], shape[2])
+            logging.getLogger("LocalImageLoader").debug("Opening label image at {}".format(internalPath))
+            dataset = h5file[internalPath]
 
-        if (self.shape == None):
-            self.getImageShape(Resource, PathInResource)
+            # same result as dataset[0, ..., 0].squeeze().astype(np.uint32), but without intermediate copies
+            frameShape = tuple(s for s in dataset.shape[1:-1] if s != 1)
+            if out is None or out.shape != frameShape or out.dtype != np.uint32 or not out.flags.c_contiguous:
+                out = np.empty(frameShape, dtype=np.uint32)
+            dataset.read_direct(out.reshape(dataset.shape[1:-1]), np.s_[0, ..., 0])
+            return out
 
-        with h5py.File(Resource, 'r') as h5file:
-            internalPath = PathInResource % (timeframe, timeframe + 1, self.shape[0], self.shape[1], self.shape[2])
-            logging.getLogger("LocalImageLoader").debug("Opening label image at {}".format(internalPath))
-            labelImage = h5file[internalPath][0, ..., 0].squeeze().astype(np.uint32)
-            return labelImage
+        if self.frameCache is not None:
+            # cached frames must not share memory with buffers that the caller reuses
+            return self._getCachedFrame(('label', Resource, PathInResource, timeframe), loadFrame)
+        return loadFrame(out)
+
+    def getImageDataRegion(self, Resource, PathInResource, axes, timeframe, roi):
+        """
+        Loads only the region of interest `roi` (a tuple of slices along the spatial axes of the frame
+        returned by `getImageDataAtTimeFrame`) via an HDF5 hyperslab selection,
+        so that only the chunks intersecting the region are read and decompressed.
+        """
+        if self.frameCache is not None:
+            frame = self.frameCache.get(('raw', Resource, PathInResource, axes, timeframe))
+            if frame is not None:
+                return frame[tuple(roi)]
+
+        dataset = self._getFile(Resource)[PathInResource]
+
+        # the roi refers to the spatial axes that are not squeezed away, in xyz order
+        roiPerAxis = {}
+        roi = list(roi)
+        for a in 'xyz':
+            if a in axes and dataset.shape[axes.index(a)] != 1 and len(roi) > 0:
+                roiPerAxis[a] = roi.pop(0)
+
+        slicing = tuple(roiPerAxis.get(a, slice(None)) for a in axes)
+        slicing = slicing[:axes.index('t')] + (timeframe,) + slicing[axes.index('t') + 1:]
+        rawImage = dataset[slicing]
+        remainingAxes = axes.replace('t', '')
+        rawImage = hytra.util.axesconversion.adjustOrder(rawImage, remainingAxes)
+
+        # only squeeze the axes that are squeezed in the full frame, even if the roi is one pixel wide
+        singletonAxes = tuple(i for i, a in enumerate('txyzc') if a not in remainingAxes or dataset.shape[axes.index(a)] == 1)
+        return np.squeeze(rawImage, axis=singletonAxes)
+
+    def getLabelImageRegion(self, Resource, PathInResource, timeframe, roi):
+        """
+        Loads only the region of interest `roi` (a tuple of slices along the axes of the frame
+        returned by `getLabelImageForFrame`) of the label image via an HDF5 hyperslab selection,
+        so that only the chunks intersecting the region are read and decompressed.
+        """
+        if self.frameCache is not None:
+            frame = self.frameCache.get(('label', Resource, PathInResource, timeframe))
+            if frame is not None:
+                return frame[tuple(roi)]
+
+        shape = self.getImageShape(Resource, PathInResource)
+        internalPath = PathInResource % (timeframe, timeframe + 1, shape[0], shape[1], shape[2])
+        dataset = self._getFile(Resource)[internalPath]
+
+        # singleton axes are squeezed away in label frames, so the roi only refers to the others
+        roi = list(roi)
+        slicing = [0]
+        for s in dataset.shape[1:-1]:
+            if s == 1:
+                slicing.append(0)
+            else:
+                slicing.append(roi.pop(0) if len(roi) > 0 else slice(None))
+        slicing.append(0)
+        return dataset[tuple(slicing)].astype(np.uint32)
 
     def getImageShape(self, Resource, PathInResource):
         """
         Derive Image Shape from label image.
         Loads label image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
+        PathInResource provides the internal image path
         Return list with image dimensions
         """
-        with h5py.File(Resource, 'r') as h5file:
-            shape = h5file['/'.join(PathInResource.split('/')[:-1])].values()[0].shape[1:4]
-            self.shape = shape
-            return shape
+        key = (Resource, PathInResource)
+        if key not in self._shapeCache:
+            group = self._getFile(Resource)['/'.join(PathInResource.split('/')[:-1])]
+            firstKey = next(iter(group.keys()))
+            self._shapeCache[key] = group[firstKey].shape[1:4]
 
+        shape = self._shapeCache[key]
+        self.shape = shape
+        return shape
 
     def getTimeRange(self, Resource, PathInResource):
         """
         Count Label images to derive the total number of frames
         Loads label image data from local resource file in hdf5 format.
-        PathInResource provides the internal image path 
+        PathInResource provides the internal image path
         Return tuple of (first frame, last frame)
         """
-        with h5py.File(Resource, 'r') as h5file:
-            maxTime = len(h5file['/'.join(PathInResource.split('/')[:-1])].keys())
-            return (0,maxTime)
+        key = (Resource, PathInResource)
+        if key not in self._timeRangeCache:
+            maxTime = len(self._getFile(Resource)['/'.join(PathInResource.split('/')[:-1])])
+            self._timeRangeCache[key] = (0, maxTime)
+        return self._timeRangeCache[key]
 
     def exportLabelImage(self, labelimage, timeframe, Resource, PathInResource):
         """
         export labelimage of timeframe
         """
+        # the file cannot stay open read-only while we write to it, and its metadata changes
+        self.closeFiles(Resource)
+        for cache in [self._shapeCache, self._timeRangeCache]:
+            for key in [k for k in cache.keys() if k[0] == Resource]:
+                del cache[key]
+        if self.frameCache is not None:
+            self.frameCache.discard(('label', Resource, PathInResource, timeframe))
+
         with h5py.File(Resource, 'r+') as h5file:
             internalPath = PathInResource % (timeframe, timeframe + 1, self.shape[0], self.shape[1], self.shape[2])
             if(len(labelimage.shape) == 3):
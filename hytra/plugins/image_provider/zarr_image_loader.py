@@ -0,0 +1,224 @@
+from hytra.pluginsystem import image_provider_plugin
+import hytra.util.axesconversion
+import numpy as np
+import logging
+import concurrent.futures
+import zarr
+
+class ZarrImageLoader(image_provider_plugin.ImageProviderPlugin):
+    """
+    Loads raw and label images from chunked zarr or N5 directory stores (N5 if `Resource` ends with `.n5`).
+
+    Raw data is an array at `PathInResource` with arbitrary `axes`, like for the `LocalImageLoader`.
+    The label image is one array at `PathInResource` with axes `txyzc`, so the path must not contain
+    the frame placeholders of the ilastik-style HDF5 label images.
+
+    The chunks of a frame are decompressed in parallel by a pool of threads. As every chunk is a separate file,
+    many worker processes can read at the same time without locking. Decoded frames are kept in the plugin's
+    frame cache, if one was set.
+    """
+
+    shape = None
+
+    numDecompressionThreads = 4
+    ''' number of threads that decompress the chunks of one read in parallel '''
+
+    def __init__(self):
+        super(ZarrImageLoader, self).__init__()
+        self._arrays = {}
+
+    def _openStore(self, Resource):
+        if Resource.rstrip('/').endswith('.n5'):
+            return zarr.N5Store(Resource)
+        return zarr.DirectoryStore(Resource)
+
+    def _getArray(self, Resource, PathInResource):
+        """
+        Get the read-only zarr array at `PathInResource`, whose metadata is loaded only once
+        """
+        key = (Resource, PathInResource)
+        if key not in self._arrays:
+            logging.getLogger("ZarrImageLoader").debug("opening {} in {}".format(PathInResource, Resource))
+            self._arrays[key] = zarr.open_array(self._openStore(Resource), mode='r', path=PathInResource)
+        return self._arrays[key]
+
+    def _readSelection(self, array, selection, dtype=None, out=None):
+        """
+        Read the basic `selection` (tuple of ints and slices with step 1) of the zarr `array` into `out`,
+        which is allocated if not given. The selection is split at the chunk boundaries of its first sliced axis
+        that spans several chunks, and the pieces are decompressed by a thread pool.
+        """
+        def readInto(pieceSelection, outPiece):
+            if outPiece.dtype == array.dtype:
+                # zarr decompresses whole chunks directly into the output
+                array.get_basic_selection(pieceSelection, out=outPiece)
+            else:
+                outPiece[...] = array.get_basic_selection(pieceSelection)
+
+        selection = list(selection)
+        outShape = []
+        for axis, s in enumerate(selection):
+            if isinstance(s, slice):
+                start, stop, _ = s.indices(array.shape[axis])
+                selection[axis] = slice(start, stop)
+                outShape.append(stop - start)
+        if out is None:
+            out = np.empty(outShape, dtype=array.dtype if dtype is None else dtype)
+
+        # find the axis along which to split the selection
+        splitAxis = None
+        outAxis = 0
+        for axis, s in enumerate(selection):
+            if isinstance(s, slice):
+                if s.start // array.chunks[axis] != (s.stop - 1) // array.chunks[axis]:
+                    splitAxis = axis
+                    break
+                outAxis += 1
+
+        if splitAxis is None or self.numDecompressionThreads < 2:
+            readInto(tuple(selection), out)
+            return out
+
+        start, stop = selection[splitAxis].start, selection[splitAxis].stop
+        chunkSize = array.chunks[splitAxis]
+        boundaries = [start] + list(range((start // chunkSize + 1) * chunkSize, stop, chunkSize)) + [stop]
+
+        def readPiece(pieceStart, pieceStop):
+            pieceSelection = list(selection)
+            pieceSelection[splitAxis] = slice(pieceStart, pieceStop)
+            outSelection = [slice(None)] * outAxis + [slice(pieceStart - start, pieceStop - start)]
+            readInto(tuple(pieceSelection), out[tuple(outSelection)])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.numDecompressionThreads) as executor:
+            jobs = [executor.submit(readPiece, a, b) for a, b in zip(boundaries[:-1], boundaries[1:])]
+            for job in jobs:
+                # raise exceptions of the reading threads
+                job.result()
+        return out
+
+    def _getLabelSelection(self, array, timeframe, roi):
+        """
+        Selection of a label frame, where singleton axes are dropped and `roi` refers to the remaining ones
+        """
+        roi = list(roi)
+        selection = [timeframe]
+        for s in array.shape[1:-1]:
+            if s == 1:
+                selection.append(0)
+            else:
+                selection.append(roi.pop(0) if len(roi) > 0 else slice(None))
+        selection.append(0)
+        return selection
+
+    def getImageDataAtTimeFrame(self, Resource, PathInResource, axes, timeframe):
+        """
+        Loads image data from a zarr/N5 store.
+        PathInResource provides the path of the array inside the store
+        Return numpy array of image data at timeframe.
+        """
+        def loadFrame():
+            array = self._getArray(Resource, PathInResource)
+            rawImage = self._readSelection(array, hytra.util.axesconversion.getFrameSlicing(axes, timeframe))
+            remainingAxes = axes.replace('t', '')
+            return hytra.util.axesconversion.adjustOrder(rawImage, remainingAxes).squeeze()
+
+        return self._getCachedFrame(('raw', Resource, PathInResource, axes, timeframe), loadFrame)
+
+    def getImageDataRegion(self, Resource, PathInResource, axes, timeframe, roi):
+        """
+        Loads only the chunks intersecting the region of interest `roi` (a tuple of slices along the spatial axes
+        of the frame returned by `getImageDataAtTimeFrame`)
+        """
+        if self.frameCache is not None:
+            frame = self.frameCache.get(('raw', Resource, PathInResource, axes, timeframe))
+            if frame is not None:
+                return frame[tuple(roi)]
+
+        array = self._getArray(Resource, PathInResource)
+
+        # the roi refers to the spatial axes that are not squeezed away, in xyz order
+        roiPerAxis = {}
+        roi = list(roi)
+        for a in 'xyz':
+            if a in axes and array.shape[axes.index(a)] != 1 and len(roi) > 0:
+                roiPerAxis[a] = roi.pop(0)
+        selection = tuple(timeframe if a == 't' else roiPerAxis.get(a, slice(None)) for a in axes)
+
+        remainingAxes = axes.replace('t', '')
+        rawImage = hytra.util.axesconversion.adjustOrder(self._readSelection(array, selection), remainingAxes)
+        singletonAxes = tuple(i for i, a in enumerate('txyzc') if a not in remainingAxes or array.shape[axes.index(a)] == 1)
+        return np.squeeze(rawImage, axis=singletonAxes)
+
+    def getLabelImageForFrame(self, Resource, PathInResource, timeframe, out=None):
+        """
+        Loads the label image of one frame from a zarr/N5 store as `uint32` array,
+        decompressing directly into `out` if it has the right shape and dtype (and no frame cache is used).
+        """
+        def loadFrame(out=None):
+            array = self._getArray(Resource, PathInResource)
+            selection = self._getLabelSelection(array, timeframe, [])
+            frameShape = tuple(s for s in array.shape[1:-1] if s != 1)
+            if out is None or out.shape != frameShape or out.dtype != np.uint32:
+                out = np.empty(frameShape, dtype=np.uint32)
+            return self._readSelection(array, selection, out=out)
+
+        if self.frameCache is not None:
+            return self._getCachedFrame(('label', Resource, PathInResource, timeframe), loadFrame)
+        return loadFrame(out)
+
+    def getLabelImageRegion(self, Resource, PathInResource, timeframe, roi):
+        """
+        Loads only the chunks intersecting the region of interest `roi` of the label image
+        """
+        if self.frameCache is not None:
+            frame = self.frameCache.get(('label', Resource, PathInResource, timeframe))
+            if frame is not None:
+                return frame[tuple(roi)]
+
+        array = self._getArray(Resource, PathInResource)
+        return self._readSelection(array, self._getLabelSelection(array, timeframe, roi), dtype=np.uint32)
+
+    def getImageShape(self, Resource, PathInResource):
+        """
+        Derive Image Shape from the `txyzc` label image array.
+        Return list with image dimensions
+        """
+        self.shape = self._getArray(Resource, PathInResource).shape[1:4]
+        return self.shape
+
+    def getTimeRange(self, Resource, PathInResource):
+        """
+        Return tuple of (first frame, last frame) of the `txyzc` label image array
+        """
+        return (0, self._getArray(Resource, PathInResource).shape[0])
+
+    def exportLabelImage(self, labelimage, timeframe, Resource, PathInResource):
+        """
+        export labelimage of timeframe into the `txyzc` label image array at `PathInResource`,
+        which is created (with one chunk per frame along the time axis) or extended as needed.
+
+        Creating and extending the array rewrites its metadata, so frames must not be exported
+        from several processes at the same time.
+        """
+        store = self._openStore(Resource)
+        if len(labelimage.shape) == 3:
+            frame = labelimage[np.newaxis, :, :, :, np.newaxis]
+        elif len(labelimage.shape) == 2:
+            frame = labelimage[np.newaxis, :, :, np.newaxis, np.newaxis]
+        else:
+            raise NotImplementedError()
+
+        if zarr.storage.contains_array(store, PathInResource):
+            array = zarr.open_array(store, mode='r+', path=PathInResource)
+            if array.shape[0] <= timeframe:
+                array.resize((timeframe + 1,) + array.shape[1:])
+        else:
+            chunks = (1,) + tuple(min(s, 256) for s in frame.shape[1:])
+            array = zarr.open_array(store, mode='w', path=PathInResource, shape=(timeframe + 1,) + frame.shape[1:],
+                                    chunks=chunks, dtype='u2', fill_value=0)
+        array[timeframe:timeframe + 1] = frame
+
+        # the shape of the array might have changed
+        self._arrays.pop((Resource, PathInResource), None)
+        if self.frameCache is not None:
+            self.frameCache.discard(('label', Resource, PathInResource, timeframe))
@@ -1,24 +1,96 @@
 from hytra.pluginsystem import merger_resolver_plugin
 import numpy as np
+import logging
 
 from sklearn import mixture
 
 
+def getLogger():
+    ''' logger to be used in this module '''
+    return logging.getLogger(__name__)
+
+
 class GMMMergerResolver(merger_resolver_plugin.MergerResolverPlugin):
     """
-    Computes the subtraction of features in the feature vector
+    Resolves mergers by fitting a Gaussian Mixture Model with diagonal covariances to the pixel coordinates.
+
+    A fitted object is a tuple of `(weight, covariance, mean)`, where `covariance` is the diagonal of
+    the covariance matrix. These fits can be used to initialize the fit in the next frame (warm start),
+    and to relabel the image without fitting again.
     """
 
-    def initGMM(self, mergerCount, object_init_list):
-        gmm = mixture.GMM(n_components=mergerCount)
-        if len(object_init_list) > 0:
-            gmm.weights_ = np.array([o[0] for o in object_init_list])
-            gmm.covars_ = np.array([o[1] for o in object_init_list])
-            gmm.means_ = np.array([o[2] for o in object_init_list])
-        return gmm
+    # mergers with at most this many pixels are fitted together in one vectorized EM run
+    # by `resolveMergersForCoords`. By default (0) each merger is fitted with scikit-learn on its own
+    batchMaxNumPixels = 0
+
+    # upper bound for the number of (padded) pixels that are processed in one EM batch
+    batchMaxTotalNumPixels = 500000
+
+    maxIterations = 100
+    tolerance = 1e-3
+    regularization = 1e-6
+
+    def _selectInitializations(self, coordinates, mergerCount, initializations):
+        """
+        Select `mergerCount` of the given initializations whose means are closest to the center of the object,
+        and renormalize their weights.
+
+        **returns** a tuple of weights, covariances and means, or `None` if not enough initializations are given
+        """
+        if len(initializations) < mergerCount:
+            return None
+
+        means = np.array([o[2] for o in initializations], dtype=np.float64)
+        if means.ndim != 2 or means.shape[1] != coordinates.shape[1]:
+            return None
+
+        distances = np.linalg.norm(means - coordinates.mean(axis=0), axis=1)
+        selected = np.argsort(distances, kind='mergesort')[:mergerCount]
+        weights = np.array([initializations[i][0] for i in selected], dtype=np.float64)
+        covariances = np.array([initializations[i][1] for i in selected], dtype=np.float64)
+        covariances = np.maximum(covariances.reshape(mergerCount, -1), self.regularization)
+        weights = np.maximum(weights, np.finfo(np.float64).eps)
+        return weights / weights.sum(), covariances, means[selected]
+
+    def initGMM(self, mergerCount, object_init_list=[], coordinates=None):
+        """
+        Set up a `GaussianMixture` with `mergerCount` components, which is warm-started
+        from `object_init_list` if that contains enough fits of the preceding frame.
+        """
+        init = None
+        if coordinates is not None and len(object_init_list) > 0:
+            init = self._selectInitializations(coordinates, mergerCount, object_init_list)
+
+        if init is None:
+            return mixture.GaussianMixture(n_components=mergerCount,
+                                           covariance_type='diag',
+                                           reg_covar=self.regularization,
+                                           tol=self.tolerance,
+                                           max_iter=self.maxIterations)
+
+        weights, covariances, means = init
+        return mixture.GaussianMixture(n_components=mergerCount,
+                                       covariance_type='diag',
+                                       reg_covar=self.regularization,
+                                       tol=self.tolerance,
+                                       max_iter=self.maxIterations,
+                                       weights_init=weights,
+                                       means_init=means,
+                                       precisions_init=1.0 / covariances)
 
     def getObjectInitializationList(self, gmm):
-        return zip(gmm.weights_, gmm.covars_, gmm.means_)
+        return list(zip(gmm.weights_, gmm.covariances_, gmm.means_))
+
+    def _fallbackFits(self, coordinates, mergerCount):
+        """
+        Objects that have fewer pixels than components cannot be fitted,
+        so place one unit-variance component at every pixel (repeating pixels if needed).
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        means = coordinates[np.arange(mergerCount) % max(len(coordinates), 1)]
+        covariances = np.ones_like(means)
+        weights = np.ones(mergerCount) / mergerCount
+        return list(zip(weights, covariances, means))
 
     def resolveMergerForCoords(self, coordinates, mergerCount, initializations=[]):
         """
@@ -26,56 +98,207 @@ class GMMMergerResolver(merger_resolver_plugin.MergerResolverPlugin):
         new segments by fitting some kind of model. The `initializations` provide fits
         in the preceding frame of all possible incomings (list may be empty, but could
         also be more than `mergerCount`).
-  
+
         `coordinates` pixel coordinates that belong to a merger ID in labelImage
-        
+
         `mergerCount` number of gaussians to fit
-  
+
         **returns** a list of fitted objects
         """
-  
-        # fit GMM to label image data
-        gmm = self.initGMM(mergerCount, initializations)
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        if len(coordinates) < mergerCount:
+            getLogger().warning("Cannot fit {} components to {} pixels, using pixel positions".format(
+                mergerCount, len(coordinates)))
+            return self._fallbackFits(coordinates, mergerCount)
+
+        # fit GMM to label image data, warm-started from the fits of the predecessors
+        gmm = self.initGMM(mergerCount, initializations, coordinates)
         gmm.fit(coordinates)
-        assert(gmm.converged_)
-  
+
+        if not gmm.converged_:
+            # retry without warm start, but with several k-means initializations
+            getLogger().debug("GMM did not converge, retrying with k-means initialization")
+            retry = self.initGMM(mergerCount)
+            retry.set_params(n_init=3, max_iter=2 * self.maxIterations)
+            retry.fit(coordinates)
+            if retry.converged_ or retry.lower_bound_ > gmm.lower_bound_:
+                gmm = retry
+            if not gmm.converged_:
+                getLogger().warning("GMM with {} components did not converge, using best fit found".format(mergerCount))
+
         return self.getObjectInitializationList(gmm)
 
+    def resolveMergersForCoords(self, coordinatesList, mergerCounts, initializationsList):
+        """
+        Resolve a batch of independent mergers at once. Small mergers (at most `batchMaxNumPixels` pixels)
+        are fitted together in vectorized EM runs, all others are fitted individually.
+        Mergers for which the vectorized EM does not converge are fitted again individually.
+
+        **returns** a list containing the list of fitted objects per merger
+        """
+        fits = [None] * len(coordinatesList)
+        batch = []
+        for i, (coordinates, mergerCount) in enumerate(zip(coordinatesList, mergerCounts)):
+            if mergerCount <= len(coordinates) <= self.batchMaxNumPixels:
+                batch.append(i)
+            else:
+                fits[i] = self.resolveMergerForCoords(coordinates, mergerCount, initializationsList[i])
+
+        # sort by size such that little padding is needed, and split into chunks of limited memory footprint
+        batch.sort(key=lambda i: len(coordinatesList[i]))
+        while len(batch) > 0:
+            numPixels = len(coordinatesList[batch[-1]])
+            chunkSize = max(1, min(len(batch), self.batchMaxTotalNumPixels // max(numPixels, 1)))
+            chunk, batch = batch[-chunkSize:], batch[:-chunkSize]
+            chunkFits, chunkConverged = self._fitBatch([np.asarray(coordinatesList[i], dtype=np.float64) for i in chunk],
+                                                       [mergerCounts[i] for i in chunk],
+                                                       [initializationsList[i] for i in chunk])
+            for i, f, converged in zip(chunk, chunkFits, chunkConverged):
+                if converged:
+                    fits[i] = f
+                else:
+                    fits[i] = self.resolveMergerForCoords(coordinatesList[i], mergerCounts[i], initializationsList[i])
 
-    def resolveMerger(self, labelImage, objectId, nextId, mergerCount, initializations=[]):
+        return fits
+
+    def _fitBatch(self, coordinatesList, mergerCounts, initializationsList):
+        """
+        Run EM for diagonal GMMs on all given objects simultaneously, by padding pixels and components
+        to the maximum number in this batch and masking them out.
+        Objects without proper warm start are initialized by spreading the means along the main axis of the object.
+
+        **returns** a tuple of the list of fitted objects per merger, and a boolean array telling which fits converged
+        """
+        numObjects = len(coordinatesList)
+        numDims = coordinatesList[0].shape[1]
+        maxPixels = max(len(c) for c in coordinatesList)
+        maxComponents = max(mergerCounts)
+
+        X = np.zeros((numObjects, maxPixels, numDims))
+        pixelMask = np.zeros((numObjects, maxPixels), dtype=bool)
+        componentMask = np.zeros((numObjects, maxComponents), dtype=bool)
+        weights = np.zeros((numObjects, maxComponents))
+        means = np.zeros((numObjects, maxComponents, numDims))
+        covariances = np.ones((numObjects, maxComponents, numDims))
+
+        for b, (coordinates, mergerCount, initializations) in enumerate(zip(coordinatesList, mergerCounts, initializationsList)):
+            X[b, :len(coordinates)] = coordinates
+            pixelMask[b, :len(coordinates)] = True
+            componentMask[b, :mergerCount] = True
+
+            init = self._selectInitializations(coordinates, mergerCount, initializations)
+            if init is None:
+                center = coordinates.mean(axis=0)
+                variance = coordinates.var(axis=0) + self.regularization
+                mainAxis = np.argmax(variance)
+                order = np.argsort(coordinates[:, mainAxis], kind='mergesort')
+                picks = order[((np.arange(mergerCount) + 0.5) * len(coordinates) / mergerCount).astype(int)]
+                init = (np.ones(mergerCount) / mergerCount,
+                        np.tile(variance / mergerCount, (mergerCount, 1)),
+                        coordinates[picks] if mergerCount > 1 else center[np.newaxis, :])
+            weights[b, :mergerCount], covariances[b, :mergerCount], means[b, :mergerCount] = init
+
+        numPixels = pixelMask.sum(axis=1).astype(np.float64)
+        converged = np.zeros(numObjects, dtype=bool)
+        previousLogLikelihood = np.full(numObjects, -np.inf)
+
+        for _ in range(self.maxIterations):
+            # E-step: log of weighted gaussian densities, shape = (objects, pixels, components)
+            diff = X[:, :, np.newaxis, :] - means[:, np.newaxis, :, :]
+            logProb = -0.5 * (np.sum(diff ** 2 / covariances[:, np.newaxis, :, :], axis=3)
+                              + np.sum(np.log(2.0 * np.pi * covariances), axis=2)[:, np.newaxis, :])
+            with np.errstate(divide='ignore'):
+                logProb += np.log(weights)[:, np.newaxis, :]
+            logProb[~np.broadcast_to(componentMask[:, np.newaxis, :], logProb.shape)] = -np.inf
+            maxLogProb = logProb.max(axis=2, keepdims=True)
+            logNorm = maxLogProb + np.log(np.exp(logProb - maxLogProb).sum(axis=2, keepdims=True))
+            responsibilities = np.exp(logProb - logNorm) * pixelMask[:, :, np.newaxis]
+
+            logLikelihood = np.sum(logNorm[:, :, 0] * pixelMask, axis=1) / numPixels
+            active = ~converged
+            converged |= np.abs(logLikelihood - previousLogLikelihood) < self.tolerance
+            previousLogLikelihood = logLikelihood
+
+            # M-step, only updating the objects that had not converged yet
+            nk = responsibilities.sum(axis=1) + 10 * np.finfo(np.float64).eps
+            newMeans = np.einsum('bnk,bnd->bkd', responsibilities, X) / nk[:, :, np.newaxis]
+            newCovariances = np.einsum('bnk,bnd->bkd', responsibilities, X ** 2) / nk[:, :, np.newaxis] \
+                - newMeans ** 2 + self.regularization
+            newCovariances = np.maximum(newCovariances, self.regularization)
+            newWeights = nk / numPixels[:, np.newaxis] * componentMask
+
+            means[active] = newMeans[active]
+            covariances[active] = newCovariances[active]
+            weights[active] = newWeights[active]
+
+            if np.all(converged):
+                break
+
+        if not np.all(converged):
+            getLogger().debug("Batched GMM fit did not converge for {} of {} objects, fitting them individually".format(
+                np.count_nonzero(~converged), numObjects))
+
+        fits = [list(zip(weights[b, :k], covariances[b, :k], means[b, :k])) for b, k in enumerate(mergerCounts)]
+        return fits, converged
+
+    def resolveMerger(self, labelImage, objectId, nextId, mergerCount, initializations=[], boundingBox=None):
         """
         Resolve the object with the ID `objectId` in the `labelImage` into `mergerCount`
         new segments by fitting some kind of model. The `initializations` provide fits
         in the preceding frame of all possible incomings (list may be empty, but could
         also be more than `mergerCount`).
-  
+
         `labelImage` is used read-only, use `updateLabelImage` to refine the segmentation
-  
+
+        `boundingBox` (optional) tuple of slices that contains the object, so that not the full `labelImage` must be searched
+
         **returns** a list of fitted objects
         """
-  
-        # fit GMM to label image data
-        coordinates = np.transpose(np.vstack(np.where(labelImage == objectId)))
-        gmm = self.initGMM(mergerCount, initializations)
-        gmm.fit(coordinates)
-        assert(gmm.converged_)
-  
-        return self.getObjectInitializationList(gmm)
+        coordinates = self.getObjectCoordinates(labelImage, objectId, boundingBox)
+        return self.resolveMergerForCoords(coordinates, mergerCount, initializations)
+
+    def _predict(self, coordinates, fits):
+        """
+        Assign each pixel to the most likely fitted object, directly using the cached parameters of the fits.
+        Ties (e.g. identical fallback fits) are resolved in favor of the first fit, so some fits may not get any pixel.
+        """
+        weights = np.array([f[0] for f in fits], dtype=np.float64)
+        covariances = np.array([f[1] for f in fits], dtype=np.float64).reshape(len(fits), -1)
+        means = np.array([f[2] for f in fits], dtype=np.float64)
 
-    def updateLabelImage(self, labelImage, objectId, fits, newIds):
+        logProb = np.zeros((len(coordinates), len(fits)))
+        for k in range(len(fits)):
+            logProb[:, k] = -0.5 * (np.sum((coordinates - means[k]) ** 2 / covariances[k], axis=1)
+                                    + np.sum(np.log(2.0 * np.pi * covariances[k]))) + np.log(weights[k])
+        return np.argmax(logProb, axis=1)
+
+    def updateLabelImage(self, labelImage, objectId, fits, newIds, boundingBox=None):
         """
         Resolve the object with the ID `objectId` in the `labelImage` into the fitted models with the given new IDs.
         `labelImage` should be updated by replacing all pixels that were labelled with `objectId`
         to get a new Id depending on the fit.
+
+        `boundingBox` (optional) tuple of slices that contains the object, so that not the full `labelImage` must be searched
+
+        Fits that are not the most likely one for any pixel (e.g. for objects with fewer pixels than fits)
+        do not get any pixels, their IDs are then missing in the `labelImage`.
         """
-        
+
         if len(fits) > 1:
             assert(len(fits) == len(newIds))
-            # edit labelimage in-place
-            coordinates = np.transpose(np.vstack(np.where(labelImage == objectId)))
-            gmm = self.initGMM(len(fits), fits)
-            responsibilities = gmm.predict(coordinates)
-            assert(len(np.unique(responsibilities)) == len(fits))
+            if boundingBox is None:
+                boundingBox = tuple(slice(0, s) for s in labelImage.shape)
+
+            # edit labelimage in-place, the crop is a view into the labelimage
+            crop = labelImage[boundingBox]
+            mask = crop == objectId
+            offset = np.array([s.start for s in boundingBox])
+            coordinates = np.transpose(np.vstack(np.nonzero(mask))) + offset
+            responsibilities = self._predict(coordinates, fits)
+            numEmptyFits = len(fits) - len(np.unique(responsibilities))
+            if numEmptyFits > 0:
+                getLogger().debug("{} of {} fits of object {} did not get any pixels".format(
+                    numEmptyFits, len(fits), objectId))
             newIds = np.array(newIds)
             newObjectIds = newIds[responsibilities]
-            labelImage[labelImage == objectId] = newObjectIds
\ No newline at end of file
+            crop[mask] = newObjectIds
@@ -1,4 +1,5 @@
 from hytra.pluginsystem import object_feature_computation_plugin
+from hytra.pluginsystem.object_feature_computation_plugin import ObjectFeaturePrerequisites
 import vigra
 from vigra import numpy as np
 
@@ -8,10 +9,16 @@ class ConvexHullObjectFeatures(object_feature_computation_plugin.ObjectFeatureCo
     """
     worksForDimensions = [2]
     omittedFeatures = ['Polygon']
+    acceptedLabelImageDtypes = ['uint32']
+    prerequisites = ['labelImage']
+    threadSafe = True
 
     def computeFeatures(self, rawImage, labelImage, frameNumber, rawFilename):
-        featureDict =  vigra.analysis.extractConvexHullFeatures(labelImage.squeeze().astype(np.uint32),
-                                                                ignoreLabel=0)
+        return self.computeFeaturesWithPrerequisites(rawImage, labelImage, frameNumber, rawFilename,
+                                                     ObjectFeaturePrerequisites(rawImage, labelImage).forPlugin(self))
+
+    def computeFeaturesWithPrerequisites(self, rawImage, labelImage, frameNumber, rawFilename, prerequisites):
+        featureDict =  vigra.analysis.extractConvexHullFeatures(prerequisites['labelImage'], ignoreLabel=0)
         if 'Center' in featureDict:
             # old vigra versions simply call that feature "Center" which conflicts with other features 
             featureDict['Hull Center'] = featureDict['Center']
@@ -1,4 +1,5 @@
 from hytra.pluginsystem import object_feature_computation_plugin
+from hytra.pluginsystem.object_feature_computation_plugin import ObjectFeaturePrerequisites
 import vigra
 from vigra import numpy as np
 
@@ -8,9 +9,16 @@ class SkeletonObjectFeatures(object_feature_computation_plugin.ObjectFeatureComp
     """
     worksForDimensions = [2]
     omittedFeatures = ['Polygon']
+    acceptedLabelImageDtypes = ['uint32']
+    prerequisites = ['labelImage']
+    threadSafe = True
 
     def computeFeatures(self, rawImage, labelImage, frameNumber, rawFilename):
-        featureDict = vigra.analysis.extractSkeletonFeatures(labelImage.squeeze().astype(np.uint32))
+        return self.computeFeaturesWithPrerequisites(rawImage, labelImage, frameNumber, rawFilename,
+                                                     ObjectFeaturePrerequisites(rawImage, labelImage).forPlugin(self))
+
+    def computeFeaturesWithPrerequisites(self, rawImage, labelImage, frameNumber, rawFilename, prerequisites):
+        featureDict = vigra.analysis.extractSkeletonFeatures(prerequisites['labelImage'])
         if 'Center' in featureDict:
             # old vigra versions simply call that feature "Center" which conflicts with other features 
             featureDict['Skeleton Center'] = featureDict['Center']
@@ -1,4 +1,5 @@
 from hytra.pluginsystem import object_feature_computation_plugin
+from hytra.pluginsystem.object_feature_computation_plugin import ObjectFeaturePrerequisites
 import vigra
 from vigra import numpy as np
 
@@ -8,9 +9,18 @@ class StandardObjectFeatures(object_feature_computation_plugin.ObjectFeatureComp
     """
     worksForDimensions = [2, 3]
     omittedFeatures = ["Global<Maximum >", "Global<Minimum >", 'Histogram', 'Weighted<RegionCenter>']
+    acceptedRawImageDtypes = ['float32']
+    acceptedLabelImageDtypes = ['uint32']
+    prerequisites = ['rawImage', 'labelImage']
+    threadSafe = True
 
     def computeFeatures(self, rawImage, labelImage, frameNumber, rawFilename):
-        return vigra.analysis.extractRegionFeatures(rawImage.squeeze().astype('float32'),
-                                                    labelImage.squeeze().astype('uint32'),
+        return self.computeFeaturesWithPrerequisites(rawImage, labelImage, frameNumber, rawFilename,
+                                                     ObjectFeaturePrerequisites(rawImage, labelImage).forPlugin(self))
+
+    def computeFeaturesWithPrerequisites(self, rawImage, labelImage, frameNumber, rawFilename, prerequisites):
+        # squeezed and cast only once per frame for all plugins
+        return vigra.analysis.extractRegionFeatures(prerequisites['rawImage'],
+                                                    prerequisites['labelImage'],
                                                     ignoreLabel=0)
 
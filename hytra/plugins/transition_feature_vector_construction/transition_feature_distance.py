@@ -14,6 +14,16 @@ class TransitionFeaturesDistance(transition_feature_vector_construction_plugin.T
                     np.linalg.norm(featureDictObjectA[key] * featureDictObjectB[key])]
         return []
 
+    def constructFeatureMatrix(self, featuresA, featuresB, selectedFeatures):
+        key = 'RegionCenter'
+        if key in selectedFeatures:
+            centersA = np.asarray(featuresA[key])
+            centersB = np.asarray(featuresB[key])
+            return np.column_stack([np.linalg.norm(centersA - centersB, axis=1),
+                                    np.linalg.norm(centersA * centersB, axis=1)]).astype('float64')
+        numTransitions = transition_feature_vector_construction_plugin.getNumTransitions(featuresA, selectedFeatures)
+        return np.zeros((numTransitions, 0))
+
     def getFeatureNames(self, featureDictObjectA, featureDictObjectB, selectedFeatures):
         key = 'RegionCenter'
         if key in selectedFeatures:
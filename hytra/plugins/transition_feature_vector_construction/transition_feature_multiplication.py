@@ -31,6 +31,38 @@ class TransitionFeaturesMultiplication(transition_feature_vector_construction_pl
 
         return features
 
+    def constructFeatureMatrix(self, featuresA, featuresB, selectedFeatures):
+        assert ("Global<Maximum >" not in selectedFeatures)
+        assert ("Global<Minimum >" not in selectedFeatures)
+        assert ("Histrogram" not in selectedFeatures)
+        assert ("Polygon" not in selectedFeatures)
+
+        numTransitions = transition_feature_vector_construction_plugin.getNumTransitions(featuresA, selectedFeatures)
+        columns = []
+
+        for key in selectedFeatures:
+            if key == 'RegionCenter':
+                continue
+            else:
+                valuesA = np.asarray(featuresA[key])
+                valuesB = np.asarray(featuresB[key])
+                objectSize = int(np.prod(valuesA.shape[1:]))
+                if objectSize == 1:
+                    # scalar per object, combined in double precision like in constructFeatureVector
+                    columns.append(valuesA.reshape(numTransitions, 1).astype('float64') \
+                                   * valuesB.reshape(numTransitions, 1).astype('float64'))
+                else:
+                    columns.append((valuesA.astype('float32') * valuesB.astype('float32')).reshape(numTransitions, objectSize))
+
+        if len(columns) == 0:
+            return np.zeros((numTransitions, 0))
+        features = np.hstack(columns).astype('float64')
+
+        # there should be no nans or infs
+        assert (np.all(np.isfinite(features)))
+
+        return features
+
     def getFeatureNames(self, featureDictObjectA, featureDictObjectB, selectedFeatures):
         assert ("Global<Maximum >" not in selectedFeatures)
         assert ("Global<Minimum >" not in selectedFeatures)
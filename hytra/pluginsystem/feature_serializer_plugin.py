@@ -15,6 +15,10 @@ class FeatureSerializerPlugin(IPlugin):
     features_per_frame = None
     ''' dictionary of features per frame (only used by local serializer plugin) '''
 
+    spill_directory = None
+    ''' directory where features are stored as one HDF5 file per frame instead of `features_per_frame`
+    (only used by local serializer plugin) '''
+
     def activate(self):
         """
         Activation of plugin could do something, but not needed here
@@ -39,4 +43,21 @@ class FeatureSerializerPlugin(IPlugin):
         loads feature data
         """
         raise NotImplementedError()
-        return []
\ No newline at end of file
+        return []
+
+    def storeFeaturesForFrames(self, featuresPerFrame):
+        """
+        Stores the feature data of several frames, given as dictionary of timeframe -> features.
+        Plugins can override this to transfer all frames at once, by default every frame is stored separately.
+        """
+        for timeframe, features in featuresPerFrame.items():
+            self.storeFeaturesForFrame(features, timeframe)
+
+    def loadFeaturesForFrames(self, timeframes):
+        """
+        Loads the feature data of several frames.
+        Plugins can override this to transfer all frames at once, by default every frame is loaded separately.
+
+        **returns** a dictionary of timeframe -> features
+        """
+        return dict((timeframe, self.loadFeaturesForFrame(None, timeframe)) for timeframe in timeframes)
@@ -6,6 +6,9 @@ class ImageProviderPlugin(IPlugin):
     This is the base class for all plugins that load images from a given location
     """
 
+    frameCache = None
+    ''' optional `hytra.util.framecache.FrameCache` that holds the decoded frames returned by this plugin '''
+
     def activate(self):
         """
         Activation of plugin could do something, but not needed here
@@ -18,6 +21,22 @@ class ImageProviderPlugin(IPlugin):
         """
         pass
 
+    def setFrameCache(self, frameCache):
+        """
+        Cache all frames returned by `getImageDataAtTimeFrame` and `getLabelImageForFrame` in the given
+        `hytra.util.framecache.FrameCache`, or disable caching if `frameCache=None`.
+        Cached frames are read-only, so copy them before modifying.
+        """
+        self.frameCache = frameCache
+
+    def _getCachedFrame(self, key, loadFrame):
+        """
+        Helper for derived plugins: return the frame for `key` from the frame cache if one is set,
+        otherwise (or on a cache miss) decode it by calling `loadFrame()`.
+        """
+        if self.frameCache is None:
+            return loadFrame()
+        return self.frameCache.getOrLoad(key, loadFrame)
 
     def getImageDataAtTimeFrame(self, Resource, PathInResource, axes, timeframe):
         """
@@ -27,13 +46,33 @@ class ImageProviderPlugin(IPlugin):
         raise NotImplementedError()
         return []
 
-    def getLabelImageForFrame(self, Resource, PathInResource, timeframe):
+    def getLabelImageForFrame(self, Resource, PathInResource, timeframe, out=None):
         """
-        Get the label image(volume) of one time frame
+        Get the label image(volume) of one time frame as `uint32` array.
+
+        A preallocated `out` array can be given to reuse its memory across frames. Plugins that support it
+        read the frame directly into `out` if shape and dtype fit, others ignore it,
+        so always use the returned array.
         """
         raise NotImplementedError()
         return []
 
+    def getImageDataRegion(self, Resource, PathInResource, axes, timeframe, roi):
+        """
+        Loads a region of interest of the image data of one time frame, where `roi` is a tuple of slices
+        along the spatial axes of the frame returned by `getImageDataAtTimeFrame`.
+        Plugins that can read sub-volumes should override this, by default the full frame is loaded and cropped.
+        """
+        return self.getImageDataAtTimeFrame(Resource, PathInResource, axes, timeframe)[tuple(roi)]
+
+    def getLabelImageRegion(self, Resource, PathInResource, timeframe, roi):
+        """
+        Get a region of interest of the label image of one time frame, where `roi` is a tuple of slices
+        along the axes of the frame returned by `getLabelImageForFrame`.
+        Plugins that can read sub-volumes should override this, by default the full frame is loaded and cropped.
+        """
+        return self.getLabelImageForFrame(Resource, PathInResource, timeframe)[tuple(roi)]
+
     def getImageShape(self, Resource, PathInResource):
         """
         extract the shape from the labelimage
@@ -53,4 +92,24 @@ class ImageProviderPlugin(IPlugin):
         export labelimage of timeframe
         """
         raise NotImplementedError()
-        return []
\ No newline at end of file
+        return []
+
+class LabelImageRegionReader(object):
+    """
+    Array-like access to the label image of one time frame, that only loads the regions which are indexed
+    via `getLabelImageRegion` of the given image provider plugin. Use it instead of the full label image
+    if only a few small regions of a large frame are needed.
+    """
+
+    def __init__(self, imageProvider, Resource, PathInResource, timeframe):
+        self._imageProvider = imageProvider
+        self._resource = Resource
+        self._pathInResource = PathInResource
+        self._timeframe = timeframe
+        # label frames have all singleton axes squeezed away
+        self.shape = tuple(s for s in imageProvider.getImageShape(Resource, PathInResource) if s != 1)
+
+    def __getitem__(self, roi):
+        if not isinstance(roi, (tuple, list)):
+            roi = (roi,)
+        return self._imageProvider.getLabelImageRegion(self._resource, self._pathInResource, self._timeframe, tuple(roi))
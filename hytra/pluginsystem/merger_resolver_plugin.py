@@ -1,4 +1,5 @@
 from yapsy.IPlugin import IPlugin
+import numpy as np
 
 
 class MergerResolverPlugin(IPlugin):
@@ -20,6 +21,21 @@ class MergerResolverPlugin(IPlugin):
         """
         pass
 
+    def getObjectCoordinates(self, labelImage, objectId, boundingBox=None):
+        """
+        Find the pixel coordinates of all pixels labelled with `objectId` in the `labelImage`.
+
+        If a `boundingBox` (tuple of slices, as returned by `scipy.ndimage.find_objects`) is given,
+        only that part of the `labelImage` is searched, but the returned coordinates still refer to the full image.
+
+        **returns** a matrix with one row of coordinates per pixel
+        """
+        if boundingBox is None:
+            return np.transpose(np.vstack(np.where(labelImage == objectId)))
+
+        offset = np.array([s.start for s in boundingBox])
+        return np.transpose(np.vstack(np.where(labelImage[boundingBox] == objectId))) + offset
+
     def resolveMergerForCoords(self, coordinates, mergerCount, initializations=[]):
         """
         Resolve the pixel coordinates belonging to an object ID, into `mergerCount`
@@ -37,7 +53,20 @@ class MergerResolverPlugin(IPlugin):
 
         return []
 
-    def resolveMerger(self, labelImage, objectId, nextId, mergerCount, initializations=[]):
+    def resolveMergersForCoords(self, coordinatesList, mergerCounts, initializationsList):
+        """
+        Resolve a batch of independent mergers at once, e.g. all mergers of one frame.
+        Each entry of `coordinatesList`, `mergerCounts` and `initializationsList` is
+        handled as in `resolveMergerForCoords`.
+
+        Plugins can override this to fit many mergers at once, by default each merger is fitted on its own.
+
+        **returns** a list containing the list of fitted objects per merger
+        """
+        return [self.resolveMergerForCoords(coordinates, mergerCount, initializations)
+                for coordinates, mergerCount, initializations in zip(coordinatesList, mergerCounts, initializationsList)]
+
+    def resolveMerger(self, labelImage, objectId, nextId, mergerCount, initializations=[], boundingBox=None):
         """
         Resolve the object with the ID `objectId` in the `labelImage` into `mergerCount`
         new segments by fitting some kind of model. The `initializations` provide fits
@@ -46,16 +75,20 @@ class MergerResolverPlugin(IPlugin):
 
         `labelImage` is used read-only, use `updateLabelImage` to refine the segmentation
 
+        `boundingBox` (optional) tuple of slices that contains the object, so that not the full `labelImage` must be searched
+
         **returns** a list of fitted objects
         """
         raise NotImplementedError()
 
         return []
     
-    def updateLabelImage(self, labelImage, objectId, fits, newIds):
+    def updateLabelImage(self, labelImage, objectId, fits, newIds, boundingBox=None):
         """
         Resolve the object with the ID `objectId` in the `labelImage` into the fitted models with the given new IDs.
         `labelImage` should be updated by replacing all pixels that were labelled with `objectId`
         to get a new Id depending on the fit.
+
+        `boundingBox` (optional) tuple of slices that contains the object, so that not the full `labelImage` must be searched
         """
         raise NotImplementedError()
\ No newline at end of file
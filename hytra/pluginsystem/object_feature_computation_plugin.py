@@ -1,4 +1,73 @@
 from yapsy.IPlugin import IPlugin
+import copy
+import threading
+import numpy as np
+
+def getAcceptedDtype(dtype, acceptedDtypes):
+    '''
+    **returns** `dtype` if it is one of the `acceptedDtypes` (or those are `None`), and the first accepted dtype otherwise
+    '''
+    if acceptedDtypes is None or np.dtype(dtype) in [np.dtype(d) for d in acceptedDtypes]:
+        return np.dtype(dtype)
+    return np.dtype(acceptedDtypes[0])
+
+class ObjectFeaturePrerequisites(object):
+    """
+    Data derived from the raw and label image of one frame that several object feature plugins need.
+    Every prerequisite is computed only once per frame, when the first plugin asks for it,
+    so plugins do not need to squeeze and cast the images themselves. Safe to use from several threads.
+
+    Available prerequisites:
+
+    * `'labelImage'`: the label image without singleton axes, in one of the `acceptedLabelImageDtypes`
+    * `'rawImage'`: the raw image without singleton axes, in one of the `acceptedRawImageDtypes`
+
+    Use `forPlugin` to get the prerequisites in the dtypes that a plugin accepts,
+    which shares all conversions with the prerequisites of the other plugins.
+    """
+
+    def __init__(self, rawImage, labelImage, acceptedRawImageDtypes=None, acceptedLabelImageDtypes=None):
+        self._images = {'rawImage': rawImage, 'labelImage': labelImage}
+        self._acceptedDtypes = {'rawImage': acceptedRawImageDtypes, 'labelImage': acceptedLabelImageDtypes}
+        self._prerequisites = {}
+        # one lock per prerequisite, such that a plugin that only needs the label image does not wait for the raw image
+        self._locks = {}
+        self._locksLock = threading.Lock()
+
+    def forPlugin(self, plugin):
+        '''
+        **returns** these prerequisites in the `acceptedRawImageDtypes` and `acceptedLabelImageDtypes` of the given plugin
+        '''
+        prerequisites = copy.copy(self)
+        prerequisites._acceptedDtypes = {'rawImage': plugin.acceptedRawImageDtypes,
+                                         'labelImage': plugin.acceptedLabelImageDtypes}
+        return prerequisites
+
+    def _get(self, key, compute):
+        with self._locksLock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._prerequisites:
+                self._prerequisites[key] = compute()
+            return self._prerequisites[key]
+
+    def getImage(self, name, acceptedDtypes):
+        '''
+        **returns** the raw (`name='rawImage'`) or label image (`name='labelImage'`) in its original shape,
+        converted to the first of the `acceptedDtypes` unless it already has one of them (or those are `None`)
+        '''
+        image = self._images[name]
+        dtype = getAcceptedDtype(image.dtype, acceptedDtypes)
+        if dtype == image.dtype:
+            return image
+        return self._get((name, dtype, 'unsqueezed'), lambda: image.astype(dtype))
+
+    def __getitem__(self, name):
+        if name not in self._images:
+            raise KeyError(name)
+        acceptedDtypes = self._acceptedDtypes[name]
+        dtype = getAcceptedDtype(self._images[name].dtype, acceptedDtypes)
+        return self._get((name, dtype), lambda: self.getImage(name, acceptedDtypes).squeeze())
 
 
 class ObjectFeatureComputationPlugin(IPlugin):
@@ -14,6 +83,20 @@ class ObjectFeatureComputationPlugin(IPlugin):
     # specify for which dimensionality these features work
     worksForDimensions = [2, 3]
 
+    # specify which dtypes of raw and label image the plugin can work on without converting them,
+    # the first one is used if a conversion is needed. `None` accepts any dtype.
+    # This applies to the images passed to `computeFeatures` and to the `rawImage` and `labelImage` prerequisites.
+    acceptedRawImageDtypes = None
+    acceptedLabelImageDtypes = ['uint32']
+
+    # specify which of the `ObjectFeaturePrerequisites` the plugin uses. Plugins with prerequisites get them
+    # from the plugin manager, together with the raw and label image in their original dtype.
+    prerequisites = []
+
+    # specify whether the plugin may run in parallel to other plugins on the same frame, in a separate thread.
+    # That only makes sense if the computation releases the GIL, as vigra does.
+    threadSafe = False
+
     def activate(self):
         """
         Activation of plugin could do something, but not needed here
@@ -38,4 +121,12 @@ class ObjectFeatureComputationPlugin(IPlugin):
         """
         raise NotImplementedError()
 
-        return dict()
\ No newline at end of file
+        return dict()
+
+    def computeFeaturesWithPrerequisites(self, rawImage, labelImage, frameNumber, rawFilename, prerequisites):
+        """
+        Same as `computeFeatures`, but with access to the `ObjectFeaturePrerequisites` of this frame,
+        which are shared by all plugins. This is what the plugin manager calls, plugins that declare
+        `prerequisites` should override this method. By default it simply calls `computeFeatures`.
+        """
+        return self.computeFeatures(rawImage, labelImage, frameNumber, rawFilename)
\ No newline at end of file
@@ -1,16 +1,59 @@
 from yapsy.PluginManager import PluginManager
-from yapsy.FilteredPluginManager import FilteredPluginManager
 import logging
-from hytra.pluginsystem.object_feature_computation_plugin import ObjectFeatureComputationPlugin
-from hytra.pluginsystem.transition_feature_vector_construction_plugin import TransitionFeatureVectorConstructionPlugin
+import os
+import sys
+import imp
+import hashlib
+import numpy as np
+import concurrent.futures
+try:
+    from ConfigParser import ConfigParser
+except ImportError:
+    from configparser import ConfigParser
+from hytra.pluginsystem.object_feature_computation_plugin import ObjectFeatureComputationPlugin, ObjectFeaturePrerequisites
+from hytra.pluginsystem.transition_feature_vector_construction_plugin import TransitionFeatureVectorConstructionPlugin, getNumTransitions
 from hytra.pluginsystem.image_provider_plugin import ImageProviderPlugin
 from hytra.pluginsystem.feature_serializer_plugin import FeatureSerializerPlugin
 from hytra.pluginsystem.merger_resolver_plugin import MergerResolverPlugin
 
+def getLogger():
+    return logging.getLogger(__name__)
+
+pluginCategories = {
+    "ObjectFeatureComputation": ObjectFeatureComputationPlugin,
+    "TransitionFeatureVectorConstruction": TransitionFeatureVectorConstructionPlugin,
+    "ImageProvider": ImageProviderPlugin,
+    "FeatureSerializer": FeatureSerializerPlugin,
+    "MergerResolver": MergerResolverPlugin,
+}
+''' base class of the plugins of every category '''
+
+_pluginIndices = {}
+''' plugin index per tuple of plugin paths, discovered at most once per process '''
+
+_pluginModules = {}
+''' plugin modules per file, imported at most once per process '''
+
+_checkedFailedPluginPaths = set()
+''' modules of plugins that failed to import during discovery, and were tried again in this process '''
+
 class TrackingPluginManager(object):
     """
-    Our plugin manager that handles the types of plugins known in this pipeline
+    Our plugin manager that handles the types of plugins known in this pipeline.
+
+    Object feature computation plugins that are `threadSafe` run in parallel threads on the same frame
+    if `numObjectFeatureThreads > 1`.
+
+    Plugins are discovered by [yapsy](http://yapsy.sourceforge.net/), which imports every plugin module.
+    As that is slow, the name, category, module and class of every plugin found is remembered once per process
+    and set of plugin paths, such that further plugin managers (e.g. those of the parallel jobs, which are forked
+    from the main process) do not discover the plugins again. Plugin instances are kept per plugin manager.
+    Plugins whose module could not be imported during discovery (e.g. because of a missing dependency) are
+    tried again once per process, and trigger a new discovery as soon as they can be imported.
     """
+    numObjectFeatureThreads = 1
+    ''' number of threads in which independent object feature computation plugins run for one frame '''
+
     def __init__(self, pluginPaths=['hytra/plugins'], turnOffFeatures=[], verbose=False):
         """
         Create the plugin manager that looks inside the specified `pluginPaths` (recursively),
@@ -21,7 +64,7 @@ class TrackingPluginManager(object):
         self._turnOffFeatures = turnOffFeatures
         self._verbose = verbose
         
-        self._initializeYapsy()
+        self._initializePlugins()
 
         self.chosen_data_provider = "LocalImageLoader"
         self.chosen_feature_serializer = "LocalFeatureSerializer"
@@ -38,71 +81,237 @@ class TrackingPluginManager(object):
         # method to avoid modifying the original state.
         state = self.__dict__.copy()
         # Remove the unpicklable entries.
-        del state['_yapsyPluginManager']
+        del state['_pluginIndex']
+        del state['_plugins']
         return state
 
     def __setstate__(self, state):
         # Restore instance attributes
         self.__dict__.update(state)
-        # Restore the yapsy plugins by reading them from scratch
-        self._initializeYapsy()
+        # Restore the plugin index, which is usually already known in this process
+        self._initializePlugins()
+
+    def _initializePlugins(self):
+        ''' get the index of all available plugins, and reset the plugin instances of this manager '''
+        self._plugins = {}
+        key = self._getPluginPathsKey()
+        if key not in _pluginIndices:
+            _pluginIndices[key] = self._discoverPlugins()
+        self._pluginIndex = _pluginIndices[key]
 
-    def _initializeYapsy(self):
+    def _getPluginPathsKey(self):
+        return tuple(os.path.abspath(p) for p in self._pluginPaths)
+
+    def _rediscoverPlugins(self):
+        ''' discover all plugins with yapsy again, and update the plugin index of this process '''
+        key = self._getPluginPathsKey()
+        _pluginIndices[key] = self._discoverPlugins()
+        self._pluginIndex = _pluginIndices[key]
+        self._plugins = dict((k, p) for k, p in self._plugins.items() if p is not None)
+
+    def _discoverPlugins(self):
+        '''
+        Let yapsy find and import all plugins, and remember where each plugin class is located.
+
+        **returns** a list of plugin descriptions with `name`, `category`, `path` (of the module, without `.py`)
+        and `className`
+        '''
+        yapsyPluginManager = self._createYapsyPluginManager()
+        index = []
+        for category in yapsyPluginManager.getCategories():
+            for pluginInfo in yapsyPluginManager.getPluginsOfCategory(category):
+                path = os.path.abspath(pluginInfo.path)
+                pluginClass = pluginInfo.plugin_object.__class__
+                index.append({'name': pluginInfo.name,
+                              'category': category,
+                              'path': path,
+                              'className': pluginClass.__name__})
+                # the module has been imported already, no need to do it again
+                _pluginModules.setdefault(path, sys.modules[pluginClass.__module__])
+
+        # remember the plugins that yapsy skipped because their module could not be imported
+        discoveredPaths = set(description['path'] for description in index)
+        for name, path in self._findPluginInfos():
+            if path not in discoveredPaths:
+                getLogger().log(logging.ERROR if self._verbose else logging.DEBUG,
+                                "Could not import plugin {} from {}".format(name, path))
+                index.append({'name': name, 'category': None, 'path': path, 'className': None})
+        return index
+
+    def _findPluginInfos(self):
+        ''' **returns** a list of `(name, path)` of all plugins described by `.yapsy-plugin` files in the plugin paths '''
+        pluginInfos = []
+        for pluginPath in self._pluginPaths:
+            for root, _, filenames in os.walk(pluginPath):
+                for filename in sorted(filenames):
+                    if filename.endswith('.yapsy-plugin'):
+                        config = ConfigParser()
+                        config.read(os.path.join(root, filename))
+                        pluginInfos.append((config.get('Core', 'Name'),
+                                            os.path.abspath(os.path.join(root, config.get('Core', 'Module')))))
+        return pluginInfos
+
+    def _hasNewlyImportablePlugins(self):
+        '''
+        Try to import the modules of the plugins that failed to import during discovery,
+        at most once per process and module.
+
+        **returns** whether one of them can be imported now
+        '''
+        for description in self._pluginIndex:
+            path = description['path']
+            if description['category'] is not None or path in _checkedFailedPluginPaths:
+                continue
+            _checkedFailedPluginPaths.add(path)
+            try:
+                module = self._importPluginModule(path)
+            except Exception as e:
+                getLogger().debug("Plugin {} still cannot be imported: {}".format(description['name'], e))
+                continue
+            if any(isinstance(c, type) and issubclass(c, base) and c is not base
+                   for c in vars(module).values() for base in pluginCategories.values()):
+                getLogger().info("Plugin {} can be imported now".format(description['name']))
+                return True
+        return False
+
+    def _createYapsyPluginManager(self):
+        ''' create a yapsy plugin manager that imports all plugins in our plugin paths, regardless of `turnOffFeatures` '''
         # Build the manager
-        self._yapsyPluginManager = PluginManager()
-        self._yapsyPluginManager = FilteredPluginManager(self._yapsyPluginManager)
-        self._yapsyPluginManager.isPluginOk = lambda x: x.name not in self._turnOffFeatures
+        yapsyPluginManager = PluginManager()
 
         # Tell it the default place(s) where to find plugins
-        self._yapsyPluginManager.setPluginPlaces(self._pluginPaths)
+        yapsyPluginManager.setPluginPlaces(self._pluginPaths)
         # Define the various categories corresponding to the different
         # kinds of plugins you have defined
-        self._yapsyPluginManager.setCategoriesFilter({
-            "ObjectFeatureComputation": ObjectFeatureComputationPlugin,
-            "TransitionFeatureVectorConstruction": TransitionFeatureVectorConstructionPlugin,
-            "ImageProvider": ImageProviderPlugin,
-            "FeatureSerializer": FeatureSerializerPlugin,
-            "MergerResolver": MergerResolverPlugin,
-        })
+        yapsyPluginManager.setCategoriesFilter(pluginCategories)
         if self._verbose:
             logging.getLogger('yapsy').setLevel(logging.DEBUG)
         else:
             logging.getLogger('yapsy').setLevel(logging.CRITICAL)
 
-        self._yapsyPluginManager.collectPlugins()
+        yapsyPluginManager.collectPlugins()
+        return yapsyPluginManager
+
+    def _importPluginModule(self, path):
+        ''' import the module of a plugin (a file or package at `path`), at most once per process '''
+        if path not in _pluginModules:
+            moduleName = 'hytra_plugin_' + hashlib.sha1(path.encode('utf-8')).hexdigest()
+            if os.path.isdir(path):
+                _pluginModules[path] = imp.load_module(moduleName, None, path, ('', '', imp.PKG_DIRECTORY))
+            else:
+                _pluginModules[path] = imp.load_source(moduleName, path + '.py')
+        return _pluginModules[path]
+
+    def _instantiatePlugin(self, description):
+        ''' **returns** this manager's instance of the described plugin, importing its module if needed '''
+        key = (description['category'], description['name'])
+        if key not in self._plugins:
+            try:
+                module = self._importPluginModule(description['path'])
+                plugin = getattr(module, description['className'])()
+            except Exception as e:
+                getLogger().warning("Could not load plugin {}: {}".format(description['name'], e))
+                plugin = None
+            self._plugins[key] = plugin
+        return self._plugins[key]
 
     def _applyToAllPluginsOfCategory(self, func, category):
         ''' helper function to apply `func` to all plugins of the given `category` and hide all yapsy stuff '''
-        for pluginInfo in self._yapsyPluginManager.getPluginsOfCategory(category):
-            p = pluginInfo.plugin_object
-            func(p)
+        # plugins that could not be imported before might work now, e.g. after a dependency has been installed
+        if self._hasNewlyImportablePlugins():
+            self._rediscoverPlugins()
+
+        for description in self._pluginIndex:
+            if description['category'] == category and description['name'] not in self._turnOffFeatures:
+                p = self._instantiatePlugin(description)
+                if p is not None:
+                    func(p)
 
     def _getPluginOfCategory(self, name, category):
         ''' 
         helper function to access a certain plugin by `name` from a `category`. 
+        The plugin is only imported when it is requested for the first time.
         
         **returns** the plugin or throws a `KeyError` 
         '''
-        pluginDict = dict((pluginInfo.name, pluginInfo.plugin_object) 
-            for pluginInfo in self._yapsyPluginManager.getPluginsOfCategory(category))
-        return pluginDict[name]
+        if (category, name) in self._plugins and self._plugins[(category, name)] is not None:
+            return self._plugins[(category, name)]
+
+        for description in self._pluginIndex:
+            if description['category'] == category and description['name'] == name \
+                    and name not in self._turnOffFeatures:
+                plugin = self._instantiatePlugin(description)
+                if plugin is not None:
+                    return plugin
+
+        # the plugin might have failed to import before, e.g. because a dependency was not installed yet
+        if self._hasNewlyImportablePlugins():
+            self._rediscoverPlugins()
+            return self._getPluginOfCategory(name, category)
+        raise KeyError(name)
 
     def applyObjectFeatureComputationPlugins(self, ndims, rawImage, labelImage, frameNumber, rawFilename):
         """
         computes the features of all plugins and returns a list of dictionaries, as well as a list of
-        feature names that should be ignored
+        feature names that should be ignored.
+
+        Plugins that declare `prerequisites` get the `ObjectFeaturePrerequisites` of this frame in the dtypes they accept,
+        otherwise raw and label image are passed to each plugin in a dtype that it accepts.
+        Either way, each conversion is performed only once for all plugins.
+        Thread safe plugins run in parallel if `numObjectFeatureThreads > 1`, the order of the returned
+        dictionaries always follows the order of the plugins.
         """
-        features = []
-        featureNamesToIgnore = []
+        plugins = []
+        self._applyToAllPluginsOfCategory(plugins.append, "ObjectFeatureComputation")
+        plugins = [p for p in plugins if ndims in p.worksForDimensions]
+
+        prerequisites = ObjectFeaturePrerequisites(rawImage, labelImage)
 
         def computeFeatures(plugin):
-            if ndims in plugin.worksForDimensions:
-                f = plugin.computeFeatures(rawImage, labelImage, frameNumber, rawFilename)
-                features.append(f)
-                featureNamesToIgnore.extend(plugin.omittedFeatures)
-        self._applyToAllPluginsOfCategory(computeFeatures, "ObjectFeatureComputation")
+            pluginPrerequisites = prerequisites.forPlugin(plugin)
+            if len(plugin.prerequisites) > 0:
+                # compute the prerequisites in this thread, they are shared with the other plugins
+                for name in plugin.prerequisites:
+                    pluginPrerequisites[name]
+                return plugin.computeFeaturesWithPrerequisites(rawImage, labelImage, frameNumber,
+                                                               rawFilename, pluginPrerequisites)
+            pluginRawImage = prerequisites.getImage('rawImage', plugin.acceptedRawImageDtypes)
+            pluginLabelImage = prerequisites.getImage('labelImage', plugin.acceptedLabelImageDtypes)
+            return plugin.computeFeaturesWithPrerequisites(pluginRawImage, pluginLabelImage, frameNumber,
+                                                           rawFilename, pluginPrerequisites)
+
+        parallelPlugins = [p for p in plugins if p.threadSafe]
+        if self.numObjectFeatureThreads > 1 and len(parallelPlugins) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.numObjectFeatureThreads) as executor:
+                jobs = dict((p, executor.submit(computeFeatures, p)) for p in parallelPlugins)
+                results = dict((p, job.result()) for p, job in jobs.items())
+            features = [results[p] if p in results else computeFeatures(p) for p in plugins]
+        else:
+            features = [computeFeatures(p) for p in plugins]
+
+        featureNamesToIgnore = []
+        for plugin in plugins:
+            featureNamesToIgnore.extend(plugin.omittedFeatures)
         return features, featureNamesToIgnore
 
+    def computeObjectFeatures(self, ndims, rawImage, labelImage, frameNumber, rawFilename, removeOmittedFeatures=True):
+        """
+        computes the features of all plugins like `applyObjectFeatureComputationPlugins`, and combines them
+        into one dictionary. If several plugins compute a feature of the same name, the later plugin wins.
+
+        **returns** the feature dictionary, without the features that plugins want to be ignored
+        if `removeOmittedFeatures=True`
+        """
+        features, featureNamesToIgnore = self.applyObjectFeatureComputationPlugins(
+            ndims, rawImage, labelImage, frameNumber, rawFilename)
+        frameFeatures = {}
+        for f in features:
+            frameFeatures.update(f)
+        if removeOmittedFeatures:
+            for name in featureNamesToIgnore:
+                frameFeatures.pop(name, None)
+        return frameFeatures
+
     def applyTransitionFeatureVectorConstructionPlugins(self, featureDictObjectA, featureDictObjectB, selectedFeatures):
         """
         constructs a transition feature vector for training/prediction with a random forest from the
@@ -117,6 +326,24 @@ class TrackingPluginManager(object):
 
         return featureVector
 
+    def applyTransitionFeatureMatrixConstructionPlugins(self, featuresA, featuresB, selectedFeatures):
+        """
+        constructs the transition feature vectors of N transitions at once, where `featuresA` and `featuresB` are
+        dictionaries of feature name -> array with one row per source and target object of the transitions.
+        Plugins that do not provide a vectorized `constructFeatureMatrix` are applied per transition.
+
+        **returns** a numpy array of shape N x F, whose rows match `applyTransitionFeatureVectorConstructionPlugins`
+        """
+        featureMatrices = []
+        def appendFeatures(plugin):
+            featureMatrices.append(plugin.constructFeatureMatrix(featuresA, featuresB, selectedFeatures))
+
+        self._applyToAllPluginsOfCategory(appendFeatures, "TransitionFeatureVectorConstruction")
+
+        if len(featureMatrices) == 0:
+            return np.zeros((getNumTransitions(featuresA, selectedFeatures), 0))
+        return np.hstack(featureMatrices)
+
     def getTransitionFeatureNames(self, featureDictObjectA, featureDictObjectB, selectedFeatures):
         """
         returns a verbal description of each feature in the transition feature vector
@@ -132,7 +359,7 @@ class TrackingPluginManager(object):
 
     def setImageProvider(self, imageProviderName):
         ''' set the used image provier plugin name '''
-    	self.chosen_data_provider = imageProviderName
+        self.chosen_data_provider = imageProviderName
 
     def getImageProvider(self):
         ''' get an instance of the selected image provider plugin '''
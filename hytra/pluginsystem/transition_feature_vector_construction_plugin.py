@@ -1,4 +1,33 @@
 from yapsy.IPlugin import IPlugin
+import numpy as np
+
+
+def getNumTransitions(featuresA, selectedFeatures):
+    """
+    Number of rows of the aligned feature matrices given to `constructFeatureMatrix`
+    """
+    for key in selectedFeatures:
+        if key in featuresA:
+            return len(featuresA[key])
+    return len(next(iter(featuresA.values()))) if len(featuresA) > 0 else 0
+
+
+def stackFeatureVectors(featureVectors, numTransitions):
+    """
+    Stack a list of per-transition feature vectors (lists) into a matrix of shape N x F,
+    which has zero columns if the vectors are empty
+    """
+    if len(featureVectors) == 0 or len(featureVectors[0]) == 0:
+        return np.zeros((numTransitions, 0))
+    return np.array(featureVectors, dtype=np.float64)
+
+
+def stackObjectFeatures(featureDicts, selectedFeatures):
+    """
+    Turn a list of per-object feature dictionaries into a dictionary of feature name -> array with one row per object,
+    as expected by `constructFeatureMatrix`. Only the `selectedFeatures` are stacked.
+    """
+    return dict((key, np.array([featureDict[key] for featureDict in featureDicts])) for key in selectedFeatures)
 
 
 class TransitionFeatureVectorConstructionPlugin(IPlugin):
@@ -39,4 +68,25 @@ class TransitionFeatureVectorConstructionPlugin(IPlugin):
                     featureDictObjectA['meanIntensity']*featureDictObjectB['meanIntensity']]
         """
         raise NotImplementedError()
-        return []
\ No newline at end of file
+        return []
+
+    def constructFeatureMatrix(self, featuresA, featuresB, selectedFeatures):
+        """
+        Batched version of `constructFeatureVector` for N transitions at once.
+
+        `featuresA` and `featuresB` are dictionaries of feature name -> numpy array, whose rows hold the features of
+        the N source and N target objects, aligned such that row i of both describes the i-th transition.
+
+        Return a numpy array of shape N x F, whose rows match the feature vectors `constructFeatureVector` would give
+        (up to floating point rounding).
+
+        The default implementation calls `constructFeatureVector` per transition,
+        plugins should override it with a vectorized computation.
+        """
+        numTransitions = getNumTransitions(featuresA, selectedFeatures)
+        rows = []
+        for i in range(numTransitions):
+            featureDictObjectA = dict((key, value[i]) for key, value in featuresA.items())
+            featureDictObjectB = dict((key, value[i]) for key, value in featuresB.items())
+            rows.append(self.constructFeatureVector(featureDictObjectA, featureDictObjectB, selectedFeatures))
+        return stackFeatureVectors(rows, numTransitions)
@@ -0,0 +1,130 @@
+"""
+This module provides a compact binary encoding of feature dictionaries (feature name -> array of values per object),
+to store or send them without converting every number to text.
+
+The encoding is a `.npz` container: every numeric feature is stored as raw little-endian array,
+all other values (e.g. lists of filenames) as JSON in a small header. It can optionally be zip-compressed.
+
+For out-of-core processing, the same split can be written to an HDF5 file with `writeFeaturesToHdf5`,
+whose numeric features are memory-mapped by `readFeaturesFromHdf5` instead of being read into memory.
+"""
+
+import io
+import os
+import numpy as np
+import h5py
+import json_tricks as json
+
+_headerName = '__header__'
+
+def _splitFeatures(features):
+    """
+    Split a feature dictionary into numeric arrays and a JSON serializable header holding all other values.
+
+    **returns** a tuple of a list of (name, array) pairs and the header dictionary
+    """
+    arrays = []
+    header = {'arrays': {}, 'values': {}, 'ndarrays': []}
+    for name, value in features.items():
+        try:
+            array = np.asarray(value)
+        except ValueError:
+            # ragged lists, e.g. of polygons
+            array = None
+
+        if array is not None and array.dtype.kind in 'biuf':
+            arrays.append((name, array))
+        elif isinstance(value, np.ndarray):
+            header['values'][name] = value.tolist()
+            header['ndarrays'].append(name)
+        else:
+            header['values'][name] = value
+    return arrays, header
+
+def _joinFeatures(header, arrays):
+    """
+    Inverse of `_splitFeatures`, where `arrays` maps the keys stored in the header to the numeric arrays
+    """
+    features = dict(header['values'])
+    for name in header['ndarrays']:
+        features[name] = np.array(features[name])
+    for name, key in header['arrays'].items():
+        features[name] = arrays[key]
+    return features
+
+def encodeFeatures(features, compress=True):
+    """
+    Encode a feature dictionary as `.npz` container.
+
+    **Parameters**
+
+    * `features`: dictionary of feature name -> numpy array or list of values per object
+    * `compress`: whether to zip-compress the arrays (slower, but usually much smaller for features)
+
+    **returns** a byte string
+    """
+    numericFeatures, header = _splitFeatures(features)
+    arrays = {}
+    for name, array in numericFeatures:
+        key = 'f{}'.format(len(arrays))
+        arrays[key] = array.astype(array.dtype.newbyteorder('<'))
+        header['arrays'][name] = key
+
+    arrays[_headerName] = np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8)
+
+    buffer = io.BytesIO()
+    if compress:
+        np.savez_compressed(buffer, **arrays)
+    else:
+        np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+def isEncodedFeatures(data):
+    """
+    **returns** whether `data` was created by `encodeFeatures`, as opposed to e.g. a JSON string
+    """
+    # npz containers are zip files
+    return data[:2] == b'PK'
+
+def decodeFeatures(data):
+    """
+    Decode a feature dictionary from a byte string created by `encodeFeatures`.
+    """
+    with np.load(io.BytesIO(data)) as container:
+        header = json.loads(container[_headerName].tobytes().decode('utf-8'))
+        return _joinFeatures(header, container)
+
+def writeFeaturesToHdf5(features, filename):
+    """
+    Write a feature dictionary to the HDF5 file `filename`, one contiguous dataset per numeric feature
+    and all other values as JSON. The file is written under a temporary name and then renamed,
+    such that readers never see a partially written file.
+    """
+    numericFeatures, header = _splitFeatures(features)
+    tmpFilename = '{}.{}.tmp'.format(filename, os.getpid())
+    with h5py.File(tmpFilename, 'w') as h5file:
+        for name, array in numericFeatures:
+            key = 'f{}'.format(len(header['arrays']))
+            h5file.create_dataset(key, data=array)
+            header['arrays'][name] = key
+        h5file.create_dataset(_headerName, data=np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8))
+    os.rename(tmpFilename, filename)
+
+def readFeaturesFromHdf5(filename, memoryMap=True):
+    """
+    Read a feature dictionary from an HDF5 file created by `writeFeaturesToHdf5`.
+
+    If `memoryMap=True`, the numeric features are returned as read-only memory maps of the file,
+    so only the parts that are accessed will be loaded from disk.
+    """
+    arrays = {}
+    with h5py.File(filename, 'r') as h5file:
+        header = json.loads(h5file[_headerName][()].tobytes().decode('utf-8'))
+        for key in header['arrays'].values():
+            dataset = h5file[key]
+            offset = dataset.id.get_offset()
+            if memoryMap and offset is not None and dataset.size > 0:
+                arrays[key] = np.memmap(filename, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+            else:
+                arrays[key] = dataset[()]
+    return _joinFeatures(header, arrays)
@@ -0,0 +1,149 @@
+import os
+import uuid
+import atexit
+import shutil
+import hashlib
+import logging
+import numpy as np
+from collections import OrderedDict
+
+def getLogger():
+    return logging.getLogger(__name__)
+
+_frameStores = {}
+''' in-memory frame storage of this process, per cache id '''
+
+class _FrameStore(object):
+    ''' LRU ordered frames of one cache and their total size in bytes '''
+    def __init__(self):
+        self.frames = OrderedDict()
+        self.numBytes = 0
+
+def _removeScratchDirectory(scratchDirectory, ownerPid):
+    ''' delete the scratch files of a cache, but only from the process that created it, not from forked workers '''
+    if os.getpid() == ownerPid and os.path.isdir(scratchDirectory):
+        getLogger().debug("Removing frame cache scratch directory {}".format(scratchDirectory))
+        shutil.rmtree(scratchDirectory, ignore_errors=True)
+
+class FrameCache(object):
+    """
+    A byte-budgeted LRU cache of decoded image frames, used by the image provider plugins such that
+    every frame only needs to be read and decompressed once, even if feature extraction, division features,
+    overlap computation and merger resolving all request it again.
+
+    If a `scratchDirectory` is given, every decoded frame is also written to a subdirectory of it as `.npy` file,
+    and loaded as read-only memory map on a cache miss. As the `FrameCache` only pickles its settings,
+    all worker processes that receive it share the frames through the scratch directory,
+    while each process additionally keeps at most `maxBytes` of frames in memory.
+    Each `FrameCache` uses its own subdirectory, such that frames of earlier runs are never picked up
+    (the files might have changed in between), and the subdirectory is removed when the process
+    that created the cache exits.
+
+    Cached frames are returned read-only, callers that want to modify a frame have to copy it first.
+    """
+
+    def __init__(self, maxBytes, scratchDirectory=None):
+        self.maxBytes = maxBytes
+        self._cacheId = uuid.uuid4().hex
+        self.scratchDirectory = None
+
+        if scratchDirectory is not None:
+            self.scratchDirectory = os.path.join(scratchDirectory, 'hytra-frames-' + self._cacheId)
+            os.makedirs(self.scratchDirectory)
+            atexit.register(_removeScratchDirectory, self.scratchDirectory, os.getpid())
+
+    def _getStore(self):
+        if self._cacheId not in _frameStores:
+            _frameStores[self._cacheId] = _FrameStore()
+        return _frameStores[self._cacheId]
+
+    def _getScratchFilename(self, key):
+        return os.path.join(self.scratchDirectory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npy')
+
+    def _insert(self, key, frame):
+        ''' insert `frame` into the in-memory LRU store, evicting the least recently used frames if needed '''
+        if frame.nbytes > self.maxBytes:
+            return
+        store = self._getStore()
+        self._remove(store, key)
+        while store.numBytes + frame.nbytes > self.maxBytes:
+            _, oldFrame = store.frames.popitem(last=False)
+            store.numBytes -= oldFrame.nbytes
+        store.frames[key] = frame
+        store.numBytes += frame.nbytes
+
+    def _remove(self, store, key):
+        if key in store.frames:
+            store.numBytes -= store.frames.pop(key).nbytes
+
+    def get(self, key):
+        '''
+        **returns** the cached frame for `key` as read-only array, or `None` if it is not cached
+        '''
+        store = self._getStore()
+        if key in store.frames:
+            # mark as most recently used
+            frame = store.frames.pop(key)
+            store.frames[key] = frame
+            return frame
+
+        if self.scratchDirectory is not None:
+            filename = self._getScratchFilename(key)
+            if os.path.exists(filename):
+                frame = np.load(filename, mmap_mode='r')
+                self._insert(key, frame)
+                return frame
+
+        return None
+
+    def put(self, key, frame):
+        '''
+        Insert a decoded `frame` for `key` into the cache.
+
+        **returns** the cached read-only version of `frame`
+        '''
+        frame = np.ascontiguousarray(frame)
+        frame.flags.writeable = False
+
+        if self.scratchDirectory is not None:
+            filename = self._getScratchFilename(key)
+            if not os.path.exists(filename):
+                # write to a temporary file first, so that other processes never see incomplete frames
+                tmpFilename = '{}.{}.tmp'.format(filename, os.getpid())
+                with open(tmpFilename, 'wb') as f:
+                    np.save(f, frame)
+                os.rename(tmpFilename, filename)
+
+        self._insert(key, frame)
+        return frame
+
+    def getOrLoad(self, key, loadFrame):
+        '''
+        **returns** the cached frame for `key`, calling `loadFrame()` to decode it on a cache miss
+        '''
+        frame = self.get(key)
+        if frame is None:
+            getLogger().debug("Frame cache miss for {}".format(key))
+            frame = self.put(key, loadFrame())
+        return frame
+
+    def discard(self, key):
+        '''
+        Remove the frame for `key` from the cache, e.g. because it has been overwritten
+        '''
+        self._remove(self._getStore(), key)
+        if self.scratchDirectory is not None:
+            filename = self._getScratchFilename(key)
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def clear(self, removeScratchFiles=False):
+        '''
+        Drop all frames held in memory by this process, and also delete all frames
+        from the scratch directory if `removeScratchFiles=True`
+        '''
+        _frameStores.pop(self._cacheId, None)
+        if removeScratchFiles and self.scratchDirectory is not None:
+            for filename in os.listdir(self.scratchDirectory):
+                if filename.endswith('.npy'):
+                    os.remove(os.path.join(self.scratchDirectory, filename))
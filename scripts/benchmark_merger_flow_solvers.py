@@ -0,0 +1,98 @@
+# pythonpath modification to make hytra available
+# for import without requiring it to be installed
+import os
+import sys
+sys.path.insert(0, os.path.abspath('..'))
+# standard imports
+import logging
+import time
+import numpy as np
+from hytra.core.jsongraph import negLog
+from hytra.core.mergerresolver import maxFlowMinCostTracking, maxFlowMinCostTrackingWithDpct
+
+
+def createRandomResolvedGraph(numFrames, numObjectsPerFrame, numNeighbors=2, transitionParameter=5.0, seed=0):
+    """
+    Create a layered graph resembling a resolved merger graph: objects at random positions in every frame,
+    each linked to its `numNeighbors` nearest objects in the next frame with distance based energies.
+
+    **returns** the number of nodes, appearance and disappearance nodes, the arcs and their energies
+    """
+    rng = np.random.RandomState(seed)
+    positions = [rng.uniform(0, 100, size=(numObjectsPerFrame, 2)) for _ in range(numFrames)]
+    numNodes = numFrames * numObjectsPerFrame
+
+    arcs = []
+    arcEnergies = []
+    for t in range(numFrames - 1):
+        for i in range(numObjectsPerFrame):
+            distances = np.linalg.norm(positions[t + 1] - positions[t][i], axis=1)
+            for j in np.argsort(distances)[:numNeighbors]:
+                prob = np.exp(-distances[j] / transitionParameter)
+                arcs.append([t * numObjectsPerFrame + i, (t + 1) * numObjectsPerFrame + j])
+                arcEnergies.append(negLog([1.0 - prob, prob]))
+
+    arcs = np.array(arcs, dtype=np.int64).reshape(-1, 2)
+    arcEnergies = np.array(arcEnergies).reshape(-1, 2)
+    hasIncoming = np.zeros(numNodes, dtype=bool)
+    hasIncoming[arcs[:, 1]] = True
+    hasOutgoing = np.zeros(numNodes, dtype=bool)
+    hasOutgoing[arcs[:, 0]] = True
+    return numNodes, list(np.where(~hasIncoming)[0]), list(np.where(~hasOutgoing)[0]), arcs, arcEnergies
+
+
+def totalEnergy(nodeFlow, arcFlow, arcEnergies):
+    ''' energy of a solution with detection energy 1 and appearance/disappearance energy 0 '''
+    return float(np.sum(nodeFlow) + np.sum(arcEnergies[np.arange(len(arcFlow)), arcFlow]))
+
+
+if __name__ == '__main__':
+    import configargparse as argparse
+
+    parser = argparse.ArgumentParser(description='Compare the runtime and solutions of the min-cost max-flow solvers '
+                                     'used for merger resolving on random graphs of different sizes.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-frames', dest='numFrames', type=int, default=4,
+                        help='Number of frames of the random graphs')
+    parser.add_argument('--num-objects', dest='numObjects', type=int, nargs='+', default=[2, 5, 10, 50, 200],
+                        help='Number of objects per frame, one benchmark is run per value')
+    parser.add_argument('--repetitions', dest='repetitions', type=int, default=10,
+                        help='Number of runs per solver and graph size')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    try:
+        import dpct
+        solvers = ['networkx', 'dpct']
+    except ImportError:
+        logging.getLogger('benchmark').warning('dpct not installed, only benchmarking the networkx solver')
+        solvers = ['networkx']
+
+    print('{:>8} {:>8} {:>10} {:>14} {:>14}'.format('objects', 'arcs', 'solver', 'time/run [ms]', 'energy'))
+    for numObjects in args.numObjects:
+        graph = createRandomResolvedGraph(args.numFrames, numObjects)
+        numNodes, appearanceNodes, disappearanceNodes, arcs, arcEnergies = graph
+        solutions = {}
+        for solver in solvers:
+            t0 = time.time()
+            for _ in range(args.repetitions):
+                if solver == 'dpct':
+                    nodeFlow, arcFlow = maxFlowMinCostTrackingWithDpct(
+                        numNodes, appearanceNodes, disappearanceNodes, arcs, arcEnergies)
+                else:
+                    nodeFlow, arcFlow = maxFlowMinCostTracking(
+                        numNodes, appearanceNodes, disappearanceNodes, arcs, arcEnergies[:, 1] - arcEnergies[:, 0])
+            t1 = time.time()
+            solutions[solver] = (nodeFlow, arcFlow)
+            print('{:>8} {:>8} {:>10} {:>14.3f} {:>14.4f}'.format(
+                numObjects, len(arcs), solver, 1000.0 * (t1 - t0) / args.repetitions,
+                totalEnergy(nodeFlow, arcFlow, arcEnergies)))
+
+        if len(solutions) == 2:
+            same = np.array_equal(solutions['networkx'][1], solutions['dpct'][1])
+            print('{:>8} {:>8} {:>10} {}'.format(numObjects, len(arcs), 'agree', same))
@@ -99,6 +99,12 @@ def getConfigAndCommandLineArguments():
                         help='Do not use multiprocessing to speed up computation',
                         default=False)
     parser.add_argument('--turn-off-features', dest='turnOffFeatures', type=str, nargs='+', default=[])
+    parser.add_argument('--frame-cache-size', dest='frameCacheSize', type=int, default=0,
+                        help='Megabytes of decoded label and raw frames to keep in memory per process, 0 disables the frame cache')
+    parser.add_argument('--frame-cache-dir', dest='frameCacheDir', type=str, default=None,
+                        help='Scratch directory where decoded frames are stored to share them between processes')
+    parser.add_argument('--feature-spill-dir', dest='featureSpillDir', type=str, default=None,
+                        help='Directory where the features of every frame are stored instead of keeping them in memory')
     parser.add_argument('--verbose', dest='verbose', action='store_true',
                         help='Turn on verbose logging', default=False)
     parser.add_argument('--plugin-paths', dest='pluginPaths', type=str, nargs='+',
@@ -467,6 +473,9 @@ def loadProbabilityGenerator(options,
     ilpOptions.rawImageFilename = options.raw_filename
     ilpOptions.rawImageAxes = options.raw_axes
     ilpOptions.sizeFilter = [options.minsize, options.maxsize]
+    ilpOptions.frameCacheSize = options.frameCacheSize * 1024 * 1024
+    ilpOptions.frameCacheScratchDirectory = options.frameCacheDir
+    ilpOptions.featureSpillDirectory = options.featureSpillDir
     if options.label_image_file is not None:
         ilpOptions.labelImageFilename = options.label_image_file
     else:
@@ -44,6 +44,13 @@ if __name__ == "__main__":
                         help='alpha for the transition prior')
     parser.add_argument('--verbose', dest='verbose', action='store_true',
                         help='Turn on verbose logging', default=False)
+    parser.add_argument('--merger-flow-solver', dest='merger_flow_solver', type=str, default='auto',
+                        choices=['auto', 'dpct', 'networkx'],
+                        help='Min-cost max-flow solver used to find the merger assignments, auto uses dpct if available')
+    parser.add_argument('--disable-multiprocessing', dest='disableMultiprocessing', action='store_true',
+                        help='Do not use multiprocessing to speed up computation', default=False)
+    parser.add_argument('--frame-cache-size', dest='frameCacheSize', type=int, default=0,
+                        help='Megabytes of decoded label and raw frames to keep in memory, 0 disables the frame cache')
     parser.add_argument('--plugin-paths', dest='pluginPaths', type=str, nargs='+',
                         default=[os.path.abspath('../hytra/plugins')],
                         help='A list of paths to search for plugins for the tracking pipeline.')
@@ -64,7 +71,10 @@ if __name__ == "__main__":
         args.raw_path,
         args.raw_axes,
         args.pluginPaths,
-        args.verbose)
+        args.verbose,
+        not args.disableMultiprocessing,
+        args.frameCacheSize * 1024 * 1024)
+    merger_resolver.minCostFlowSolver = args.merger_flow_solver
     merger_resolver.run(
         args.transition_classifier_filename,
         args.transition_classifier_path)
@@ -130,6 +130,8 @@ def setupGraph(options):
     ilpOptions.rawImageAxes = options.raw_data_axes
     
     ilpOptions.sizeFilter = [10, 100000]
+    ilpOptions.frameCacheSize = options.frameCacheSize * 1024 * 1024
+    ilpOptions.frameCacheScratchDirectory = options.frameCacheDir
     ilpOptions.objectCountClassifierFilename = options.obj_count_classifier_file
     ilpOptions.objectCountClassifierPath = options.obj_count_classifier_path
     
@@ -381,6 +383,10 @@ if __name__ == "__main__":
     parser.add_argument('--disable-multiprocessing', dest='disableMultiprocessing', action='store_true',
                         help='Do not use multiprocessing to speed up computation',
                         default=False)
+    parser.add_argument('--frame-cache-size', dest='frameCacheSize', type=int, default=0,
+                        help='Megabytes of decoded label and raw frames to keep in memory per process, 0 disables the frame cache')
+    parser.add_argument('--frame-cache-dir', dest='frameCacheDir', type=str, default=None,
+                        help='Scratch directory where decoded frames are stored to share them between processes')
 
     # Raw Data:
     group = parser.add_argument_group('Input Images', 'Raw data and label images')
@@ -4,15 +4,14 @@ import os
 import sys
 sys.path.insert(0, os.path.abspath('..'))
 # standard imports
-from compiler.ast import flatten
 import logging
 import glob
 import vigra
 from vigra import numpy as np
 import h5py
-from sklearn.neighbors import KDTree
 from hytra.pluginsystem.plugin_manager import TrackingPluginManager
 import hytra.util.axesconversion
+import hytra.core.transitiontrainingset
 
 logger = logging.getLogger('TransitionClassifier')
 logger.setLevel(logging.DEBUG)
@@ -26,137 +25,23 @@ def read_in_images(n1, n2, files, axes):
     logger.info("Found segmentation of shape {}".format(gt_labelimage[0].shape))
     return gt_labelimage
 
-# compute features from input data and return them
-def compute_features(raw_image, labeled_image, n1, n2, pluginManager, filepath):
-    # perhaps there is an elegant way to get into the RegionFeatureAccumulator.
-    # For now, the new feature are a separate vector
-    allFeat = []
-    for i in range(0, n2 - n1):
-        moreFeats, _ = pluginManager.applyObjectFeatureComputationPlugins(
-            len(raw_image.squeeze().shape)-1, raw_image[..., i, 0], labeled_image[i][..., 0], i, filepath)
-        frameFeatureItems = []
-        for f in moreFeats:
-            frameFeatureItems = frameFeatureItems + f.items()
-        allFeat.append(dict(frameFeatureItems))
-    return allFeat
-
 # read in 'n2-n1' of labels
 def read_positiveLabels(n1, n2, files):
     gt_moves = [vigra.impex.readHDF5(f, 'tracking/Moves') for f in files[n1+1:n2]]
     return gt_moves
 
-def getValidRegionCentersAndTheirIDs(featureDict, 
-                                     countFeatureName='Count', 
-                                     regionCenterName='RegionCenter'):
-    """
-    From the feature dictionary of a certain frame, 
-    find all objects with pixel count > 0, and return their
-    region centers and ids.
-    """
-    validObjectMask = featureDict[countFeatureName] > 0
-    validObjectMask[0] = False
-    
-    regionCenters = featureDict[regionCenterName][validObjectMask, :]
-    objectIds = list(np.where(validObjectMask)[0])
-    return regionCenters, objectIds
-
-def negativeLabels(features, positiveLabels):
-    """
-    Compute negative labels by finding 3 nearest neighbors in the next frame, and
-    filtering out those pairings that are part of the positiveLabels.
-
-    **Returns** a list of lists of pairs of indices, where there are as many inner lists
-    as there are pairs of consecutive frames ordered by time, 
-    e.g. for frame pairs (0,1), (1,2), ... (n-1,n).
-    Each pair in such a list then contains an index into the earlier frame of the pair, 
-    and one index into the later frame.
-    """
-    numFrames = len(features)
-    neg_lab = []
-    for i in range(1, numFrames):  # for all frames but the first
-        logger.debug("Frame {}\n".format(i))
-        frameNegLab = []
-        # build kdtree for frame i
-        centersAtI, objectIdsAtI = getValidRegionCentersAndTheirIDs(features[i])
-        kdt = KDTree(centersAtI, metric='euclidean')
-        # find k=3 nearest neighbors of each object of frame i-1 in frame i
-        centersAtIMinusOne, objectIdsAtIMinusOne = getValidRegionCentersAndTheirIDs(features[i - 1])
-        neighb = kdt.query(centersAtIMinusOne, k=3, return_distance=False)
-        for j in range(0, neighb.shape[0]):  # for all valid objects in frame i-1
-            logger.debug('looking at neighbors of {} at position {}'.format(
-                objectIdsAtIMinusOne[j], features[i - 1]['RegionCenter'][objectIdsAtIMinusOne[j], ...]))
-            for m in range(0, neighb.shape[1]):  # for all neighbors
-                pair = [objectIdsAtIMinusOne[j], objectIdsAtI[neighb[j][m]]]
-                if pair not in positiveLabels[i - 1].tolist():
-                    # add one because we've removed the first element when creating the KD tree
-                    frameNegLab.append(pair)
-                    logger.debug("Adding negative example: {} at position {}".format(
-                        pair, features[i]['RegionCenter'][objectIdsAtI[neighb[j][m]], ...]))
-                else:
-                    logger.debug("Discarding negative example {} which is a positive annotation".format(pair))
-        neg_lab.append(frameNegLab)
-
-    return neg_lab
-
-def find_features_without_NaNs(features):
-    """
-    Remove all features from the list of selected features which have NaNs
-    """
-    selectedFeatures = features[0].keys()
-    for featuresPerFrame in features:
-        for key, value in featuresPerFrame.iteritems():
-            if not isinstance(value, list) and (np.any(np.isnan(value)) or np.any(np.isinf(value))):
-                try:
-                    selectedFeatures.remove(key)
-                except:
-                    pass  # has already been deleted
-    forbidden = ["Global<Maximum >", "Global<Minimum >", 'Histogram', 'Polygon', 'Defect Center',
-                 'Center', 'Input Center', 'Weighted<RegionCenter>']
-    for f in forbidden:
-        if f in selectedFeatures:
-            selectedFeatures.remove(f)
-
-    selectedFeatures.sort()
-    return selectedFeatures
-
 class TransitionClassifier:
-    def __init__(self, selectedFeatures, numSamples=None):
+    def __init__(self, selectedFeatures):
         """
-        Set up a transition classifier class that makes it easy to add samples, train and store the RF.
+        Set up a transition classifier class that makes it easy to add the training data, train and store the RF.
         :param selectedFeatures: list of feature names that are supposed to be used
-        :param numSamples: if given, the data array for the samples is allocated with the proper dimensions,
-                            otherwise it needs to be resized whenever new samples are added.
         """
         self.rf = vigra.learning.RandomForest()
         self.mydata = None
         self.labels = []
         self.selectedFeatures = selectedFeatures
-        self._numSamples = numSamples
-        self._nextIdx = 0
         # TODO: check whether prediction here and in hypotheses graph script are the same!
 
-    def addSample(self, f1, f2, label, pluginManager):
-        # if self.labels == []:
-        self.labels.append(label)
-        # else:
-        #    self.labels = np.concatenate((np.array(self.labels),label)) # for adding batches of features
-        features = self.constructSampleFeatureVector(f1, f2, pluginManager)
-
-        if self._numSamples is None:
-            # use vstack
-            if self.mydata is None:
-                self.mydata = features
-            else:
-                self.mydata = np.vstack((self.mydata, features))
-        else:
-            # allocate full array once, then fill in row by row
-            if self.mydata is None:
-                self.mydata = np.zeros((self._numSamples, features.shape[0]))
-
-            assert(self._nextIdx < self._numSamples)
-            self.mydata[self._nextIdx, :] = features
-            self._nextIdx += 1
-
     def constructSampleFeatureVector(self, f1, f2, pluginManager):
         featVec = pluginManager.applyTransitionFeatureVectorConstructionPlugins(f1, f2, self.selectedFeatures)
         return np.array(featVec)
@@ -249,6 +134,9 @@ if __name__ == '__main__':
     parser.add_argument("--filepattern", dest='filepattern', type=str, nargs='+', default=['0*.h5'],
                         help="File pattern of the ground truth files. Can be also a list of paths, to train from more datasets.")
     parser.add_argument("--verbose", dest='verbose', action='store_true', default=False)
+    parser.add_argument('--disable-multiprocessing', dest='disableMultiprocessing', action='store_true',
+                        help='Do not use multiprocessing to speed up computation',
+                        default=False)
     parser.add_argument('--plugin-paths', dest='pluginPaths', type=str, nargs='+',
                         default=[os.path.abspath('../hytra/plugins')],
                         help='A list of paths to search for plugins for the tracking pipeline.')
@@ -265,9 +153,10 @@ if __name__ == '__main__':
     
     assert len(args.rawimage_filename) == len(args.rawimage_axes) == len(args.filepattern) == len(args.filepath) == len(args.groundtruth_axes)
     
-    # read raw image
-    numSamples = 0
-    mlabels = None
+    trackingPluginManager = TrackingPluginManager(verbose=args.verbose,
+                                                  pluginPaths=args.pluginPaths)
+    featuresPerDataset = []
+    positiveLabelsPerDataset = []
 
     for dataset in range(len(args.rawimage_filename)):
         rawimage_filename = args.rawimage_filename[dataset]
@@ -289,62 +178,39 @@ if __name__ == '__main__':
         if endFrame < 0:
             endFrame += len(files)
     
-        # compute features
-        trackingPluginManager = TrackingPluginManager(verbose=args.verbose, 
-                                                      pluginPaths=args.pluginPaths)
-        features = compute_features(rawimage,
-                                        read_in_images(initFrame, endFrame, files, args.groundtruth_axes[dataset]),
-                                        initFrame,
-                                        endFrame,
-                                        trackingPluginManager,
-                                        rawimage_filename)
+        # compute features of all frames in parallel
+        features = hytra.core.transitiontrainingset.computeFeatures(
+            rawimage,
+            read_in_images(initFrame, endFrame, files, args.groundtruth_axes[dataset]),
+            rawimage_filename,
+            args.pluginPaths,
+            useMultiprocessing=not args.disableMultiprocessing)
         logger.info('Done computing features from dataset {}'.format(dataset))
 
-        selectedFeatures = find_features_without_NaNs(features)
-        pos_labels = read_positiveLabels(initFrame, endFrame, files)
-        neg_labels = negativeLabels(features, pos_labels)
-        numSamples += 2 * sum([len(l) for l in pos_labels]) + sum([len(l) for l in neg_labels])
-        logger.info('Done extracting {} samples'.format(numSamples))
-        TC = TransitionClassifier(selectedFeatures, numSamples)
-        if dataset > 0:
-            TC.labels = mlabels # restore labels overwritten by constructor
+        featuresPerDataset.append(features)
+        positiveLabelsPerDataset.append(read_positiveLabels(initFrame, endFrame, files))
 
-        # compute featuresA for each object A from the feature matrix from Vigra
-        def compute_ObjFeatures(features, obj):
-            featureDict = {}
-            for key in features:
-                if key == "Global<Maximum >" or key == "Global<Minimum >":  # this ones have only one element
-                    featureDict[key] = features[key]
-                else:
-                    featureDict[key] = features[key][obj]
-            return featureDict
+    # only use the features that are valid in all datasets
+    selectedFeatures = hytra.core.transitiontrainingset.findFeaturesWithoutNaNs(
+        [f for features in featuresPerDataset for f in features])
 
+    samples = []
+    labels = []
+    for features, pos_labels in zip(featuresPerDataset, positiveLabelsPerDataset):
+        neg_labels = hytra.core.transitiontrainingset.findNegativeExamples(features, pos_labels)
+        datasetSamples, datasetLabels = hytra.core.transitiontrainingset.constructTrainingSet(
+            features, pos_labels, neg_labels, selectedFeatures, trackingPluginManager)
+        samples.append(datasetSamples)
+        labels.append(datasetLabels)
+    logger.info('Done extracting {} samples'.format(sum(len(l) for l in labels)))
 
-        for k in range(0, len(features) - 1):
-            for i in pos_labels[k]:
-                # positive
-                logger.debug("Adding positive sample {} from pos {} to {}".format(
-                    i, features[k]['RegionCenter'][i[0]], features[k + 1]['RegionCenter'][i[1]]))
-                TC.addSample(compute_ObjFeatures(
-                    features[k], i[0]), compute_ObjFeatures(features[k + 1], i[1]), 1, trackingPluginManager)
-                TC.addSample(compute_ObjFeatures(
-                    features[k + 1], i[1]), compute_ObjFeatures(features[k], i[0]), 1, trackingPluginManager)
-            
-            for i in neg_labels[k]:
-                # negative
-                logger.debug("Adding negative sample {} from pos {} to {}".format(i,
-                              features[k]['RegionCenter'][i[0]], features[k + 1]['RegionCenter'][i[1]]))
-                TC.addSample(compute_ObjFeatures(
-                    features[k], i[0]), compute_ObjFeatures(features[k + 1], i[1]), 0, trackingPluginManager)
-        mlabels =TC.labels
+    TC = TransitionClassifier(selectedFeatures)
+    TC.add_allData(np.vstack(samples), list(np.concatenate(labels)))
 
     logger.info('Done adding samples to RF. Beginning training...')
     TC.train()
     logger.info('Done training RF')
 
-    srcObject = compute_ObjFeatures(features[0], 1)
-    destObject = compute_ObjFeatures(features[1], 2)
-
     # delete file before writing
     if os.path.exists(args.outputFilename):
         os.remove(args.outputFilename)
@@ -1,7 +1,8 @@
 import logging
 
 from hytra.core.ilastik_project_options import IlastikProjectOptions
-from hytra.jst.conflictingsegmentsprobabilitygenerator import ConflictingSegmentsProbabilityGenerator
+from hytra.jst.conflictingsegmentsprobabilitygenerator import ConflictingSegmentsProbabilityGenerator, computeLabelOverlaps, \
+    createGlobalIdLookup, lookupGlobalIds
 from hytra.core.ilastikhypothesesgraph import IlastikHypothesesGraph
 from hytra.core.fieldofview import FieldOfView
 
@@ -23,6 +24,23 @@ def constructFov(shape, t0, t1, scale=[1, 1, 1]):
                       zscale * (zshape - 1))
     return fov
 
+def test_computeLabelOverlaps():
+    import numpy as np
+    labelImageA = np.array([[1, 1, 0], [2, 2, 2]], dtype=np.uint32)
+    labelImageB = np.array([[3, 0, 0], [3, 4, 4]], dtype=np.uint32)
+    labelsA, labelsB, counts = computeLabelOverlaps(labelImageA, labelImageB)
+    assert(list(labelsA) == [1, 2, 2])
+    assert(list(labelsB) == [3, 3, 4])
+    assert(list(counts) == [1, 1, 2])
+
+def test_globalIdLookup():
+    # globalIds 0-2 are from the first hypothesis (including the background), 3-4 from the second, 5 from the third
+    globalIdLookup = createGlobalIdLookup([0, 0, 0, 1, 1, 2], [0, 1, 2, 1, 2, 1], 3)
+    assert(lookupGlobalIds(globalIdLookup, 0, [1, 2]) == [1, 2])
+    assert(lookupGlobalIds(globalIdLookup, 1, [2, 1]) == [4, 3])
+    assert(lookupGlobalIds(globalIdLookup, 2, [1]) == [5])
+    assert(lookupGlobalIds(globalIdLookup, 1, [0]) == [-1])
+
 def test_twoSegmentations():
     # set up ConflictingSegmentsProbabilityGenerator
     ilpOptions = IlastikProjectOptions()
@@ -86,6 +104,9 @@ def test_twoSegmentations():
     assert(hypotheses_graph._graph.node[(1, 1)]['traxel'].conflictingTraxelIds == [2, 3])
     assert(hypotheses_graph._graph.node[(1, 2)]['traxel'].conflictingTraxelIds == [1])
     assert(hypotheses_graph._graph.node[(1, 3)]['traxel'].conflictingTraxelIds == [1])
+    assert(probabilityGenerator.overlapPixelCountsPerFrame[1][(1, 2)] > 0)
+    assert(probabilityGenerator.overlapPixelCountsPerFrame[1][(1, 2)] == probabilityGenerator.overlapPixelCountsPerFrame[1][(2, 1)])
+    assert((2, 3) not in probabilityGenerator.overlapPixelCountsPerFrame[1])
 
     # track, but check that the right exclusion constraints are present
     hypotheses_graph.insertEnergies()
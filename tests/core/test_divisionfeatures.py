@@ -0,0 +1,43 @@
+import numpy as np
+from hytra.core.divisionfeatures import FeatureManager
+
+def test_division_features_by_center_proximity():
+    featuresAtT = {'RegionCenter': np.array([[0, 0], [10, 10], [100, 100.]]),
+                   'Count': np.array([0, 50, 50.])}
+    featuresAtTPlus1 = {'RegionCenter': np.array([[0, 0], [5, 12], [15, 8], [200, 200], [11, 11]]),
+                        'Count': np.array([0, 20, 25, 30, 2.])}
+    fm = FeatureManager(ndim=2)
+    feats = fm.computeFeatures_at(featuresAtT, featuresAtTPlus1, None, ['ChildrenRatio_Count'])
+
+    # object 1 has two children candidates close by, the tiny object 4 is ignored, object 2 has none
+    assert(feats['ChildrenRatio_Count'].shape[0] == 3)
+    assert(np.isclose(feats['ChildrenRatio_Count'][1], 0.8))
+    assert(np.isclose(feats['SquaredDistances_0'][1], np.sqrt(29)))
+    assert(feats['SquaredDistances_0'][2] == fm.squared_distance_default)
+
+def test_division_features_of_overlapping_hypotheses():
+    featuresAtT = {'RegionCenter': np.array([[0, 0], [10, 10.]]),
+                   'Count': np.array([0, 50.])}
+    # objects 1 and 2 are the same cell in two segmentation hypotheses, object 3 is another cell
+    featuresAtTPlus1 = {'RegionCenter': np.array([[0, 0], [5, 12], [5, 13], [16, 8]]),
+                        'Count': np.array([0, 20, 22, 25.])}
+    overlapPixelCounts = {(1, 2): 18, (2, 1): 18}
+    fm = FeatureManager(ndim=2)
+
+    # a cell that does not divide, seen in both hypotheses, is not mistaken for two children
+    notDividing = dict((k, v[:3]) for k, v in featuresAtTPlus1.items())
+    feats = fm.computeFeatures_at(featuresAtT, notDividing, None, ['ChildrenRatio_Count'])
+    assert(feats['SquaredDistances_1'][1] != fm.squared_distance_default)
+    feats = fm.computeFeatures_at(featuresAtT, notDividing, None, ['ChildrenRatio_Count'],
+                                  overlapping_next=overlapPixelCounts)
+    assert(np.isclose(feats['SquaredDistances_0'][1], np.sqrt(29)))
+    assert(feats['SquaredDistances_1'][1] == fm.squared_distance_default)
+    assert(feats['ChildrenRatio_Count'][1] == 0)
+
+    # a dividing cell gets the closer hypothesis of the first child and the second child
+    feats = fm.computeFeatures_at(featuresAtT, featuresAtTPlus1, None, ['ChildrenRatio_Count'],
+                                  overlapping_next=overlapPixelCounts)
+    assert(np.isclose(feats['SquaredDistances_0'][1], np.sqrt(29)))
+    assert(np.isclose(feats['SquaredDistances_1'][1], np.sqrt(40)))
+    assert(feats['SquaredDistances_2'][1] == fm.squared_distance_default)
+    assert(np.isclose(feats['ChildrenRatio_Count'][1], 0.8))
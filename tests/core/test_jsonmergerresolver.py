@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import networkx as nx
+import pytest
+
+pytest.importorskip('vigra')
+
+from hytra.util.framecache import FrameCache
+from hytra.core.jsongraph import JsonTrackingGraph
+from hytra.core.jsonmergerresolver import JsonMergerResolver
+
+datasetDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mergerResolvingTestDataset')
+rawFilename = os.path.join(datasetDirectory, 'Raw.h5')
+labelImageFilename = os.path.join(datasetDirectory, 'tracking.ilp')
+labelImagePath = '/TrackingFeatureExtraction/LabelImage/0000/[[%d, 0, 0, 0, 0], [%d, %d, %d, %d, 1]]'
+timesteps = ['0', '1', '2', '3']
+
+def createResolver(outLabelImageFilename):
+    '''
+    Merger resolver for the merger resolving test dataset, where objects 1 and 2 of frame 0
+    merge into object 1 of frames 1 and 2, and split again in frame 3. The merger fits are stored
+    in the graph as `_fitAndRefineNodes` would, the merged objects get the new ids 3 and 4.
+    '''
+    trackingGraph = JsonTrackingGraph()
+    trackingGraph.result = {'detectionResults': [], 'linkingResults': [], 'divisionResults': None}
+    resolver = JsonMergerResolver(trackingGraph,
+                                  labelImageFilename,
+                                  labelImagePath,
+                                  outLabelImageFilename,
+                                  rawFilename,
+                                  'exported_data',
+                                  'txyzc',
+                                  pluginPaths=['hytra/plugins'],
+                                  useMultiprocessing=False)
+
+    resolver.detectionsPerTimestep = {'0': [1, 2], '1': [1], '2': [1], '3': [1, 2]}
+    resolver.mergersPerTimestep = {'0': {}, '1': {1: 2}, '2': {1: 2}, '3': {}}
+    resolver.unresolvedGraph = nx.DiGraph()
+    resolver.resolvedGraph = nx.DiGraph()
+    for t in range(4):
+        if t in [1, 2]:
+            labelImage = resolver._readLabelImage(t)
+            coordinates = resolver.mergerResolverPlugin.getObjectCoordinates(labelImage, 1)
+            resolver.unresolvedGraph.add_node((t, 1), fits=resolver.mergerResolverPlugin.resolveMergerForCoords(coordinates, 2),
+                                              newIds=[3, 4])
+            resolver.resolvedGraph.add_nodes_from([(t, 3), (t, 4)])
+        else:
+            resolver.resolvedGraph.add_nodes_from([(t, 1), (t, 2)])
+    # division nodes have no features
+    resolver.resolvedGraph.add_node((0, 'div-1'))
+    return resolver
+
+def computeObjectFeaturesOfWholeMovie(resolver, timesteps):
+    '''
+    The previous implementation of `JsonMergerResolver._computeObjectFeatures`, which loads the images
+    of all frames first and computes the features of each object on a mask of that object only.
+    '''
+    rawImages = {}
+    labelImages = {}
+    for t in timesteps:
+        rawImages[t] = resolver.imageProvider.getImageDataAtTimeFrame(resolver.raw_filename, resolver.raw_path, resolver.raw_axes, int(t))
+        labelImages[t] = resolver.imageProvider.getLabelImageForFrame(resolver.label_image_filename, resolver.label_image_path, int(t))
+        labelImages[t] = resolver.relabelMergers(labelImages[t], int(t))
+
+    imageShape = resolver.imageProvider.getImageShape(resolver.label_image_filename, resolver.label_image_path)
+    ndims = len([i for i in imageShape if i != 1])
+    objectFeatures = {}
+    for node in resolver.resolvedGraph.nodes():
+        intT, idx = node
+        if isinstance(idx, str) and idx.startswith('div-'):
+            continue
+
+        mask = labelImages[str(intT)].copy()
+        mask[mask != idx] = 0
+        mask[mask == idx] = 1
+
+        frameFeatureDicts, ignoreNames = resolver.pluginManager.applyObjectFeatureComputationPlugins(
+            ndims, rawImages[str(intT)], mask, intT, resolver.raw_filename)
+        frameFeatures = {}
+        for f in frameFeatureDicts:
+            frameFeatures.update(f)
+
+        objectFeatureDict = {}
+        for k, v in frameFeatures.items():
+            if k in ignoreNames:
+                continue
+            elif 'Polygon' in k:
+                objectFeatureDict[k] = v[1]
+            else:
+                objectFeatureDict[k] = v[1, ...]
+        objectFeatures[node] = objectFeatureDict
+
+    return objectFeatures
+
+def test_computeObjectFeatures_per_frame():
+    tmpDirectory = tempfile.mkdtemp()
+    try:
+        outLabelImageFilename = os.path.join(tmpDirectory, 'out-label-image.h5')
+        # the merger fits are not deterministic, so both versions use the same resolver
+        resolver = createResolver(outLabelImageFilename)
+        expectedFeatures = computeObjectFeaturesOfWholeMovie(resolver, timesteps)
+        assert(sorted(expectedFeatures.keys()) == [(0, 1), (0, 2), (1, 3), (1, 4), (2, 3), (2, 4), (3, 1), (3, 2)])
+
+        # with a frame cache, the cached label frames are read-only and must be copied before relabeling
+        for frameCache in [None, FrameCache(10**8)]:
+            resolver.imageProvider.setFrameCache(frameCache)
+            objectFeatures = resolver._computeObjectFeatures(timesteps)
+            assert(sorted(objectFeatures.keys()) == sorted(expectedFeatures.keys()))
+            for node, expected in expectedFeatures.items():
+                assert(sorted(objectFeatures[node].keys()) == sorted(expected.keys()))
+                for k, v in expected.items():
+                    assert(np.allclose(np.asarray(objectFeatures[node][k], dtype=np.float64),
+                                       np.asarray(v, dtype=np.float64), equal_nan=True))
+    finally:
+        shutil.rmtree(tmpDirectory)
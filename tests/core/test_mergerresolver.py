@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import networkx as nx
+from scipy.ndimage import find_objects
+from hytra.core.mergerresolver import MergerResolver, maxFlowMinCostTracking
+
+def test_maxFlowMinCostTracking():
+    # two objects in each of two frames, the straight links are cheap, the crossing ones expensive
+    arcs = np.array([[0, 2], [0, 3], [1, 2], [1, 3]])
+    arcCosts = np.array([-2.0, 1.0, 1.0, -2.0])
+    nodeFlow, arcFlow = maxFlowMinCostTracking(4, [0, 1], [2, 3], arcs, arcCosts)
+    assert(list(nodeFlow) == [1, 1, 1, 1])
+    assert(list(arcFlow) == [1, 0, 0, 1])
+
+def test_maxFlowMinCostTrackingPrefersMaxFlow():
+    # even though all links are expensive, the flow must be maximal
+    arcs = np.array([[0, 1], [1, 2]])
+    arcCosts = np.array([5.0, 5.0])
+    nodeFlow, arcFlow = maxFlowMinCostTracking(3, [0], [2], arcs, arcCosts)
+    assert(list(nodeFlow) == [1, 1, 1])
+    assert(list(arcFlow) == [1, 1])
+
+def test_maxFlowMinCostTrackingWithoutSink():
+    arcs = np.array([[0, 1]])
+    nodeFlow, arcFlow = maxFlowMinCostTracking(2, [0], [], arcs, np.array([-1.0]))
+    assert(list(nodeFlow) == [0, 0])
+    assert(list(arcFlow) == [0])
+
+class RegionMergerResolver(MergerResolver):
+    ''' merger resolver that reads the label images of a tiny test movie from an HDF5 file '''
+    labelImagePath = 'labels/[[%d, 0, 0, 0, 0], [%d, %d, %d, %d, 1]]'
+
+    def __init__(self, labelImages, labelImageFilename):
+        super(RegionMergerResolver, self).__init__(pluginPaths=['hytra/plugins'], useMultiprocessing=False)
+        self.labelImageFilename = labelImageFilename
+        with h5py.File(labelImageFilename, 'w') as h5file:
+            for t, labelImage in enumerate(labelImages):
+                h5file.create_dataset(self.labelImagePath % (t, t + 1, labelImage.shape[0], labelImage.shape[1], 1),
+                                      data=labelImage[np.newaxis, :, :, np.newaxis, np.newaxis])
+
+    def _getLabelImageSource(self):
+        return 'LocalImageLoader', self.labelImageFilename, self.labelImagePath
+
+def createMergerMovie():
+    ''' two objects (1, 2) merge into object 1 and split again, object 3 is a separate track '''
+    labelImages = np.zeros((3, 30, 20), dtype=np.uint32)
+    labelImages[0, 2:6, 2:6] = 1
+    labelImages[0, 12:16, 2:6] = 2
+    labelImages[1, 2:16, 2:6] = 1
+    labelImages[2, 2:6, 2:6] = 1
+    labelImages[2, 12:16, 2:6] = 2
+    labelImages[:, 24:28, 14:18] = 3
+    return labelImages
+
+def test_fitMergerComponents():
+    tmpDirectory = tempfile.mkdtemp()
+    try:
+        labelImages = createMergerMovie()
+        resolver = RegionMergerResolver(labelImages, os.path.join(tmpDirectory, 'labels.h5'))
+        resolver.unresolvedGraph = nx.DiGraph()
+        resolver.unresolvedGraph.add_edges_from([((0, 1), (1, 1)), ((0, 2), (1, 1)), ((1, 1), (2, 1)), ((1, 1), (2, 2)),
+                                                 ((0, 3), (1, 3)), ((1, 3), (2, 3))])
+        counts = {(1, 1): 2}
+        nodesToFit = {}
+        for node in resolver.unresolvedGraph.nodes():
+            boundingBoxes = find_objects(labelImages[node[0]])
+            nodesToFit[node] = (counts.get(node, 1), boundingBoxes[node[1] - 1])
+
+        components = resolver._findMergerComponents(nodesToFit)
+        assert(sorted(len(c) for c in components) == [3, 5])
+        for component in components:
+            # predecessors are fitted first, as they are needed for initialization
+            nodes = [nodeInfo[0] for nodeInfo in component]
+            for node, count, boundingBox, predecessors in component:
+                assert(count == counts.get(node, 1))
+                assert(boundingBox == nodesToFit[node][1])
+                assert(set(predecessors) == set(e[0] for e in resolver.unresolvedGraph.in_edges(node)))
+                for predecessor in predecessors:
+                    assert(nodes.index(predecessor) < nodes.index(node))
+
+        fitsPerNode = resolver._fitMergerComponents(components)
+        assert(set(fitsPerNode.keys()) == set(nodesToFit.keys()))
+        for node, (count, _) in nodesToFit.items():
+            assert(len(fitsPerNode[node]) == count)
+
+        # the merger is fitted with the fits of its predecessors as initialization
+        mergerCoordinates = np.transpose(np.nonzero(labelImages[1] == 1))
+        initializations = fitsPerNode[(0, 1)] + fitsPerNode[(0, 2)]
+        expectedFits = resolver.mergerResolverPlugin.resolveMergerForCoords(mergerCoordinates, 2, initializations)
+        for fit, expectedFit in zip(fitsPerNode[(1, 1)], expectedFits):
+            assert(np.allclose(fit[2], expectedFit[2]))
+        assert(np.allclose(fitsPerNode[(2, 3)][0][2], [25.5, 15.5]))
+    finally:
+        shutil.rmtree(tmpDirectory)
+
+class OldStyleMergerResolverPlugin(object):
+    ''' merger resolver plugin that does not know about bounding boxes yet, splitting objects at their center row '''
+    def updateLabelImage(self, labelImage, objectId, fits, newIds):
+        mask = labelImage == objectId
+        if not mask.any():
+            return
+        upperHalf = np.arange(labelImage.shape[0])[:, np.newaxis] <= np.nonzero(mask)[0].mean()
+        labelImage[mask & upperHalf] = newIds[0]
+        labelImage[mask & ~upperHalf] = newIds[1]
+
+class CropRecordingMergerResolverPlugin(OldStyleMergerResolverPlugin):
+    ''' merger resolver plugin that records the bounding boxes it gets '''
+    def __init__(self):
+        self.boundingBoxes = {}
+
+    def updateLabelImage(self, labelImage, objectId, fits, newIds, boundingBox=None):
+        self.boundingBoxes[objectId] = boundingBox
+        if boundingBox is None:
+            boundingBox = tuple(slice(0, s) for s in labelImage.shape)
+        OldStyleMergerResolverPlugin.updateLabelImage(self, labelImage[boundingBox], objectId, fits, newIds)
+
+def setUpRelabeling(resolver):
+    resolver.unresolvedGraph = nx.DiGraph()
+    resolver.unresolvedGraph.add_node((1, 1), fits=[None, None], newIds=[4, 5])
+    resolver.unresolvedGraph.add_node((1, 7), fits=[None, None], newIds=[8, 9])
+    # object 7 is a merger that does not occur in the label image
+    resolver.detectionsPerTimestep = {'1': [1, 3, 7]}
+    resolver.mergersPerTimestep = {'1': {1: 2, 7: 2}}
+
+def test_relabelMergers():
+    tmpDirectory = tempfile.mkdtemp()
+    try:
+        labelImages = createMergerMovie()
+        resolver = RegionMergerResolver(labelImages, os.path.join(tmpDirectory, 'labels.h5'))
+        setUpRelabeling(resolver)
+
+        # old plugins get the full label image
+        resolver.mergerResolverPlugin = OldStyleMergerResolverPlugin()
+        expected = resolver.relabelMergers(labelImages[1].copy(), 1)
+        assert(set(np.unique(expected)) == set([0, 3, 4, 5]))
+
+        # plugins that support it only look at the bounding box of each merger
+        resolver.mergerResolverPlugin = CropRecordingMergerResolverPlugin()
+        readOnlyLabelImage = labelImages[1].copy()
+        readOnlyLabelImage.flags.writeable = False
+        relabeled = resolver.relabelMergers(readOnlyLabelImage, 1)
+        assert((relabeled == expected).all())
+        assert((readOnlyLabelImage == labelImages[1]).all())
+        assert(resolver.mergerResolverPlugin.boundingBoxes[1] == (slice(2, 16), slice(2, 6)))
+        assert(resolver.mergerResolverPlugin.boundingBoxes[7] is None)
+
+        # the GMM plugin gives the same result within the bounding box as on the full image
+        resolver.mergerResolverPlugin = resolver.pluginManager.getMergerResolver()
+        coordinates = np.transpose(np.nonzero(labelImages[1] == 1))
+        resolver.unresolvedGraph.node[(1, 1)]['fits'] = resolver.mergerResolverPlugin.resolveMergerForCoords(coordinates, 2)
+        resolver.detectionsPerTimestep = {'1': [1, 3]}
+        expected = labelImages[1].copy()
+        resolver.mergerResolverPlugin.updateLabelImage(expected, 1, resolver.unresolvedGraph.node[(1, 1)]['fits'], [4, 5])
+        relabeled = resolver.relabelMergers(labelImages[1].copy(), 1)
+        assert((relabeled == expected).all())
+        assert(set(np.unique(relabeled)) == set([0, 3, 4, 5]))
+    finally:
+        shutil.rmtree(tmpDirectory)
@@ -4,3 +4,71 @@ def test_rf():
     rf = RandomForestClassifier('/CountClassification', 'tests/mergerResolvingTestDataset/tracking.ilp')
     assert(len(rf._randomForests) == 1)
     assert(len(rf.selectedFeatures) == 4)
+
+def test_rf_parallel_training():
+    import os
+    import shutil
+    import tempfile
+    import numpy as np
+    rng = np.random.RandomState(0)
+    features = np.vstack([rng.normal(0, 1, (50, 3)), rng.normal(5, 1, (50, 3))])
+    labels = np.hstack([np.zeros(50), np.ones(50)])
+
+    rf = RandomForestClassifier(selectedFeatures=['a', 'b', 'c'])
+    # by default a single forest is trained, such that the probabilities do not depend on the training machine
+    rf.train(features, labels, treeCount=10)
+    assert(len(rf._randomForests) == 1)
+    probabilities = rf.predictProbabilities(features)
+    assert(np.allclose(probabilities.sum(axis=1), 1.0))
+    assert(np.all(np.argmax(probabilities, axis=1) == labels))
+
+    rf.train(features, labels, numForests=3, treeCount=10)
+    assert(len(rf._randomForests) == 3)
+    assert(np.all(np.argmax(rf.predictProbabilities(features), axis=1) == labels))
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, 'classifier.h5')
+        rf.save(filename)
+        # saving again replaces all forests
+        rf.train(features, labels, numForests=2, treeCount=10)
+        rf.save(filename)
+        loaded = RandomForestClassifier('/', filename)
+        assert(len(loaded._randomForests) == 2)
+        assert(loaded.selectedFeatures == ['a', 'b', 'c'])
+        assert(np.allclose(loaded.predictProbabilities(features), rf.predictProbabilities(features)))
+    finally:
+        shutil.rmtree(tmpDir)
+
+def test_rf_feature_extraction():
+    import numpy as np
+    rf = RandomForestClassifier(selectedFeatures=['Count', 'RegionCenter', 'Covariance'])
+    featureDict = {'Count': np.arange(4, dtype=np.float32),
+                   'RegionCenter': np.arange(8).reshape(4, 2),
+                   'Covariance': np.arange(16).reshape(4, 2, 2),
+                   'Unused': np.zeros(4)}
+    features = rf.extractFeatureVector(featureDict)
+    assert(features.shape == (4, 7))
+    assert(list(features[1]) == [1, 2, 3, 4, 6, 5, 7])
+
+    # one object at a time, and several single objects at once
+    objectFeatureDicts = [dict((k, v[i].reshape(-1)) for k, v in featureDict.items() if k != 'Covariance')
+                          for i in range(4)]
+    rf = RandomForestClassifier(selectedFeatures=['Count', 'RegionCenter'])
+    assert(np.all(rf.extractFeatureVector(objectFeatureDicts[2], singleObject=True) == features[2:3, :3]))
+    assert(np.all(rf.extractFeatureMatrix(objectFeatureDicts) == features[:, :3]))
+
+def test_rf_pickling():
+    import pickle
+    import numpy as np
+    import hytra.core.random_forest_classifier
+    rf = RandomForestClassifier('/CountClassification', 'tests/mergerResolvingTestDataset/tracking.ilp')
+    features = np.random.RandomState(0).rand(5, rf._randomForests[0].featureCount()).astype(np.float32)
+
+    restored = pickle.loads(pickle.dumps(rf))
+    # the forests are only parsed again when they are needed, and then only once per process
+    assert(restored._randomForests is None)
+    assert(np.allclose(restored.predictProbabilities(features), rf.predictProbabilities(features)))
+    assert(len(hytra.core.random_forest_classifier._deserializedForests) > 0)
+    assert(restored.selectedFeatures == rf.selectedFeatures)
+    assert(pickle.loads(pickle.dumps(restored))._getRandomForests() is restored._randomForests)
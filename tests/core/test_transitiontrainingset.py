@@ -0,0 +1,48 @@
+import numpy as np
+from hytra.core.transitiontrainingset import findNegativeExamples, findFeaturesWithoutNaNs
+
+def createFrameFeatures(regionCenters):
+    # object 0 is the background, object 2 is not present in the frame
+    regionCenters = np.vstack([np.zeros((1, 2)), np.array(regionCenters, dtype=np.float32)])
+    count = np.ones(len(regionCenters))
+    count[0] = 0
+    if len(regionCenters) > 2:
+        count[2] = 0
+    return {'Count': count, 'RegionCenter': regionCenters, 'Mean': np.ones(len(regionCenters))}
+
+def test_negative_examples():
+    features = [createFrameFeatures([[0, 0], [50, 50], [10, 10], [20, 0]]),
+                createFrameFeatures([[1, 0], [80, 80], [11, 10], [20, 1], [0, 30]])]
+    positiveLabels = [np.array([[1, 1], [3, 3]])]
+
+    negativeLabels = findNegativeExamples(features, positiveLabels, numNeighbors=2)
+    assert(len(negativeLabels) == 1)
+    negatives = set(tuple(p) for p in negativeLabels[0].tolist())
+
+    # no positive pair is a negative example, and all candidates are valid objects
+    for pair in negatives:
+        assert(pair not in [(1, 1), (3, 3)])
+        assert(features[0]['Count'][pair[0]] > 0)
+        assert(features[1]['Count'][pair[1]] > 0)
+
+    # compare with the nearest neighbors found by brute force
+    validA = [1, 3, 4]
+    validB = [1, 3, 4, 5]
+    expected = set()
+    for a in validA:
+        distances = [np.linalg.norm(features[0]['RegionCenter'][a] - features[1]['RegionCenter'][b]) for b in validB]
+        for idx in np.argsort(distances)[:2]:
+            if (a, validB[idx]) not in [(1, 1), (3, 3)]:
+                expected.add((a, validB[idx]))
+    assert(negatives == expected)
+
+def test_negative_examples_few_objects():
+    features = [createFrameFeatures([[0, 0]]), createFrameFeatures([[1, 0]])]
+    negativeLabels = findNegativeExamples(features, [np.zeros((0, 2))])
+    assert(negativeLabels[0].tolist() == [[1, 1]])
+
+def test_features_without_nans():
+    features = [createFrameFeatures([[0, 0], [1, 1]]), createFrameFeatures([[0, 0], [1, 1]])]
+    features[1]['Mean'][1] = np.nan
+    features[0]['Polygon'] = [[[0, 0]], [[1, 1]]]
+    assert(findFeaturesWithoutNaNs(features) == ['Count', 'RegionCenter'])
@@ -0,0 +1,126 @@
+import json
+import threading
+import numpy as np
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+
+uuid = 'abc123'
+shape = (20, 30, 1)
+timeRange = (0, 3)
+rng = np.random.RandomState(42)
+volumes = {}
+for t in range(timeRange[1]):
+    volumes['raw-{}'.format(t)] = rng.randint(0, 255, shape).astype(np.uint8)
+    volumes['seg-{}'.format(t)] = rng.randint(0, 10, shape).astype(np.uint64)
+
+class MockDvidHandler(BaseHTTPRequestHandler):
+    ''' answers the few requests of DVID's HTTP API that the DvidImageLoader needs '''
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        parts = self.path.strip('/').split('/')
+        if parts[:5] == ['api', 'node', uuid, 'config', 'key'] and parts[5] == 'imageInfo':
+            body = json.dumps({'shape': shape, 'time_range': timeRange}).encode('utf-8')
+        elif parts[:3] == ['api', 'node', uuid] and parts[4:6] == ['raw', '0_1_2']:
+            # sizes and offsets are given in x-first order
+            size = [int(s) for s in reversed(parts[6].split('_'))]
+            offset = [int(o) for o in reversed(parts[7].split('_'))]
+            roi = tuple(slice(o, o + s) for o, s in zip(offset, size))
+            body = np.ascontiguousarray(volumes[parts[3]][roi]).astype(volumes[parts[3]].dtype.newbyteorder('<')).tobytes()
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MockDvidServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def getDvidImageLoader():
+    pluginManager = TrackingPluginManager(pluginPaths=['hytra/plugins'])
+    pluginManager.setImageProvider('DvidImageLoader')
+    return pluginManager.getImageProvider()
+
+def startServer():
+    MockDvidHandler.requests = []
+    server = MockDvidServer(('127.0.0.1', 0), MockDvidHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, '127.0.0.1:{}'.format(server.server_address[1])
+
+def test_dvid_loader_frames_and_metadata():
+    server, address = startServer()
+    try:
+        loader = getDvidImageLoader()
+        assert(list(loader.getImageShape(address, uuid)) == list(shape))
+        assert(list(loader.getTimeRange(address, uuid)) == list(timeRange))
+        for t in range(timeRange[1]):
+            labelImage = loader.getLabelImageForFrame(address, uuid, t)
+            assert(labelImage.dtype == np.uint32)
+            assert(np.all(labelImage == volumes['seg-{}'.format(t)]))
+            assert(np.all(loader.getImageDataAtTimeFrame(address, uuid, 'xyz', t) == volumes['raw-{}'.format(t)]))
+
+        # the metadata is only downloaded once, and nothing is prefetched by default
+        assert(len([r for r in MockDvidHandler.requests if 'imageInfo' in r]) == 1)
+        assert(len(MockDvidHandler.requests) == 1 + 2 * timeRange[1])
+
+        region = loader.getLabelImageRegion(address, uuid, 1, (slice(2, 5), slice(10, 20)))
+        assert(np.all(region == volumes['seg-1'][2:5, 10:20]))
+        loader.deactivate()
+    finally:
+        server.shutdown()
+
+def test_dvid_loader_parallel_slabs_and_prefetch():
+    server, address = startServer()
+    try:
+        loader = getDvidImageLoader()
+        loader.prefetchNextFrame = True
+        loader.minSlabBytes = 100
+        labelImage = loader.getLabelImageForFrame(address, uuid, 0)
+        assert(np.all(labelImage == volumes['seg-0']))
+        # the frame was fetched in several slabs
+        assert(len([r for r in MockDvidHandler.requests if '/seg-0/' in r]) == loader.numFetchThreads)
+
+        # the next frame has been prefetched, and is not requested again
+        labelImage = loader.getLabelImageForFrame(address, uuid, 1)
+        assert(np.all(labelImage == volumes['seg-1']))
+        assert(len([r for r in MockDvidHandler.requests if '/seg-1/' in r]) == 1)
+        loader.deactivate()
+    finally:
+        server.shutdown()
+
+def test_dvid_loader_state_is_shared_by_jobs():
+    server, address = startServer()
+    try:
+        # like the feature computation jobs, every frame is loaded by a new plugin manager
+        for t in range(timeRange[1]):
+            loader = getDvidImageLoader()
+            loader.prefetchNextFrame = True
+            assert(np.all(loader.getLabelImageForFrame(address, uuid, t) == volumes['seg-{}'.format(t)]))
+            assert(np.all(loader.getImageDataAtTimeFrame(address, uuid, 'xyz', t) == volumes['raw-{}'.format(t)]))
+
+        # the metadata is downloaded once, and the prefetched frames are used by the next job
+        assert(len([r for r in MockDvidHandler.requests if 'imageInfo' in r]) == 1)
+        for t in range(timeRange[1]):
+            for name in ['seg', 'raw']:
+                assert(len([r for r in MockDvidHandler.requests if '/{}-{}/'.format(name, t) in r]) == 1)
+        loader.deactivate()
+    finally:
+        server.shutdown()
@@ -0,0 +1,87 @@
+import numpy as np
+from sklearn import mixture
+from hytra.plugins.merger_resolver.gmm_merger_resolver import GMMMergerResolver
+
+def createBlobs(centers, numPixels=50, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.vstack([rng.randn(numPixels, 2) + np.array(c, dtype=np.float64) for c in centers])
+
+def sortedMeans(fits):
+    means = np.array([f[2] for f in fits])
+    return means[np.lexsort(means.T[::-1])]
+
+def test_gmm_fallback_relabeling():
+    resolver = GMMMergerResolver()
+    labelImage = np.zeros((5, 5), dtype=np.uint32)
+    labelImage[2, 3] = 7
+
+    # a single pixel cannot be split into two objects, both fallback fits are placed at that pixel
+    fits = resolver.resolveMergerForCoords(resolver.getObjectCoordinates(labelImage, 7), 2)
+    assert(len(fits) == 2)
+    resolver.updateLabelImage(labelImage, 7, fits, [10, 11])
+    assert(labelImage[2, 3] == 10)
+    assert(np.count_nonzero(labelImage) == 1)
+
+    # same within a bounding box
+    labelImage[2, 3] = 7
+    resolver.updateLabelImage(labelImage, 7, fits, [10, 11], boundingBox=(slice(1, 4), slice(2, 5)))
+    assert(labelImage[2, 3] == 10)
+
+def test_gmm_warm_start():
+    resolver = GMMMergerResolver()
+    coordinates = createBlobs([[0, 0], [20, 0]])
+    initializations = [(0.5, np.ones(2), np.array([0.5, 0.5])),
+                       (0.5, np.ones(2), np.array([100.0, 100.0])),
+                       (0.5, np.ones(2), np.array([19.0, 1.0]))]
+
+    # the two initializations closest to the object center are used, closest first
+    weights, covariances, means = resolver._selectInitializations(coordinates, 2, initializations)
+    assert(np.allclose(weights, [0.5, 0.5]))
+    assert(np.allclose(means, [[19.0, 1.0], [0.5, 0.5]]))
+    assert(resolver._selectInitializations(coordinates, 4, initializations) is None)
+
+    gmm = resolver.initGMM(2, initializations, coordinates)
+    assert(np.allclose(gmm.means_init, means))
+
+    fits = resolver.resolveMergerForCoords(coordinates, 2, initializations)
+    assert(np.allclose([f[2] for f in fits], [[20, 0], [0, 0]], atol=0.5))
+
+def test_gmm_retry_without_convergence():
+    resolver = GMMMergerResolver()
+    resolver.maxIterations = 1
+    coordinates = createBlobs([[0, 0], [20, 0]])
+
+    # the warm start is far off and cannot converge in one iteration, the k-means initialized retry finds the blobs
+    initializations = [(0.5, np.ones(2), np.array([9.0, 0.0])), (0.5, np.ones(2), np.array([11.0, 0.0]))]
+    fits = resolver.resolveMergerForCoords(coordinates, 2, initializations)
+    assert(len(fits) == 2)
+    assert(np.allclose(sortedMeans(fits), [[0, 0], [20, 0]], atol=0.5))
+
+    # batched fits that did not converge are fitted again individually
+    resolver.batchMaxNumPixels = 1000
+    fits = resolver.resolveMergersForCoords([coordinates], [2], [initializations])
+    assert(np.allclose(sortedMeans(fits[0]), [[0, 0], [20, 0]], atol=0.5))
+
+def test_gmm_predict():
+    resolver = GMMMergerResolver()
+    coordinates = createBlobs([[0, 0], [6, 0], [3, 5]])
+    gmm = resolver.initGMM(3)
+    gmm.fit(coordinates)
+    fits = resolver.getObjectInitializationList(gmm)
+    assert((resolver._predict(coordinates, fits) == gmm.predict(coordinates)).all())
+
+def test_gmm_batch_matches_single():
+    resolver = GMMMergerResolver()
+    resolver.batchMaxNumPixels = 1000
+    coordinatesList = [createBlobs([[0, 0], [20, 0]], seed=1),
+                       createBlobs([[0, 0], [0, 15], [15, 15]], numPixels=30, seed=2),
+                       createBlobs([[5, 5]], numPixels=20, seed=3)]
+    mergerCounts = [2, 3, 1]
+    initializationsList = [[], [], []]
+
+    batchedFits = resolver.resolveMergersForCoords(coordinatesList, mergerCounts, initializationsList)
+    for coordinates, mergerCount, fits in zip(coordinatesList, mergerCounts, batchedFits):
+        singleFits = resolver.resolveMergerForCoords(coordinates, mergerCount)
+        assert(len(fits) == mergerCount)
+        assert(np.allclose(sortedMeans(fits), sortedMeans(singleFits), atol=1e-2))
+        assert(np.allclose(sum(f[0] for f in fits), 1.0))
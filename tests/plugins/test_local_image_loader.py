@@ -0,0 +1,173 @@
+import os
+import pickle
+import shutil
+import tempfile
+import h5py
+import numpy as np
+from hytra.util.framecache import FrameCache
+from hytra.plugins.image_provider.local_image_loader import LocalImageLoader
+from hytra.pluginsystem.image_provider_plugin import LabelImageRegionReader
+
+labelImagePath = 'labels/[[%d, 0, 0, 0, 0], [%d, %d, %d, %d, 1]]'
+
+def createLabelImageFile(filename, labelImages):
+    ''' store label images with axes `txyzc` in the ilastik layout of one dataset per frame '''
+    with h5py.File(filename, 'w') as h5file:
+        for t, labelImage in enumerate(labelImages):
+            shape = labelImage.shape[1:4]
+            h5file.create_dataset(labelImagePath % (t, t + 1, shape[0], shape[1], shape[2]), data=labelImage)
+
+def test_label_image_read_direct():
+    directory = tempfile.mkdtemp()
+    try:
+        # stored as uint16 with a singleton y axis
+        rng = np.random.RandomState(0)
+        labelImages = [rng.randint(0, 1000, (1, 20, 1, 30, 1)).astype(np.uint16) for _ in range(2)]
+        filename = os.path.join(directory, 'labels.h5')
+        createLabelImageFile(filename, labelImages)
+        loader = LocalImageLoader()
+
+        labelImage = loader.getLabelImageForFrame(filename, labelImagePath, 0)
+        assert(labelImage.dtype == np.uint32)
+        assert(labelImage.shape == (20, 30))
+        assert((labelImage == labelImages[0][0, :, 0, :, 0]).all())
+
+        # the buffer is reused for the next frame
+        out = loader.getLabelImageForFrame(filename, labelImagePath, 1, out=labelImage)
+        assert(out is labelImage)
+        assert((out == labelImages[1][0, :, 0, :, 0]).all())
+
+        # buffers of the wrong shape, dtype or memory layout are not used
+        for buffer in [np.zeros((30, 20), dtype=np.uint32), np.zeros((20, 30), dtype=np.uint16),
+                       np.zeros((20, 30), dtype=np.uint32, order='F')]:
+            result = loader.getLabelImageForFrame(filename, labelImagePath, 0, out=buffer)
+            assert(result is not buffer)
+            assert(result.dtype == np.uint32)
+            assert((result == labelImages[0][0, :, 0, :, 0]).all())
+            assert((buffer == 0).all())
+
+        # cached frames never share memory with the caller's buffer
+        loader.setFrameCache(FrameCache(10**6))
+        buffer = np.zeros((20, 30), dtype=np.uint32)
+        result = loader.getLabelImageForFrame(filename, labelImagePath, 1, out=buffer)
+        assert(result is not buffer)
+        assert(not result.flags.writeable)
+        assert((result == labelImages[1][0, :, 0, :, 0]).all())
+        loader.closeFiles()
+    finally:
+        shutil.rmtree(directory)
+
+def test_open_files_lru():
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = [os.path.join(directory, 'labels{}.h5'.format(i)) for i in range(3)]
+        for filename in filenames:
+            createLabelImageFile(filename, [np.ones((1, 5, 6, 1, 1), dtype=np.uint32)])
+        loader = LocalImageLoader()
+        loader.maxNumOpenFiles = 2
+
+        loader.getLabelImageForFrame(filenames[0], labelImagePath, 0)
+        firstFile = loader._openFiles[filenames[0]]
+        loader.getLabelImageForFrame(filenames[1], labelImagePath, 0)
+        secondFile = loader._openFiles[filenames[1]]
+        # using the first file again makes the second one the least recently used
+        loader.getLabelImageForFrame(filenames[0], labelImagePath, 0)
+        assert(loader._openFiles[filenames[0]] is firstFile)
+        loader.getLabelImageForFrame(filenames[2], labelImagePath, 0)
+        assert(list(loader._openFiles.keys()) == [filenames[0], filenames[2]])
+        assert(not secondFile.id.valid)
+        assert(firstFile.id.valid)
+        loader.closeFiles()
+        assert(len(loader._openFiles) == 0)
+        assert(not firstFile.id.valid)
+    finally:
+        shutil.rmtree(directory)
+
+def test_open_files_after_pickling_and_forking():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'labels.h5')
+        createLabelImageFile(filename, [np.ones((1, 5, 6, 1, 1), dtype=np.uint32)])
+        loader = LocalImageLoader()
+        loader.getImageShape(filename, labelImagePath)
+        openFile = loader._openFiles[filename]
+
+        # open files are not pickled, but the cached metadata is
+        unpickled = pickle.loads(pickle.dumps(loader))
+        assert(len(unpickled._openFiles) == 0)
+        assert((filename, labelImagePath) in unpickled._shapeCache)
+        assert((unpickled.getLabelImageForFrame(filename, labelImagePath, 0) == 1).all())
+        assert(unpickled._openFiles[filename] is not openFile)
+        unpickled.closeFiles()
+        assert(openFile.id.valid)
+
+        # pretend to be a forked process, which must neither use nor close the handles of its parent
+        loader._pid = os.getpid() + 1
+        assert((loader.getLabelImageForFrame(filename, labelImagePath, 0) == 1).all())
+        assert(loader._openFiles[filename] is not openFile)
+        assert(openFile.id.valid)
+        loader.closeFiles()
+        openFile.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_export_invalidates_metadata():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'labels.h5')
+        createLabelImageFile(filename, [np.ones((1, 5, 6, 1, 1), dtype=np.uint32)])
+        loader = LocalImageLoader()
+        assert(tuple(loader.getImageShape(filename, labelImagePath)) == (5, 6, 1))
+        assert(loader.getTimeRange(filename, labelImagePath) == (0, 1))
+
+        exported = np.arange(30, dtype=np.uint32).reshape(5, 6)
+        loader.exportLabelImage(exported, 1, filename, labelImagePath)
+        assert((filename, labelImagePath) not in loader._shapeCache)
+        assert(filename not in loader._openFiles)
+        assert(loader.getTimeRange(filename, labelImagePath) == (0, 2))
+        assert((loader.getLabelImageForFrame(filename, labelImagePath, 1) == exported).all())
+        loader.closeFiles()
+    finally:
+        shutil.rmtree(directory)
+
+def test_region_reads():
+    directory = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(1)
+        filename = os.path.join(directory, 'data.h5')
+        with h5py.File(filename, 'w') as h5file:
+            # time axis in the middle and two channels, or a singleton y axis
+            h5file.create_dataset('xyztc', data=rng.randint(0, 255, (20, 30, 1, 3, 2)).astype(np.uint8), chunks=(7, 8, 1, 1, 1))
+            h5file.create_dataset('txyzc', data=rng.randint(0, 255, (3, 20, 1, 30, 1)).astype(np.uint8), chunks=(1, 7, 1, 8, 1))
+        labelImages = [rng.randint(0, 10, (1, 20, 1, 30, 1)).astype(np.uint16) for _ in range(3)]
+        labelFilename = os.path.join(directory, 'labels.h5')
+        createLabelImageFile(labelFilename, labelImages)
+
+        # also one pixel wide regions along each non-singleton axis
+        rois = [(slice(3, 17), slice(5, 29)), (slice(4, 5), slice(0, 30)), (slice(0, 20), slice(9, 10)), (slice(2, 3),)]
+        for useFrameCache in [False, True]:
+            loader = LocalImageLoader()
+            if useFrameCache:
+                loader.setFrameCache(FrameCache(10**6))
+            for t in range(3):
+                for axes in ['xyztc', 'txyzc']:
+                    frame = loader.getImageDataAtTimeFrame(filename, axes, axes, t)
+                    assert(frame.shape[:2] == (20, 30))
+                    for roi in rois:
+                        region = loader.getImageDataRegion(filename, axes, axes, t, roi)
+                        assert(region.shape == frame[roi].shape)
+                        assert((region == frame[roi]).all())
+
+                labelImage = loader.getLabelImageForFrame(labelFilename, labelImagePath, t)
+                reader = LabelImageRegionReader(loader, labelFilename, labelImagePath, t)
+                assert(reader.shape == labelImage.shape)
+                for roi in rois:
+                    region = loader.getLabelImageRegion(labelFilename, labelImagePath, t, roi)
+                    assert(region.dtype == np.uint32)
+                    assert(region.shape == labelImage[roi].shape)
+                    assert((region == labelImage[roi]).all())
+                    assert((reader[roi] == labelImage[roi]).all())
+                assert((reader[4:9] == labelImage[4:9]).all())
+            loader.closeFiles()
+    finally:
+        shutil.rmtree(directory)
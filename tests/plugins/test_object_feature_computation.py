@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+from hytra.pluginsystem.object_feature_computation_plugin import ObjectFeaturePrerequisites, ObjectFeatureComputationPlugin
+
+pluginTemplate = '''
+from hytra.pluginsystem import object_feature_computation_plugin
+import numpy as np
+
+class {name}(object_feature_computation_plugin.ObjectFeatureComputationPlugin):
+    prerequisites = ['labelImage']
+    acceptedLabelImageDtypes = ['{dtype}']
+    omittedFeatures = ['{name}Ignored']
+    threadSafe = True
+
+    def computeFeaturesWithPrerequisites(self, rawImage, labelImage, frameNumber, rawFilename, prerequisites):
+        counts = np.bincount(prerequisites['labelImage'].ravel())
+        counts = counts.astype(prerequisites['labelImage'].dtype)
+        counts[0] = 0
+        return {{'{name}Count': counts, '{name}Ignored': np.zeros(len(counts)), 'Shared': np.array([1])}}
+'''
+
+def createPlugins(directory, names, dtypes):
+    for name, dtype in zip(names, dtypes):
+        with open(os.path.join(directory, name + '.py'), 'w') as f:
+            f.write(pluginTemplate.format(name=name, dtype=dtype))
+        with open(os.path.join(directory, name + '.yapsy-plugin'), 'w') as f:
+            f.write('[Core]\nName = {}\nModule = {}\n'.format(name, name))
+
+def test_object_feature_prerequisites():
+    labelImage = np.zeros((10, 10, 1), dtype=np.uint16)
+    labelImage[1:3, 2:5] = 1
+    labelImage[5:9, 5:6] = 3
+    prerequisites = ObjectFeaturePrerequisites(np.ones((10, 10, 1)), labelImage, ['float32'], ['uint32'])
+    assert(prerequisites['rawImage'].dtype == np.float32)
+
+    # the label image is computed independently of the raw image
+    with prerequisites._locks[('rawImage', np.dtype(np.float32))]:
+        assert(prerequisites['labelImage'].shape == (10, 10))
+        assert(prerequisites['labelImage'].dtype == np.uint32)
+        assert(prerequisites['labelImage'] is prerequisites['labelImage'])
+        assert(prerequisites['labelImage'].sum() == 6 + 3 * 4)
+    try:
+        prerequisites['boundingBoxes']
+        assert(False)
+    except KeyError:
+        pass
+
+def test_fused_object_feature_computation():
+    directory = tempfile.mkdtemp()
+    try:
+        createPlugins(directory, ['FirstFeatures', 'SecondFeatures'], ['uint16', 'uint32'])
+        pluginManager = TrackingPluginManager(pluginPaths=[directory])
+        labelImage = np.zeros((10, 10), dtype=np.uint32)
+        labelImage[1:3, 2:5] = 1
+        labelImage[5:9, 5:6] = 2
+
+        for numThreads in [1, 2]:
+            pluginManager.numObjectFeatureThreads = numThreads
+            features, ignoreNames = pluginManager.applyObjectFeatureComputationPlugins(
+                2, labelImage, labelImage, 0, 'raw.h5')
+            assert(len(features) == 2)
+            assert(set(ignoreNames) == set(['FirstFeaturesIgnored', 'SecondFeaturesIgnored']))
+
+            frameFeatures = pluginManager.computeObjectFeatures(2, labelImage, labelImage, 0, 'raw.h5')
+            assert(set(frameFeatures.keys()) == set(['FirstFeaturesCount', 'SecondFeaturesCount', 'Shared']))
+            assert(list(frameFeatures['FirstFeaturesCount']) == [0, 6, 4])
+            # the prerequisites of each plugin are in a dtype that it accepts
+            assert(frameFeatures['FirstFeaturesCount'].dtype == np.uint16)
+            assert(frameFeatures['SecondFeaturesCount'].dtype == np.uint32)
+    finally:
+        shutil.rmtree(directory)
+
+def test_image_dtype_conversion():
+    image = np.arange(12, dtype=np.uint16).reshape(3, 1, 4)
+    prerequisites = ObjectFeaturePrerequisites(image, image)
+
+    # images of an accepted dtype are passed on as they are
+    assert(prerequisites.getImage('rawImage', None) is image)
+    assert(prerequisites.getImage('rawImage', ['float32', 'uint16']) is image)
+
+    # otherwise the image is converted to the first accepted dtype, only once for all plugins
+    converted = prerequisites.getImage('rawImage', ['float32', 'uint32'])
+    assert(converted.dtype == np.float32)
+    assert(converted.shape == image.shape)
+    assert((converted == image).all())
+    assert(prerequisites.getImage('rawImage', [np.float32]) is converted)
+    assert(prerequisites.getImage('labelImage', ['uint32']).dtype == np.uint32)
+
+    # the prerequisites of a plugin are squeezed and converted to the dtypes the plugin accepts, sharing the conversion
+    plugin = ObjectFeatureComputationPlugin()
+    plugin.acceptedRawImageDtypes = ['float32']
+    pluginPrerequisites = prerequisites.forPlugin(plugin)
+    assert(pluginPrerequisites['rawImage'].shape == (3, 4))
+    assert(pluginPrerequisites['rawImage'].base is converted)
+    assert(pluginPrerequisites['labelImage'].dtype == np.uint32)
+    assert(prerequisites['labelImage'].dtype == np.uint16)
@@ -0,0 +1,81 @@
+import os
+import sys
+import shutil
+import tempfile
+import hytra.pluginsystem.plugin_manager
+from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+
+def test_plugin_discovery_once_per_process():
+    hytra.pluginsystem.plugin_manager._pluginIndices.clear()
+    pluginManager = TrackingPluginManager(pluginPaths=['hytra/plugins'])
+    otherPluginManager = TrackingPluginManager(pluginPaths=['hytra/plugins'], turnOffFeatures=['LocalImageLoader'])
+    assert(otherPluginManager._pluginIndex is pluginManager._pluginIndex)
+
+    featureSerializer = otherPluginManager.getFeatureSerializer()
+    assert(featureSerializer is otherPluginManager.getFeatureSerializer())
+    assert(featureSerializer is not pluginManager.getFeatureSerializer())
+    try:
+        otherPluginManager.getImageProvider()
+        assert(False)
+    except KeyError:
+        pass
+
+pluginWithDependency = '''
+from hytra.pluginsystem import transition_feature_vector_construction_plugin
+import {dependency}
+
+class {name}(transition_feature_vector_construction_plugin.TransitionFeatureVectorConstructionPlugin):
+    def constructFeatureVector(self, featureDictObjectA, featureDictObjectB, selectedFeatures):
+        return [{dependency}.value]
+'''
+
+def pretendNewProcess():
+    ''' forget everything about plugins that was found in this process '''
+    hytra.pluginsystem.plugin_manager._pluginIndices.clear()
+    hytra.pluginsystem.plugin_manager._pluginModules.clear()
+    hytra.pluginsystem.plugin_manager._checkedFailedPluginPaths.clear()
+
+def createPluginWithDependency(pluginDirectory, name, dependency):
+    with open(os.path.join(pluginDirectory, name + '.py'), 'w') as f:
+        f.write(pluginWithDependency.format(name=name, dependency=dependency))
+    with open(os.path.join(pluginDirectory, name + '.yapsy-plugin'), 'w') as f:
+        f.write('[Core]\nName = {}\nModule = {}\n'.format(name, name))
+
+def installDependency(dependencyDirectory, dependency, value):
+    with open(os.path.join(dependencyDirectory, dependency + '.py'), 'w') as f:
+        f.write('value = {}\n'.format(value))
+    sys.modules.pop(dependency, None)
+
+def test_plugin_discovery_retries_failed_plugins():
+    directory = tempfile.mkdtemp()
+    pluginDirectory = os.path.join(directory, 'plugins')
+    dependencyDirectory = os.path.join(directory, 'dependencies')
+    os.makedirs(pluginDirectory)
+    os.makedirs(dependencyDirectory)
+    sys.path.insert(0, dependencyDirectory)
+    try:
+        createPluginWithDependency(pluginDirectory, 'PluginWithDependency', 'hytra_test_dependency_a')
+        pretendNewProcess()
+        pluginManager = TrackingPluginManager(pluginPaths=[pluginDirectory])
+        assert([d['category'] for d in pluginManager._pluginIndex] == [None])
+
+        # after installing the dependency, the plugin is found by the next plugin manager of this process
+        installDependency(dependencyDirectory, 'hytra_test_dependency_a', 42)
+        pluginManager = TrackingPluginManager(pluginPaths=[pluginDirectory])
+        assert(pluginManager.applyTransitionFeatureVectorConstructionPlugins({}, {}, []) == [42])
+        assert([d['category'] for d in pluginManager._pluginIndex] == ['TransitionFeatureVectorConstruction'])
+
+        # a plugin that still cannot be imported is only tried once more
+        createPluginWithDependency(pluginDirectory, 'PluginWithMissingDependency', 'hytra_test_dependency_b')
+        pretendNewProcess()
+        pluginManager = TrackingPluginManager(pluginPaths=[pluginDirectory])
+        assert(pluginManager.applyTransitionFeatureVectorConstructionPlugins({}, {}, []) == [42])
+        assert(hytra.pluginsystem.plugin_manager._checkedFailedPluginPaths ==
+               set([os.path.abspath(os.path.join(pluginDirectory, 'PluginWithMissingDependency'))]))
+        index = pluginManager._pluginIndex
+        assert(pluginManager.applyTransitionFeatureVectorConstructionPlugins({}, {}, []) == [42])
+        assert(pluginManager._pluginIndex is index)
+    finally:
+        sys.path.remove(dependencyDirectory)
+        sys.modules.pop('hytra_test_dependency_a', None)
+        shutil.rmtree(directory)
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pytest
+from hytra.pluginsystem.plugin_manager import TrackingPluginManager
+from hytra.pluginsystem.transition_feature_vector_construction_plugin import stackObjectFeatures
+
+oldStylePlugin = '''
+from hytra.pluginsystem import transition_feature_vector_construction_plugin
+
+class OldStyleTransitionFeatures(transition_feature_vector_construction_plugin.TransitionFeatureVectorConstructionPlugin):
+    def constructFeatureVector(self, featureDictObjectA, featureDictObjectB, selectedFeatures):
+        return [float(featureDictObjectA['Count']) / float(featureDictObjectB['Count'])]
+'''
+
+selectedFeatures = ['Count', 'Mean', 'RegionCenter', 'Variance']
+
+def createObjectFeatures(numObjects):
+    rng = np.random.RandomState(0)
+    return [{'Count': np.float32(rng.randint(1, 100)),
+             'Mean': np.float32(rng.rand()),
+             'RegionCenter': rng.rand(3).astype(np.float32) * 100,
+             'Variance': rng.rand(2, 2).astype(np.float32),
+             'Polygon': [[1, 2], [3, 4]]}
+            for i in range(numObjects)]
+
+def checkBatchedMatchesPerPair(pluginManager):
+    objects = createObjectFeatures(10)
+    objectsA = objects[:5]
+    objectsB = objects[5:]
+    featureMatrix = pluginManager.applyTransitionFeatureMatrixConstructionPlugins(
+        stackObjectFeatures(objectsA, selectedFeatures), stackObjectFeatures(objectsB, selectedFeatures), selectedFeatures)
+
+    assert(featureMatrix.shape[0] == 5)
+    for i in range(5):
+        featureVector = pluginManager.applyTransitionFeatureVectorConstructionPlugins(objectsA[i], objectsB[i], selectedFeatures)
+        assert(np.allclose(featureMatrix[i], np.array(featureVector), rtol=1e-6))
+
+def getTransitionPlugins(pluginManager):
+    plugins = []
+    pluginManager._applyToAllPluginsOfCategory(plugins.append, "TransitionFeatureVectorConstruction")
+    return dict((p.__class__.__name__, p) for p in plugins)
+
+def test_transition_feature_matrix():
+    # the subtraction and multiplication plugins need the python 2 `compiler` module
+    pytest.importorskip('compiler')
+    pluginManager = TrackingPluginManager(pluginPaths=['hytra/plugins'])
+    plugins = getTransitionPlugins(pluginManager)
+    assert(sorted(plugins.keys()) == ['TransitionFeaturesDistance', 'TransitionFeaturesMultiplication',
+                                      'TransitionFeaturesSubtraction'])
+    checkBatchedMatchesPerPair(pluginManager)
+
+    # columns of the scalar features first, then the flattened variance, all skipping the region center
+    objects = createObjectFeatures(6)
+    featuresA = stackObjectFeatures(objects[:3], selectedFeatures)
+    featuresB = stackObjectFeatures(objects[3:], selectedFeatures)
+    varianceA = featuresA['Variance'].astype('float32').reshape(3, 4)
+    varianceB = featuresB['Variance'].astype('float32').reshape(3, 4)
+    scalarColumns = lambda op: [op(featuresA[k].astype('float64'), featuresB[k].astype('float64')).reshape(3, 1)
+                                for k in ['Count', 'Mean']]
+    expected = {'TransitionFeaturesSubtraction': np.hstack(scalarColumns(np.subtract) + [varianceA - varianceB]),
+                'TransitionFeaturesMultiplication': np.hstack(scalarColumns(np.multiply) + [varianceA * varianceB])}
+    for name, expectedMatrix in expected.items():
+        featureMatrix = plugins[name].constructFeatureMatrix(featuresA, featuresB, selectedFeatures)
+        assert(featureMatrix.dtype == np.float64)
+        assert(featureMatrix.shape == (3, 6))
+        assert(np.array_equal(featureMatrix, expectedMatrix))
+
+def test_transition_feature_matrix_fallback():
+    pluginDirectory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(pluginDirectory, 'old_style_transition_features.py'), 'w') as f:
+            f.write(oldStylePlugin)
+        with open(os.path.join(pluginDirectory, 'old_style_transition_features.yapsy-plugin'), 'w') as f:
+            f.write('[Core]\nName = OldStyleTransitionFeatures\nModule = old_style_transition_features\n')
+        pluginManager = TrackingPluginManager(pluginPaths=[pluginDirectory])
+        checkBatchedMatchesPerPair(pluginManager)
+
+        # no transitions at all
+        emptyMatrix = pluginManager.applyTransitionFeatureMatrixConstructionPlugins(
+            stackObjectFeatures([], selectedFeatures), stackObjectFeatures([], selectedFeatures), selectedFeatures)
+        assert(emptyMatrix.shape[0] == 0)
+    finally:
+        shutil.rmtree(pluginDirectory)
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pytest
+from hytra.util.framecache import FrameCache
+
+zarr = pytest.importorskip('zarr')
+
+rng = np.random.RandomState(0)
+# raw data with the time axis in the middle, and labels with a singleton y axis
+rawImage = rng.randint(0, 255, (20, 30, 3, 1)).astype(np.uint8)
+labelImage = rng.randint(0, 10, (3, 20, 1, 30, 1)).astype(np.uint16)
+
+def createStore(directory):
+    store = zarr.DirectoryStore(os.path.join(directory, 'data.zarr'))
+    zarr.array(rawImage, chunks=(7, 8, 1, 1), store=store, path='raw')
+    zarr.array(labelImage, chunks=(1, 6, 1, 7, 1), store=store, path='labels')
+    return os.path.join(directory, 'data.zarr')
+
+def createLoader():
+    from hytra.plugins.image_provider.zarr_image_loader import ZarrImageLoader
+    loader = ZarrImageLoader()
+    loader.numDecompressionThreads = 3
+    return loader
+
+def test_zarr_region_reads():
+    tmpDirectory = tempfile.mkdtemp()
+    try:
+        resource = createStore(tmpDirectory)
+        loader = createLoader()
+
+        assert(tuple(loader.getImageShape(resource, 'labels')) == (20, 1, 30))
+        assert(loader.getTimeRange(resource, 'labels') == (0, 3))
+
+        for t in range(3):
+            raw = loader.getImageDataAtTimeFrame(resource, 'raw', 'xytc', t)
+            assert((raw == rawImage[:, :, t, 0]).all())
+            label = loader.getLabelImageForFrame(resource, 'labels', t)
+            assert(label.dtype == np.uint32)
+            assert((label == labelImage[t, :, 0, :, 0]).all())
+
+            # regions, also one pixel wide ones, are the same as slices of the full frame
+            for roi in [(slice(3, 17), slice(5, 29)), (slice(4, 5), slice(0, 30)), (slice(0, 20), slice(9, 10))]:
+                assert((loader.getImageDataRegion(resource, 'raw', 'xytc', t, roi) == raw[roi]).all())
+                labelRegion = loader.getLabelImageRegion(resource, 'labels', t, roi)
+                assert(labelRegion.dtype == np.uint32)
+                assert((labelRegion == label[roi]).all())
+
+        # the label buffer is reused if it fits
+        out = np.zeros((20, 30), dtype=np.uint32)
+        label = loader.getLabelImageForFrame(resource, 'labels', 1, out=out)
+        assert(label is out)
+        assert((out == labelImage[1, :, 0, :, 0]).all())
+    finally:
+        shutil.rmtree(tmpDirectory)
+
+def test_zarr_region_reads_use_frame_cache():
+    tmpDirectory = tempfile.mkdtemp()
+    try:
+        resource = createStore(tmpDirectory)
+        loader = createLoader()
+        loader.setFrameCache(FrameCache(10**6))
+        raw = loader.getImageDataAtTimeFrame(resource, 'raw', 'xytc', 2)
+        label = loader.getLabelImageForFrame(resource, 'labels', 2)
+
+        # cached frames are cropped instead of reading from the store again
+        def noReading(*args):
+            raise AssertionError("store must not be read")
+        loader._getArray = noReading
+        roi = (slice(2, 3), slice(4, 12))
+        assert((loader.getImageDataRegion(resource, 'raw', 'xytc', 2, roi) == raw[roi]).all())
+        assert((loader.getLabelImageRegion(resource, 'labels', 2, roi) == label[roi]).all())
+    finally:
+        shutil.rmtree(tmpDirectory)
+
+def test_zarr_export_roundtrip():
+    tmpDirectory = tempfile.mkdtemp()
+    try:
+        resource = createStore(tmpDirectory)
+        loader = createLoader()
+        loader.setFrameCache(FrameCache(10**6))
+        frames = [rng.randint(0, 100, (20, 30)).astype(np.uint32) for _ in range(2)]
+
+        loader.exportLabelImage(frames[0], 0, resource, 'exported')
+        assert(loader.getTimeRange(resource, 'exported') == (0, 1))
+        assert((loader.getLabelImageForFrame(resource, 'exported', 0) == frames[0]).all())
+
+        # later frames extend the array, overwriting a frame discards it from the frame cache
+        loader.exportLabelImage(frames[1], 3, resource, 'exported')
+        loader.exportLabelImage(frames[1], 0, resource, 'exported')
+        assert(loader.getTimeRange(resource, 'exported') == (0, 4))
+        assert(tuple(loader.getImageShape(resource, 'exported')) == (20, 30, 1))
+        assert((loader.getLabelImageForFrame(resource, 'exported', 0) == frames[1]).all())
+        assert((loader.getLabelImageForFrame(resource, 'exported', 1) == 0).all())
+        assert((loader.getLabelImageRegion(resource, 'exported', 3, (slice(5, 6),)) == frames[1][5:6]).all())
+    finally:
+        shutil.rmtree(tmpDirectory)
@@ -0,0 +1,53 @@
+import numpy as np
+import json_tricks as json
+from hytra.util.featureencoding import encodeFeatures, decodeFeatures, isEncodedFeatures
+
+def test_feature_encoding_roundtrip():
+    features = {'RegionCenter': np.random.rand(100, 2),
+                'Count': np.arange(100, dtype=np.float32),
+                'filename': np.array(['a.h5'] * 100),
+                'Polygon': [np.zeros((3, 2)), np.ones((4, 2))]}
+
+    for compress in [True, False]:
+        data = encodeFeatures(features, compress)
+        assert(isEncodedFeatures(data))
+        decoded = decodeFeatures(data)
+        assert(set(decoded.keys()) == set(features.keys()))
+        assert(decoded['RegionCenter'].dtype == np.float64)
+        assert(np.all(decoded['RegionCenter'] == features['RegionCenter']))
+        assert(decoded['Count'].dtype == np.float32)
+        assert(np.all(decoded['Count'] == features['Count']))
+        assert(np.all(decoded['filename'] == features['filename']))
+        assert(len(decoded['Polygon']) == 2)
+        assert(np.all(np.array(decoded['Polygon'][1]) == 1))
+
+def test_feature_encoding_detects_json():
+    assert(not isEncodedFeatures(json.dumps({'Count': [1, 2, 3]})))
+
+def test_feature_hdf5_roundtrip():
+    import os
+    import tempfile
+    import shutil
+    from hytra.util.featureencoding import writeFeaturesToHdf5, readFeaturesFromHdf5
+
+    features = {'RegionCenter': np.random.rand(100, 2),
+                'Count': np.arange(100, dtype=np.float32),
+                'filename': np.array(['a.h5'] * 100),
+                'Polygon': [np.zeros((3, 2)), np.ones((4, 2))]}
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'features-0.h5')
+        writeFeaturesToHdf5(features, filename)
+        assert(os.listdir(directory) == ['features-0.h5'])
+        for memoryMap in [True, False]:
+            loaded = readFeaturesFromHdf5(filename, memoryMap)
+            assert(set(loaded.keys()) == set(features.keys()))
+            assert(isinstance(loaded['RegionCenter'], np.memmap) == memoryMap)
+            assert(np.all(loaded['RegionCenter'] == features['RegionCenter']))
+            assert(loaded['Count'].dtype == np.float32)
+            assert(np.all(loaded['Count'] == features['Count']))
+            assert(np.all(loaded['filename'] == features['filename']))
+            assert(np.all(np.array(loaded['Polygon'][1]) == 1))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import pickle
+import tempfile
+import numpy as np
+from hytra.util import framecache
+from hytra.util.framecache import FrameCache
+
+def test_frame_cache_loads_once():
+    cache = FrameCache(1024)
+    numLoads = [0]
+    def loadFrame():
+        numLoads[0] += 1
+        return np.arange(10, dtype=np.uint32)
+
+    a = cache.getOrLoad(('label', 'file.h5', 'path', 0), loadFrame)
+    b = cache.getOrLoad(('label', 'file.h5', 'path', 0), loadFrame)
+    assert(numLoads[0] == 1)
+    assert(np.all(a == b))
+    assert(not b.flags.writeable)
+
+def test_frame_cache_byte_budget():
+    # room for two frames of 400 bytes only
+    cache = FrameCache(800)
+    for t in range(3):
+        cache.put(t, np.zeros(100, dtype=np.uint32))
+    assert(cache.get(0) is None)
+    assert(cache.get(1) is not None)
+    assert(cache.get(2) is not None)
+
+    # frames larger than the budget are never kept
+    cache.put(3, np.zeros(1000, dtype=np.uint32))
+    assert(cache.get(3) is None)
+
+def test_frame_cache_scratch_directory():
+    scratchDirectory = tempfile.mkdtemp()
+    try:
+        cache = FrameCache(0, scratchDirectory)
+        cache.put(('raw', 'file.h5', 'path', 'txy', 5), np.ones((3, 4)))
+
+        # an unpickled copy, as used in worker processes, finds the frame in the scratch directory
+        otherCache = pickle.loads(pickle.dumps(cache))
+        otherCache.clear()
+        frame = otherCache.get(('raw', 'file.h5', 'path', 'txy', 5))
+        assert(frame.shape == (3, 4))
+        assert(np.all(frame == 1))
+
+        otherCache.discard(('raw', 'file.h5', 'path', 'txy', 5))
+        assert(cache.get(('raw', 'file.h5', 'path', 'txy', 5)) is None)
+    finally:
+        shutil.rmtree(scratchDirectory)
+
+def test_frame_cache_scratch_directory_per_run():
+    scratchDirectory = tempfile.mkdtemp()
+    try:
+        key = ('label', 'file.h5', 'path', 0)
+        cache = FrameCache(0, scratchDirectory)
+        cache.put(key, np.ones(3))
+
+        # a cache of another run does not see stale frames of the same file
+        otherCache = FrameCache(0, scratchDirectory)
+        assert(otherCache.get(key) is None)
+        assert(cache.scratchDirectory != otherCache.scratchDirectory)
+
+        cache.clear(removeScratchFiles=True)
+        assert(cache.get(key) is None)
+        assert(os.listdir(cache.scratchDirectory) == [])
+
+        # the scratch files are only removed by the process that created the cache
+        framecache._removeScratchDirectory(otherCache.scratchDirectory, os.getpid() + 1)
+        assert(os.path.isdir(otherCache.scratchDirectory))
+        framecache._removeScratchDirectory(otherCache.scratchDirectory, os.getpid())
+        assert(not os.path.exists(otherCache.scratchDirectory))
+    finally:
+        shutil.rmtree(scratchDirectory)